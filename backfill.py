@@ -0,0 +1,356 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+import argparse
+import asyncio
+import multiprocessing as mp
+import datetime as dt
+import time
+from heartbeat import Heartbeat
+from heartbeat.utils import Queue, Stage
+from heartbeat.op_codec import encode_queues, decode_queues
+from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.tooter import Tooter
+from ccdexplorer_fundamentals.mongodb import (
+    MongoDB,
+    MongoMotor,
+    Collections,
+)
+from env import *
+from rich.console import Console
+import urllib3
+
+urllib3.disable_warnings()
+
+console = Console()
+
+# queues that go straight into a collection. Modules are reconciled at the end,
+# once all instances of a module are known.
+COLLECTION_FOR_QUEUE = {
+    Queue.blocks: Collections.blocks,
+    Queue.special_events: Collections.special_events,
+    Queue.transactions: Collections.transactions,
+    Queue.involved_all: Collections.involved_accounts_all,
+    Queue.involved_transfer: Collections.involved_accounts_transfer,
+    Queue.involved_contract: Collections.involved_contracts,
+    Queue.instances: Collections.instances,
+    Queue.logged_events: Collections.tokens_logged_events,
+    Queue.impacted_addresses: Collections.impacted_addresses,
+}
+
+
+def create_heartbeat(net: str) -> Heartbeat:
+    """
+    Every process creates its own clients, these can't be shared
+    between processes. Backfill processes don't touch the snapshot, spool
+    or checkpoint of the running service.
+    """
+    tooter = Tooter()
+    return Heartbeat(
+        GRPCClient(),
+        tooter,
+        MongoDB(tooter),
+        MongoMotor(tooter),
+        net,
+        persist_state=False,
+    )
+
+
+async def fetch_range_with_retries(
+    heartbeat: Heartbeat, height: int, count: int
+) -> list[CCD_BlockInfo]:
+    """
+    An empty range is usually a transient gRPC failure, so it is fetched
+    again, up to BACKFILL_FETCH_RETRIES times, before the height is given up.
+    """
+    for attempt in range(BACKFILL_FETCH_RETRIES + 1):
+        if attempt > 0:
+            await asyncio.sleep(BACKFILL_FETCH_BACKOFF * 2 ** (attempt - 1))
+        block_infos = await heartbeat.block_fetcher.fetch_range(height, count)
+        if len(block_infos) > 0:
+            return block_infos
+    return []
+
+
+async def backfill_worker(
+    worker_id: int, net: str, tasks: mp.Queue, ops: mp.Queue
+) -> None:
+    """
+    Takes height ranges from `tasks`, fetches and decodes the blocks through
+    the regular decode path and sends the resulting operations to the writer,
+    BACKFILL_BATCH blocks per message. When there are no more ranges, the
+    modules this worker has seen contracts for are sent along, so the writer
+    can reconcile them.
+    """
+    loop = asyncio.get_running_loop()
+    heartbeat = create_heartbeat(net)
+    heartbeat.load_existing_modules_and_instances()
+    updated_modules = set()
+    failed_heights = []
+
+    while True:
+        task = await loop.run_in_executor(None, tasks.get)
+        if task is None:
+            break
+        start_height, end_height = task
+        height = start_height
+        while height <= end_height:
+            block_infos = await fetch_range_with_retries(
+                heartbeat, height, min(BACKFILL_BATCH, end_height - height + 1)
+            )
+            if len(block_infos) == 0:
+                console.log(f"Worker {worker_id}: block {height:,.0f} not found.")
+                failed_heights.append(height)
+                height += 1
+                continue
+
+            for block_info in block_infos:
+                heartbeat.block_prefetcher.prefetch(block_info)
+            decoded = await asyncio.gather(
+                *[
+                    heartbeat.run_in_stage(
+                        Stage.decode, heartbeat.decode_block, block_info
+                    )
+                    for block_info in block_infos
+                ],
+                return_exceptions=True,
+            )
+            batch = {q: [] for q in Queue}
+            for block_info, block_queues in zip(block_infos, decoded):
+                heartbeat.block_prefetcher.release(block_info)
+                if isinstance(block_queues, Exception):
+                    heartbeat.log_error_in_mongo(block_queues, block_info)
+                    failed_heights.append(block_info.height)
+                    continue
+                for q, queue in block_queues.items():
+                    batch[q].extend(queue)
+            # as `commit_decoded_block` does, so later transactions on these
+            # contracts don't request the instance again.
+            for instance in batch[Queue.instances]:
+                heartbeat.contract_index.add_instance(instance._filter["_id"])
+            updated_modules.update(batch[Queue.updated_modules])
+            for module_ref in batch[Queue.modules]:
+                updated_modules.add(module_ref._filter["_id"])
+            # modules are reconciled by the writer.
+            for q in [Queue.modules, Queue.updated_modules, Queue.block_heights]:
+                batch[q] = []
+
+            await loop.run_in_executor(None, ops.put, ("ops", encode_queues(batch)))
+            console.log(
+                f"Worker {worker_id}: decoded {block_infos[0].height:,.0f} - {block_infos[-1].height:,.0f}."
+            )
+            height = block_infos[-1].height + 1
+
+    discovered = {
+        module_ref: list(heartbeat.existing_source_modules.get(module_ref, []))
+        for module_ref in updated_modules
+    }
+    await loop.run_in_executor(
+        None, ops.put, ("done", worker_id, discovered, failed_heights)
+    )
+    heartbeat.exit()
+
+
+async def backfill_writer(
+    net: str, ops: mp.Queue, nr_of_workers: int, blocks_per_day: bool
+) -> None:
+    """
+    The single process that writes to MongoDB. Operations from all workers
+    are collected and written with unordered bulk writes once
+    BACKFILL_WRITE_BATCH operations are waiting. When all workers are done,
+    the modules are written with the contracts found by all workers combined.
+    """
+    loop = asyncio.get_running_loop()
+    heartbeat = create_heartbeat(net)
+    pending = {q: [] for q in Queue}
+    discovered: dict[CCD_ModuleRef, set] = {}
+    failed_heights = []
+    workers_done = 0
+    written = 0
+    start = dt.datetime.now()
+
+    async def write_pending():
+        """
+        Writes through `flush_queue`, with the chunking and retries of
+        `send_to_mongo`. Operations that still could not be written stay
+        pending, to be retried with the next write.
+        """
+        nonlocal written
+        for q, collection in COLLECTION_FOR_QUEUE.items():
+            if len(pending[q]) == 0:
+                continue
+            ops = len(pending[q])
+            try:
+                await heartbeat.flush_queue(
+                    pending, q, collection, heartbeat.flush_semaphore
+                )
+            except Exception as e:
+                console.log(
+                    f"Writer: {len(pending[q]):,.0f} operations for {collection.value} not written: {e}"
+                )
+            written += ops - len(pending[q])
+
+    while workers_done < nr_of_workers:
+        message = await loop.run_in_executor(None, ops.get)
+        if message[0] == "ops":
+            for q, queue in decode_queues(message[1]).items():
+                pending[q].extend(queue)
+            if (
+                sum([len(pending[q]) for q in COLLECTION_FOR_QUEUE])
+                >= BACKFILL_WRITE_BATCH
+            ):
+                await write_pending()
+                console.log(
+                    f"Writer: {written:,.0f} operations in {(dt.datetime.now() - start).total_seconds():,.0f} sec."
+                )
+        else:
+            _, worker_id, worker_discovered, worker_failed_heights = message
+            workers_done += 1
+            if worker_discovered is None:
+                console.log(f"Writer: worker {worker_id} failed.")
+                continue
+            for module_ref, contracts in worker_discovered.items():
+                discovered.setdefault(module_ref, set()).update(contracts)
+            failed_heights.extend(worker_failed_heights)
+
+    await write_pending()
+    not_written = sum([len(pending[q]) for q in COLLECTION_FOR_QUEUE])
+    if not_written > 0:
+        console.log(
+            f"Writer: {not_written:,.0f} operations could not be written, run backfill for this range again."
+        )
+
+    # every worker only knows the contracts it has seen itself, so the module
+    # documents are created here, from the combined view.
+    heartbeat.load_existing_modules_and_instances()
+    for module_ref, contracts in discovered.items():
+        heartbeat.existing_source_modules.setdefault(module_ref, set()).update(
+            contracts
+        )
+    heartbeat.add_back_updated_modules_to_queue(list(discovered.keys()))
+    if len(heartbeat.queues[Queue.modules]) > 0:
+        heartbeat.db[Collections.modules].bulk_write(heartbeat.queues[Queue.modules])
+    console.log(f"Writer: reconciled {len(discovered):,.0f} modules.")
+
+    if len(pending[Queue.token_addresses_to_redo_accounting]) > 0:
+        result = heartbeat.db[Collections.helpers].find_one(
+            {"_id": "redo_token_addresses"}
+        )
+        token_addresses = result["token_addresses"] if result else []
+        heartbeat.db[Collections.helpers].replace_one(
+            {"_id": "redo_token_addresses"},
+            {
+                "_id": "redo_token_addresses",
+                "token_addresses": list(
+                    set(
+                        token_addresses
+                        + pending[Queue.token_addresses_to_redo_accounting]
+                    )
+                ),
+            },
+            upsert=True,
+        )
+
+    if len(pending[Queue.provenance_contracts_to_add]) > 0:
+        heartbeat.save_provenance_contracts(pending[Queue.provenance_contracts_to_add])
+
+    if blocks_per_day:
+        heartbeat.create_block_per_day()
+
+    if len(failed_heights) > 0:
+        console.log(
+            f"Writer: {len(failed_heights):,.0f} blocks failed: {sorted(failed_heights)}"
+        )
+    console.log(
+        f"Writer: done, {written:,.0f} operations in {(dt.datetime.now() - start).total_seconds():,.0f} sec."
+    )
+    heartbeat.exit()
+
+
+def run_worker(worker_id: int, net: str, tasks: mp.Queue, ops: mp.Queue):
+    asyncio.run(backfill_worker(worker_id, net, tasks, ops))
+
+
+def run_writer(net: str, ops: mp.Queue, nr_of_workers: int, blocks_per_day: bool):
+    asyncio.run(backfill_writer(net, ops, nr_of_workers, blocks_per_day))
+
+
+def main():
+    """
+    Backfill re-indexes a range of heights, using multiple processes:
+    1. The range is split into chunks of `--chunk-size` heights, which
+    worker processes take from a shared task queue.
+    2. Every worker fetches and decodes its blocks with the same decode
+    path as `process_blocks` and sends the resulting Mongo operations,
+    encoded with `op_codec`, to the writer.
+    3. A single writer process does all bulk writes and, once all workers
+    are done, reconciles the modules with the contracts found by all workers.
+    Backfill does not move `heartbeat_last_processed_block` and does not
+    read or write the snapshot or the spool. Workers skip
+    `lookout_for_payday` and `lookout_for_end_of_day`: `last_known_payday`
+    is not updated, use `--blocks-per-day` to re-create blocks_per_day.
+    """
+    parser = argparse.ArgumentParser(description="Backfill a range of heights.")
+    parser.add_argument("start_height", type=int)
+    parser.add_argument("end_height", type=int)
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument(
+        "--blocks-per-day",
+        action="store_true",
+        help="Re-create blocks_per_day when done.",
+    )
+    args = parser.parse_args()
+    console.log(
+        f"Backfill {RUN_ON_NET}: {args.start_height:,.0f} - {args.end_height:,.0f} with {args.workers} workers."
+    )
+
+    # gRPC channels don't survive a fork.
+    ctx = mp.get_context("spawn")
+    tasks = ctx.Queue()
+    for start_height in range(args.start_height, args.end_height + 1, args.chunk_size):
+        tasks.put(
+            (start_height, min(start_height + args.chunk_size - 1, args.end_height))
+        )
+    for _ in range(args.workers):
+        tasks.put(None)
+    # bounded, so workers wait if the writer can't keep up.
+    ops = ctx.Queue(maxsize=BACKFILL_QUEUE_SIZE)
+
+    writer = ctx.Process(
+        target=run_writer,
+        args=(RUN_ON_NET, ops, args.workers, args.blocks_per_day),
+    )
+    writer.start()
+    workers = [
+        ctx.Process(target=run_worker, args=(worker_id, RUN_ON_NET, tasks, ops))
+        for worker_id in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # if the writer dies, the workers would wait forever for room in `ops`.
+    while any([worker.is_alive() for worker in workers]):
+        if not writer.is_alive():
+            console.log(
+                f"Backfill: writer exited with {writer.exitcode}, stopping the workers."
+            )
+            for worker in workers:
+                worker.terminate()
+            break
+        time.sleep(1)
+
+    for worker_id, worker in enumerate(workers):
+        worker.join()
+        if (worker.exitcode != 0) and writer.is_alive():
+            # let the writer know it shouldn't wait for this worker.
+            ops.put(("done", worker_id, None, []))
+    writer.join()
+    if writer.exitcode != 0:
+        console.log(f"Backfill: writer exited with {writer.exitcode}.")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as f:
+        console.log("backfill error: ", f)
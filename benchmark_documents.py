@@ -0,0 +1,153 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+import argparse
+import gzip
+import json
+import time
+from heartbeat.documents import block_document, transaction_document
+from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.enums import NET
+from env import *
+from rich.console import Console
+import urllib3
+
+urllib3.disable_warnings()
+
+console = Console()
+
+
+def json_round_trip_block(block_info: CCD_BlockInfo, transaction_hashes: list[str]):
+    """
+    How `add_block_and_txs_to_queue` used to build the block document.
+    """
+    json_block_info: dict = json.loads(block_info.model_dump_json(exclude_none=True))
+    json_block_info.update({"_id": block_info.hash})
+    json_block_info.update({"slot_time": block_info.slot_time})
+    del json_block_info["arrive_time"]
+    del json_block_info["receive_time"]
+    json_block_info.update({"transaction_hashes": transaction_hashes})
+    return json_block_info
+
+
+def json_round_trip_tx(tx: CCD_BlockItemSummary, block_info: CCD_BlockInfo):
+    """
+    How `add_block_and_txs_to_queue` used to build a transaction document.
+    """
+    json_tx: dict = json.loads(tx.model_dump_json(exclude_none=True))
+    json_tx.update({"_id": tx.hash})
+    json_tx.update(
+        {
+            "block_info": {
+                "height": block_info.height,
+                "hash": block_info.hash,
+                "slot_time": block_info.slot_time,
+            }
+        }
+    )
+    return json_tx
+
+
+def record(path: str, start_height: int, nr_of_blocks: int):
+    """
+    Records blocks (with transaction events) from the node, so every run
+    of the benchmark uses the same input.
+    """
+    grpcclient = GRPCClient()
+    recorded = 0
+    height = start_height
+    with gzip.open(path, "wt") as f:
+        while recorded < nr_of_blocks:
+            block_info = grpcclient.get_finalized_block_at_height(
+                height, NET(RUN_ON_NET)
+            )
+            height += 1
+            if block_info.transaction_count == 0:
+                continue
+            block = grpcclient.get_block_transaction_events(
+                block_info.hash, NET(RUN_ON_NET)
+            )
+            f.write(
+                json.dumps(
+                    {
+                        "block_info": json.loads(block_info.model_dump_json()),
+                        "block": json.loads(block.model_dump_json()),
+                    }
+                )
+                + "\n"
+            )
+            recorded += 1
+    console.log(
+        f"Recorded {recorded:,.0f} blocks {start_height:,.0f} - {height - 1:,.0f} to {path}."
+    )
+
+
+def load(path: str) -> list[tuple[CCD_BlockInfo, CCD_Block]]:
+    with gzip.open(path, "rt") as f:
+        return [
+            (
+                CCD_BlockInfo.model_validate(x["block_info"]),
+                CCD_Block.model_validate(x["block"]),
+            )
+            for x in map(json.loads, f)
+        ]
+
+
+def encode_all(blocks: list[tuple[CCD_BlockInfo, CCD_Block]], encode_block, encode_tx):
+    docs = []
+    for block_info, block in blocks:
+        docs.append(
+            encode_block(block_info, [x.hash for x in block.transaction_summaries])
+        )
+        for tx in block.transaction_summaries:
+            docs.append(encode_tx(tx, block_info))
+    return docs
+
+
+def benchmark(path: str, rounds: int):
+    blocks = load(path)
+    nr_of_txs = sum([len(block.transaction_summaries) for _, block in blocks])
+
+    # the stored shape must not change.
+    if encode_all(blocks, json_round_trip_block, json_round_trip_tx) != encode_all(
+        blocks, block_document, transaction_document
+    ):
+        console.log("Documents differ from the json round trip!")
+        return
+
+    for name, encode_block, encode_tx in [
+        ("json round trip", json_round_trip_block, json_round_trip_tx),
+        ("document encoder", block_document, transaction_document),
+    ]:
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            encode_all(blocks, encode_block, encode_tx)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        console.log(
+            f"{name:>16}: {best:,.3f} s for {len(blocks):,.0f} blocks, {nr_of_txs:,.0f} txs ({1_000_000 * best / max(1, nr_of_txs):,.1f} µs/tx)."
+        )
+
+
+def main():
+    """
+    Compares the document encoder with the json round trip it replaced, on
+    blocks recorded from the node:
+    python benchmark_documents.py --record 1000 --start-height 10000000
+    python benchmark_documents.py
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the document encoder.")
+    parser.add_argument("--path", default=f"recorded_blocks_{RUN_ON_NET}.jsonl.gz")
+    parser.add_argument("--record", type=int, help="Number of blocks to record.")
+    parser.add_argument("--start-height", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.path, args.start_height, args.record)
+    else:
+        benchmark(args.path, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
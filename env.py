@@ -8,5 +8,87 @@ load_dotenv()
 COIN_API_KEY = os.environ.get("COIN_API_KEY")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 DEBUG = False if os.environ.get("DEBUG", False) == "False" else True
-MAX_BLOCKS_PER_RUN = int(os.environ.get("MAX_BLOCKS_PER_RUN", 100))
+# batches are sized between these, see BatchController.
+MIN_BLOCKS_PER_RUN = int(os.environ.get("MIN_BLOCKS_PER_RUN", 1))
+MAX_BLOCKS_PER_RUN = int(os.environ.get("MAX_BLOCKS_PER_RUN", 1_000))
+# at most this many blocks behind the last finalized block counts as the tip.
+TIP_LAG_BLOCKS = int(os.environ.get("TIP_LAG_BLOCKS", 5))
+# during catch-up, the slowest stage should take about this long per batch.
+TARGET_BATCH_SECONDS = float(os.environ.get("TARGET_BATCH_SECONDS", 5))
+# send_to_mongo flushes at least this often (sec).
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 1))
+# special purpose blocks are processed in small batches, at most this many are outstanding.
+SPECIAL_PURPOSE_BATCH_SIZE = int(os.environ.get("SPECIAL_PURPOSE_BATCH_SIZE", 10))
+SPECIAL_PURPOSE_MAX_OUTSTANDING = int(
+    os.environ.get("SPECIAL_PURPOSE_MAX_OUTSTANDING", 100)
+)
+# warm-start snapshot of the contract index, defaults to heartbeat_<net>_snapshot.json.gz.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 300))
+# how long (sec) we trust that a contract does, or does not, support CIS-1/CIS-2.
+CIS_SUPPORT_TTL = int(os.environ.get("CIS_SUPPORT_TTL", 7 * 24 * 60 * 60))
+CIS_SUPPORT_NEGATIVE_TTL = int(os.environ.get("CIS_SUPPORT_NEGATIVE_TTL", 24 * 60 * 60))
+# number of contract addresses -> init name kept for CIS decoding of interrupted effects.
+INSTANCE_NAME_CACHE_SIZE = int(os.environ.get("INSTANCE_NAME_CACHE_SIZE", 100_000))
+# memory (MB) for the resident ledger of token supply and holder balances.
+TOKEN_LEDGER_MB = int(os.environ.get("TOKEN_LEDGER_MB", 512))
+# encode documents to BSON while decoding blocks, so a flush only sends bytes.
+RAW_BSON_WRITES = os.environ.get("RAW_BSON_WRITES", "false").lower() == "true"
+# directory of the local spool for flush batches that can't be written to MongoDB,
+# no spool if not set.
+SPOOL_DIR = os.environ.get("SPOOL_DIR")
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", 64_000_000))
+SPOOL_REPLAY_INTERVAL = float(os.environ.get("SPOOL_REPLAY_INTERVAL", 5))
+# the stored checkpoint is persisted to helpers at most this often (sec).
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", 1))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 8))
+# blocks past the ones being decoded whose gRPC reads are already issued.
+PREFETCH_BLOCKS = int(os.environ.get("PREFETCH_BLOCKS", 8))
+# "stream" follows the tip through the finalized blocks stream, "poll" only polls.
+TIP_MODE = os.environ.get("TIP_MODE", "stream")
 RUN_ON_NET = os.environ.get("RUN_ON_NET")
+
+# number of worker threads per pipeline stage.
+PROCESS_WORKERS = int(os.environ.get("PROCESS_WORKERS", 1))
+# number of blocks that are decoded concurrently, 1 decodes one block at a time.
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 1))
+FLUSH_WORKERS = int(os.environ.get("FLUSH_WORKERS", 4))
+# number of collections send_to_mongo writes to at the same time.
+FLUSH_CONCURRENCY = int(os.environ.get("FLUSH_CONCURRENCY", 4))
+# a flush is split in unordered bulk writes of at most this many operations/bytes.
+FLUSH_CHUNK_OPS = int(os.environ.get("FLUSH_CHUNK_OPS", 1_000))
+FLUSH_CHUNK_BYTES = int(os.environ.get("FLUSH_CHUNK_BYTES", 8_000_000))
+# failed operations are retried this often, after 0.5, 1, 2, ... sec.
+FLUSH_RETRIES = int(os.environ.get("FLUSH_RETRIES", 5))
+FLUSH_RETRY_BACKOFF = float(os.environ.get("FLUSH_RETRY_BACKOFF", 0.5))
+ACCOUNTING_WORKERS = int(os.environ.get("ACCOUNTING_WORKERS", 1))
+# token accounting splits a batch in this many partitions of token addresses,
+# run in parallel on a stage of their own (1 accounts for a batch serially).
+TOKEN_ACCOUNTING_PARTITIONS = int(os.environ.get("TOKEN_ACCOUNTING_PARTITIONS", 1))
+# logged events are read in pages of whole blocks, sized to about this many sec
+# of token accounting, between min and max events.
+TOKEN_ACCOUNTING_MIN_PAGE = int(os.environ.get("TOKEN_ACCOUNTING_MIN_PAGE", 1_000))
+TOKEN_ACCOUNTING_MAX_PAGE = int(os.environ.get("TOKEN_ACCOUNTING_MAX_PAGE", 50_000))
+TOKEN_ACCOUNTING_TARGET_SECONDS = float(
+    os.environ.get("TOKEN_ACCOUNTING_TARGET_SECONDS", 2)
+)
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 4))
+METRICS_INTERVAL = int(os.environ.get("METRICS_INTERVAL", 60))
+
+# limits between stages, in items and in estimated bytes.
+MAX_PENDING_BLOCKS = int(os.environ.get("MAX_PENDING_BLOCKS", 5_000))
+MAX_PENDING_BLOCKS_BYTES = int(os.environ.get("MAX_PENDING_BLOCKS_BYTES", 100_000_000))
+MAX_QUEUED_OPS = int(os.environ.get("MAX_QUEUED_OPS", 250_000))
+MAX_QUEUED_BYTES = int(os.environ.get("MAX_QUEUED_BYTES", 500_000_000))
+
+# backfill.py
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", os.cpu_count() or 1))
+BACKFILL_CHUNK_SIZE = int(os.environ.get("BACKFILL_CHUNK_SIZE", 1_000))
+# blocks per message from a worker to the writer.
+BACKFILL_BATCH = int(os.environ.get("BACKFILL_BATCH", 100))
+BACKFILL_WRITE_BATCH = int(os.environ.get("BACKFILL_WRITE_BATCH", 10_000))
+BACKFILL_QUEUE_SIZE = int(os.environ.get("BACKFILL_QUEUE_SIZE", 64))
+# a block that isn't returned is retried this many times, with exponential
+# backoff starting at BACKFILL_FETCH_BACKOFF sec, before it is given up.
+BACKFILL_FETCH_RETRIES = int(os.environ.get("BACKFILL_FETCH_RETRIES", 5))
+BACKFILL_FETCH_BACKOFF = float(os.environ.get("BACKFILL_FETCH_BACKOFF", 1))
@@ -18,9 +18,26 @@ from .token_accounting import TokenAccounting as _token_accounting
 from .start_over import StartOver as _start_over
 from .send_to_mongo import SendToMongo as _send_to_mongo
 from .block_loop import BlockLoop as _block_loop
+from .tip_follower import TipFollower as _tip_follower
 from .consistency import Consistency as _consistency
-from .utils import Queue
+from .execution import Execution as _execution
+from .backpressure import Backpressure as _backpressure
+from .snapshot import Snapshot as _snapshot
+from .block_fetcher import BlockFetcher
+from .block_prefetcher import BlockPrefetcher
+from .contract_index import ContractIndex
+from .cis_support_cache import CisSupportCache
+from .instance_name_cache import InstanceNameCache
+from .token_ledger import TokenAddressLocks, TokenLedger
+from .logged_event_stream import LoggedEventStream
+from .batch_controller import BatchController
+from .bulk_writes import FlushStats
+from .pending_blocks import PendingBlocks
+from .spool import Spool
+from .utils import Queue, Stage
 import aiohttp
+import asyncio
+import threading
 
 urllib3.disable_warnings()
 console = Console()
@@ -28,11 +45,15 @@ console = Console()
 
 class Heartbeat(
     _block_loop,
+    _tip_follower,
     _impacted_addresses,
     _token_accounting,
     _start_over,
     _send_to_mongo,
     _consistency,
+    _execution,
+    _backpressure,
+    _snapshot,
 ):
     def __init__(
         self,
@@ -41,12 +62,19 @@ class Heartbeat(
         mongodb: MongoDB,
         motormongo: MongoMotor,
         net: str,
+        persist_state: bool = True,
     ):
+        """
+        With `persist_state` off (backfill processes), the snapshot is neither
+        loaded nor saved, there is no spool and the checkpoint is never
+        written, so the state of the running service is left alone.
+        """
         self.grpcclient = grpcclient
         self.tooter = tooter
         self.mongodb = mongodb
         self.motormongo = motormongo
         self.net = net
+        self.persist_state = persist_state
         self.utilities: dict[Collections, Collection] = self.mongodb.utilities
         self.db: dict[Collections, Collection] = (
             self.mongodb.mainnet if self.net == "mainnet" else self.mongodb.testnet
@@ -54,13 +82,72 @@ class Heartbeat(
         self.motordb: dict[Collections, Collection] = (
             self.motormongo.testnet if net == "testnet" else self.motormongo.mainnet
         )
-        self.finalized_block_infos_to_process: list[CCD_BlockInfo] = []
-        self.special_purpose_block_infos_to_process: list[CCD_BlockInfo] = []
+        self.finalized_block_infos_to_process = PendingBlocks()
+        self.special_purpose_block_infos_to_process = PendingBlocks()
+        # requested special purpose heights that are queued or being processed,
+        # with the value as it appears in the helper.
+        self.special_purpose_heights: dict[int, int | str] = {}
+        self.create_stage_executors()
+        self.create_budgets()
+        self.flush_stats = FlushStats()
+        self.block_fetcher = BlockFetcher(
+            self.grpcclient, self.net, FETCH_CONCURRENCY, self.executors[Stage.fetch]
+        )
+        self.block_prefetcher = BlockPrefetcher(
+            self.grpcclient, self.net, PREFETCH_BLOCKS, self.executors[Stage.fetch]
+        )
+        self.batch_controller = BatchController(
+            MIN_BLOCKS_PER_RUN, MAX_BLOCKS_PER_RUN, TIP_LAG_BLOCKS, TARGET_BATCH_SECONDS
+        )
+        # makes sure polling and the finalized blocks stream do not request
+        # the same heights at the same time.
+        self.fetch_lock = asyncio.Lock()
+        self.finalized_blocks_available = asyncio.Event()
+        # set by `follow_finalized_blocks` while the stream keeps us at the tip.
+        self.following_tip = False
+        self.finalized_blocks_stream = None
 
-        self.existing_source_modules: dict[CCD_ModuleRef, set] = {}
+        # progress, see `load_checkpoint`.
+        self.last_committed_height: int | None = None
+        self.last_stored_height: int | None = None
+        self.last_persisted_height: int | None = None
+        # flush batches that couldn't be written go to the spool, if configured.
+        self.spool = (
+            Spool(SPOOL_DIR, SPOOL_SEGMENT_BYTES)
+            if (SPOOL_DIR and self.persist_state)
+            else None
+        )
+        self.last_spooled_height: int | None = (
+            self.spool.last_checkpoint_height if self.spool else None
+        )
+        self.flush_semaphore = asyncio.Semaphore(max(1, FLUSH_CONCURRENCY))
+
+        self.instance_name_cache = InstanceNameCache(INSTANCE_NAME_CACHE_SIZE)
+        self.contract_index = ContractIndex(self.instance_name_cache)
+        self.existing_source_modules: dict[CCD_ModuleRef, set] = (
+            self.contract_index.modules
+        )
+        self.existing_instances: dict[str, bool] = self.contract_index.instances
+        self.cis_support_cache = CisSupportCache(
+            CIS_SUPPORT_TTL, CIS_SUPPORT_NEGATIVE_TTL
+        )
+        self.token_ledger = TokenLedger(TOKEN_LEDGER_MB * 1_000_000)
+        self.token_address_locks = TokenAddressLocks()
+        self.logged_event_stream = LoggedEventStream(
+            TOKEN_ACCOUNTING_MIN_PAGE,
+            TOKEN_ACCOUNTING_MAX_PAGE,
+            TOKEN_ACCOUNTING_TARGET_SECONDS,
+        )
         self.queues: dict[Collections, list] = {}
         for q in Queue:
             self.queues[q] = []
+        # processing (adding to) and flushing (taking from) the queues happen
+        # in different threads.
+        self.queues_lock = threading.Lock()
+        # blocks that are decoded concurrently share `existing_source_modules`.
+        self.discovery_lock = threading.Lock()
+        if self.persist_state:
+            self.load_snapshot()
 
         # this gets set every time the log heartbeat last processed helper gets set
         # in block_loop we check if this value is < x min from now.
@@ -74,5 +161,18 @@ class Heartbeat(
         self.coin_api_session = aiohttp.ClientSession(headers=coin_api_headers)
 
     def exit(self):
+        if self.persist_state:
+            self.persist_checkpoint_on_exit()
+        if self.spool is not None:
+            self.spool.close()
+        if self.persist_state:
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                console.log(f"Could not save snapshot: {e}")
+        if self.finalized_blocks_stream:
+            self.finalized_blocks_stream.cancel()
+        self.block_fetcher.shutdown()
+        self.shutdown_stage_executors()
         self.session.close()
         self.coin_api_session.close()
@@ -0,0 +1,156 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .utils import Utils, Queue
+from pymongo import ReplaceOne
+from env import *
+import datetime as dt
+import random
+import time
+import bson
+from bson.raw_bson import RawBSONDocument
+from rich.console import Console
+
+console = Console()
+
+# used until we have measured the size of operations in a queue.
+DEFAULT_OP_BYTES = 2_000
+# number of operations per queue we encode to estimate the average size.
+OPS_TO_SAMPLE = 10
+
+
+class Budget:
+    """
+    Limits on what sits between two stages, both in item count and in
+    estimated bytes. The current fill is measured by the caller, this only
+    decides whether there is room and keeps track of how often (and how
+    long) the stage above had to wait.
+    """
+
+    def __init__(self, name: str, max_items: int, max_bytes: int):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = 0
+        self.bytes = 0
+        self.times_full = 0
+        self.seconds_waited = 0.0
+
+    def update(self, items: int, nbytes: int):
+        self.items = items
+        self.bytes = nbytes
+
+    def is_full(self) -> bool:
+        return (self.items >= self.max_items) or (self.bytes >= self.max_bytes)
+
+    def items_room(self) -> int:
+        if self.bytes >= self.max_bytes:
+            return 0
+        return max(0, self.max_items - self.items)
+
+    def fill_level(self) -> dict:
+        return {
+            "items": self.items,
+            "max_items": self.max_items,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "fill": round(
+                max(self.items / self.max_items, self.bytes / self.max_bytes), 3
+            ),
+            "times_full": self.times_full,
+            "seconds_waited": round(self.seconds_waited, 3),
+        }
+
+
+def estimate_op_bytes(op) -> int:
+    if isinstance(op, ReplaceOne):
+        if isinstance(op._doc, RawBSONDocument):
+            return len(op._doc.raw)
+        return len(bson.encode(op._doc))
+    return DEFAULT_OP_BYTES
+
+
+class Backpressure(Utils):
+    """
+    Bounds the pipeline: fetch -> `finalized_block_infos_to_process` -> process
+    -> `queues` -> flush. If the flush stage can't keep up, processing waits for
+    room in the queues, the pending blocks fill up and fetching pauses.
+    """
+
+    def create_budgets(self):
+        self.pending_blocks_budget = Budget(
+            "pending_blocks", MAX_PENDING_BLOCKS, MAX_PENDING_BLOCKS_BYTES
+        )
+        self.queues_budget = Budget("queues", MAX_QUEUED_OPS, MAX_QUEUED_BYTES)
+        # running estimate of the size of an operation, per queue.
+        self.average_op_bytes: dict[Queue, float] = {}
+
+    def record_op_sizes(self, queues: dict[Queue, list]):
+        """
+        Called by the flush stage with the queues it is about to send. Encodes
+        a small sample of the operations to keep the average size per queue
+        up to date.
+        """
+        for q, queue in queues.items():
+            if len(queue) == 0:
+                continue
+            sample = random.sample(queue, min(OPS_TO_SAMPLE, len(queue)))
+            try:
+                sample_average = sum([estimate_op_bytes(x) for x in sample]) / len(
+                    sample
+                )
+            except:
+                continue
+            previous = self.average_op_bytes.get(q, sample_average)
+            self.average_op_bytes[q] = 0.8 * previous + 0.2 * sample_average
+
+    def measure_pending_blocks(self):
+        pending_blocks = self.finalized_block_infos_to_process
+        self.pending_blocks_budget.update(
+            len(pending_blocks), pending_blocks.estimated_bytes
+        )
+
+    def measure_queues(self):
+        items = 0
+        nbytes = 0
+        for q, queue in list(self.queues.items()):
+            if q in [Queue.block_heights, Queue.updated_modules]:
+                continue
+            items += len(queue)
+            nbytes += len(queue) * self.average_op_bytes.get(q, DEFAULT_OP_BYTES)
+        self.queues_budget.update(items, int(nbytes))
+
+    def pending_blocks_room(self) -> int:
+        """
+        Number of blocks the fetch stage may add to `finalized_block_infos_to_process`.
+        """
+        self.measure_pending_blocks()
+        room = self.pending_blocks_budget.items_room()
+        if room == 0:
+            self.pending_blocks_budget.times_full += 1
+        return room
+
+    def wait_for_room_in_queues(self):
+        """
+        Runs on the process stage thread. Blocks until the flush stage has
+        made room in the queues.
+        """
+        self.measure_queues()
+        if not self.queues_budget.is_full():
+            return
+
+        start = dt.datetime.now()
+        self.queues_budget.times_full += 1
+        console.log(
+            f"Backpressure: queues are full ({self.queues_budget.items:,.0f} ops, {self.queues_budget.bytes/1_000_000:,.0f} MB), waiting for send_to_mongo."
+        )
+        while self.queues_budget.is_full():
+            time.sleep(0.1)
+            self.measure_queues()
+        self.queues_budget.seconds_waited += (dt.datetime.now() - start).total_seconds()
+
+    def fill_levels(self) -> dict:
+        self.measure_pending_blocks()
+        self.measure_queues()
+        return {
+            "pending_blocks": self.pending_blocks_budget.fill_level(),
+            "queues": self.queues_budget.fill_level(),
+        }
@@ -0,0 +1,109 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from enum import Enum
+from rich.console import Console
+
+console = Console()
+
+# weight of a new measurement in the running per-block latency.
+LATENCY_WEIGHT = 0.2
+
+
+class BatchMode(Enum):
+    tip = "tip"
+    catch_up = "catch-up"
+
+
+class BatchController:
+    """
+    Sizes the fetch, process and flush batches. At the tip (at most
+    `tip_lag` blocks behind the last finalized block) batches are as small as
+    possible, so a block is stored as soon as it is finalized. When we are
+    behind, batches are sized so the slowest stage takes about
+    `target_batch_seconds` per batch, between `min_batch` and `max_batch`.
+    """
+
+    def __init__(
+        self,
+        min_batch: int,
+        max_batch: int,
+        tip_lag: int,
+        target_batch_seconds: float,
+    ):
+        self.min_batch = max(1, min_batch)
+        self.max_batch = max(self.min_batch, max_batch)
+        self.tip_lag = tip_lag
+        self.target_batch_seconds = target_batch_seconds
+        self.mode = BatchMode.catch_up
+        self.lag = None
+        self.chain_height = None
+        # running average of seconds per block, per stage.
+        self.latency: dict[str, float] = {}
+
+    def update_chain_height(self, chain_height: int):
+        if (self.chain_height is None) or (chain_height > self.chain_height):
+            self.chain_height = chain_height
+
+    def update_lag(self, next_height: int):
+        """
+        `next_height` is the first height we haven't fetched yet.
+        """
+        if self.chain_height is None:
+            return
+        self.lag = max(0, self.chain_height - next_height + 1)
+        mode = BatchMode.tip if self.lag <= self.tip_lag else BatchMode.catch_up
+        if mode != self.mode:
+            console.log(
+                f"Batch controller: {self.mode.value} -> {mode.value} ({self.lag:,.0f} blocks behind)."
+            )
+            self.mode = mode
+
+    def record(self, stage: str, blocks: int, seconds: float):
+        if blocks <= 0:
+            return
+        per_block = seconds / blocks
+        previous = self.latency.get(stage, per_block)
+        self.latency[stage] = (
+            1 - LATENCY_WEIGHT
+        ) * previous + LATENCY_WEIGHT * per_block
+
+    def catch_up_batch_size(self) -> int:
+        slowest = max(self.latency.values()) if len(self.latency) > 0 else 0
+        if slowest > 0:
+            size = int(self.target_batch_seconds / slowest)
+        else:
+            size = self.max_batch
+        return min(self.max_batch, max(self.min_batch, size))
+
+    def fetch_batch_size(self) -> int:
+        if self.mode == BatchMode.tip:
+            return max(self.min_batch, self.lag or 0)
+        size = self.catch_up_batch_size()
+        if self.lag is not None:
+            size = min(size, max(self.min_batch, self.lag))
+        return size
+
+    def process_batch_size(self) -> int:
+        # at the tip only a few blocks are waiting, process them all at once.
+        if self.mode == BatchMode.tip:
+            return self.max_batch
+        return self.catch_up_batch_size()
+
+    def flush_batch_size(self) -> int:
+        """
+        Number of processed blocks `send_to_mongo` waits for, unless the
+        flush interval has passed.
+        """
+        if self.mode == BatchMode.tip:
+            return 1
+        return self.catch_up_batch_size()
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode.value,
+            "lag": self.lag,
+            "chain_height": self.chain_height,
+            "latency_per_block": {k: round(v, 4) for k, v in self.latency.items()},
+            "fetch_batch_size": self.fetch_batch_size(),
+            "process_batch_size": self.process_batch_size(),
+            "flush_batch_size": self.flush_batch_size(),
+        }
@@ -0,0 +1,130 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.enums import NET
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import asyncio
+
+
+class BlockFetcher:
+    """
+    Fetches finalized blocks for a range of heights with multiple
+    `get_finalized_block_at_height` calls in flight. Responses can arrive in any
+    order, blocks are handed back ordered by height and cut off at the first height
+    that isn't finalized (yet), so the caller never sees a gap.
+
+    The number of calls in flight starts at 1 and grows with every block that
+    comes back, up to `concurrency`. At the tip this means we only probe the next
+    height, during catch-up we quickly fill the pipeline.
+    """
+
+    def __init__(
+        self,
+        grpcclient: GRPCClient,
+        net: str,
+        concurrency: int,
+        executor: ThreadPoolExecutor = None,
+    ):
+        self.grpcclient = grpcclient
+        self.net = net
+        self.concurrency = max(1, concurrency)
+        # the fetch stage executor is passed in by Heartbeat.
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="fetch"
+        )
+
+        # stats
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.blocks_fetched = 0
+        self.requests_sent = 0
+        self.seconds_fetching = 0.0
+        self.last_throughput = 0.0
+
+    def get_block(self, height: int) -> CCD_BlockInfo | None:
+        try:
+            return self.grpcclient.get_finalized_block_at_height(height, NET(self.net))
+        except:
+            return None
+
+    async def fetch_range(
+        self, start_height: int, max_blocks: int
+    ) -> list[CCD_BlockInfo]:
+        """
+        Returns up to `max_blocks` consecutive finalized blocks, starting at
+        `start_height`.
+        """
+        loop = asyncio.get_running_loop()
+        start = dt.datetime.now()
+        end_height = start_height + max_blocks
+        next_height = start_height
+        window = 1
+        first_missing_height = None
+        received: dict[int, CCD_BlockInfo] = {}
+        pending: dict[asyncio.Future, int] = {}
+
+        while True:
+            while (
+                len(pending) < window
+                and next_height < end_height
+                and first_missing_height is None
+            ):
+                future = loop.run_in_executor(
+                    self.executor, self.get_block, next_height
+                )
+                pending[future] = next_height
+                next_height += 1
+                self.requests_sent += 1
+
+            self.in_flight = len(pending)
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if len(pending) == 0:
+                break
+
+            done, _ = await asyncio.wait(
+                pending.keys(), return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                height = pending.pop(future)
+                block_info = future.result()
+                if block_info:
+                    received[height] = block_info
+                    window = min(self.concurrency, window + 1)
+                elif first_missing_height is None or height < first_missing_height:
+                    first_missing_height = height
+        self.in_flight = 0
+
+        # only hand back the consecutive run from start_height.
+        blocks = []
+        height = start_height
+        while height in received:
+            blocks.append(received[height])
+            height += 1
+
+        duration = (dt.datetime.now() - start).total_seconds()
+        self.seconds_fetching += duration
+        self.blocks_fetched += len(blocks)
+        if len(blocks) > 0 and duration > 0:
+            self.last_throughput = len(blocks) / duration
+        return blocks
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "blocks_fetched": self.blocks_fetched,
+            "requests_sent": self.requests_sent,
+            "last_throughput": round(self.last_throughput, 2),
+            "avg_throughput": (
+                round(self.blocks_fetched / self.seconds_fetching, 2)
+                if self.seconds_fetching > 0
+                else 0.0
+            ),
+        }
+
+    def shutdown(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,15 +1,17 @@
 # ruff: noqa: F403, F405, E402, E501, E722
-from .utils import Queue
+from .utils import Queue, Stage
+from .batch_controller import BatchMode
 from .block_processing import BlockProcessing as _block_processing
+from .op_codec import pre_encode_queues
+from .pending_blocks import PendingBlocks
 from ccdexplorer_fundamentals.tooter import TooterChannel, TooterType
 from ccdexplorer_fundamentals.mongodb import Collections
 from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
-from pymongo import ReplaceOne
 from pymongo.collection import Collection
-from ccdexplorer_fundamentals.enums import NET
 from env import *
+from collections import deque
+from concurrent.futures import Future
 import datetime as dt
-from copy import copy
 
 import asyncio
 from rich.console import Console
@@ -18,69 +20,166 @@ console = Console()
 
 
 class BlockLoop(_block_processing):
-    def process_list_of_blocks(self, block_list: list, special_purpose: bool = False):
+    def decode_block(
+        self, block_info: CCD_BlockInfo, special_purpose: bool = False
+    ) -> dict[Queue, list]:
+        """
+        Runs on the decode stage thread pool. Decodes a block into a set of
+        queues of its own, so blocks can be decoded concurrently. Everything
+        else (db, grpcclient, existing instances and modules) is shared.
+        With RAW_BSON_WRITES, the documents are encoded to BSON here as well.
+        """
+        block_queues = {q: [] for q in Queue}
+        self.add_block_and_txs_to_queue(block_info, block_queues, special_purpose)
+        if RAW_BSON_WRITES:
+            pre_encode_queues(block_queues)
+        return block_queues
+
+    def commit_decoded_block(
+        self,
+        block_info: CCD_BlockInfo,
+        block_queues: dict[Queue, list],
+        special_purpose: bool = False,
+    ):
+        """
+        Adds the queue contributions of a decoded block to the queues. Called
+        in height order, while holding the queues lock, so a flush never sees
+        half a block, nor a block without the blocks before it.
+        The lookouts read from Mongo and gRPC, so they run outside the lock,
+        before the block is committed: the end of day they queue is never
+        behind the checkpoint.
+        """
+        self.lookout_for_payday(block_info)
+        self.lookout_for_end_of_day(block_info)
+        with self.queues_lock:
+            for q, queue in block_queues.items():
+                # updated modules are kept per batch, see `process_list_of_blocks`.
+                if (len(queue) > 0) and (q != Queue.updated_modules):
+                    self.queues[q].extend(queue)
+            for instance in block_queues[Queue.instances]:
+                self.contract_index.add_instance(instance._filter["_id"])
+            # special purpose blocks are re-processed out of order, they don't
+            # move the checkpoint.
+            if not special_purpose:
+                self.last_committed_height = block_info.height
+        self.block_prefetcher.release(block_info)
+
+    def remove_special_purpose_heights(self, heights: list[int]):
+        """
+        Removes processed heights from the helper in a single atomic update.
+        Heights may have been requested as int or as str, both are removed.
+        """
+        if len(heights) == 0:
+            return
+        values = set()
+        for height in heights:
+            values.add(height)
+            values.add(self.special_purpose_heights.get(height, height))
+        try:
+            self.db[Collections.helpers].update_one(
+                {"_id": "special_purpose_block_request"},
+                {"$pullAll": {"heights": list(values)}},
+            )
+        except Exception as e:
+            console.log(f"Could not remove special purpose heights: {e}")
+        # if the update failed, the heights are requested (and processed) again.
+        for height in heights:
+            self.special_purpose_heights.pop(height, None)
+
+    def load_existing_modules_and_instances(self):
+        """
+        Brings the modules (with their contracts) and instances we already know
+        about up to date, used to discover new instances and modules while
+        decoding. The `contract_index` is loaded once, after that this is a
+        small delta query.
+        """
+        self.db: dict[Collections, Collection]
+        # decode threads of another batch may be adding contracts to modules.
+        with self.discovery_lock:
+            self.contract_index.refresh(self.db)
+        self.existing_source_modules = self.contract_index.modules
+        self.existing_instances = self.contract_index.instances
+
+    def process_list_of_blocks(
+        self,
+        block_list: PendingBlocks,
+        special_purpose: bool = False,
+        max_blocks: int | None = None,
+    ):
+        """
+        Runs on the process stage thread pool. Up to DECODE_WORKERS blocks are
+        decoded concurrently on the decode stage, their queue contributions are
+        committed strictly in height order. The gRPC reads for the blocks
+        being decoded and the next PREFETCH_BLOCKS blocks are in flight on the
+        fetch stage. Processes at most `max_blocks` blocks, or the entire list.
+        """
         self.queues: dict[Collections, list]
         self.db: dict[Collections, Collection]
-        result = self.db[Collections.modules].find({})
-        result = list(result)
-        self.existing_source_modules: dict[CCD_ModuleRef, set] = {
-            x["_id"]: set(x["contracts"]) for x in result if x["contracts"] is not None
-        }
-        existing_source_modules_no_contracts = {
-            x["_id"]: set() for x in result if x["contracts"] is None
-        }
-        self.existing_source_modules.update(existing_source_modules_no_contracts)
-        self.queues[Queue.updated_modules] = []
-
-        result = self.db[Collections.instances].find({})
-        result = list(result)
-        self.existing_instances: dict[str, CCD_ModuleRef] = {
-            x["_id"]: True for x in result
-        }
+        self.load_existing_modules_and_instances()
+        # per batch, a main and a special purpose batch can run at the same time.
+        updated_modules = set()
 
         start = dt.datetime.now()
-        while len(block_list) > 0:
-            current_block_to_process: CCD_BlockInfo = block_list.pop(0)
-            try:
-                self.add_block_and_txs_to_queue(
-                    current_block_to_process, special_purpose
+        blocks_taken = 0
+        special_purpose_heights_done = []
+        decoding: deque[tuple[CCD_BlockInfo, Future]] = deque()
+        while (
+            len(block_list) > 0 and (max_blocks is None or blocks_taken < max_blocks)
+        ) or len(decoding) > 0:
+            while (
+                len(decoding) < max(1, DECODE_WORKERS)
+                and len(block_list) > 0
+                and (max_blocks is None or blocks_taken < max_blocks)
+            ):
+                block_info: CCD_BlockInfo = block_list.popleft()
+                blocks_taken += 1
+                self.block_prefetcher.prefetch(block_info)
+                decoding.append(
+                    (
+                        block_info,
+                        self.executors[Stage.decode].submit(
+                            self.decode_block, block_info, special_purpose
+                        ),
+                    )
                 )
 
-                self.lookout_for_payday(current_block_to_process)
-                self.lookout_for_end_of_day(current_block_to_process)
+            for block_info in block_list.peek(self.block_prefetcher.read_ahead):
+                self.block_prefetcher.prefetch(block_info)
+
+            current_block_to_process, future = decoding.popleft()
+            try:
+                block_queues = future.result()
+                # if send_to_mongo can't keep up, wait here.
+                self.wait_for_room_in_queues()
+                self.commit_decoded_block(
+                    current_block_to_process, block_queues, special_purpose
+                )
+                updated_modules.update(block_queues[Queue.updated_modules])
 
                 if special_purpose:
-                    # if it's a special purpose block, we need to remove it from the helper
-                    result: dict = self.db[Collections.helpers].find_one(
-                        {"_id": "special_purpose_block_request"}
-                    )
-                    if result:
-                        heights: list = result["heights"]
-                        try:
-                            heights.remove(current_block_to_process.height)
-                        except ValueError:
-                            console.log(
-                                f" Tried 'heights.remove(current_block_to_process.height)' for {current_block_to_process.height:,.0f} but failed."
-                            )
-                        result.update({"heights": heights})
-                    _ = self.db[Collections.helpers].bulk_write(
-                        [
-                            ReplaceOne(
-                                {"_id": "special_purpose_block_request"},
-                                replacement=result,
-                                upsert=True,
-                            )
-                        ]
-                    )
+                    special_purpose_heights_done.append(current_block_to_process.height)
             except Exception as e:
                 self.log_error_in_mongo(e, current_block_to_process)
+                self.block_prefetcher.release(current_block_to_process)
+                if special_purpose:
+                    # stays in the helper, so it's requested again.
+                    self.special_purpose_heights.pop(
+                        current_block_to_process.height, None
+                    )
+        self.remove_special_purpose_heights(special_purpose_heights_done)
         duration = dt.datetime.now() - start
+        if not special_purpose:
+            self.batch_controller.record(
+                "process", blocks_taken, duration.total_seconds()
+            )
         console.log(
             f"Spent {duration.total_seconds():,.0f} sec on {len(self.queues[Queue.transactions]):,.0f} txs."
         )
 
-        if len(self.queues[Queue.instances]) > 0:
-            self.add_back_updated_modules_to_queue(current_block_to_process)
+        # not the instances queue, send_to_mongo may already have taken it
+        # during the batch.
+        if len(updated_modules) > 0:
+            self.add_back_updated_modules_to_queue(list(updated_modules))
 
         return current_block_to_process
 
@@ -89,72 +188,232 @@ class BlockLoop(_block_processing):
         This method takes the queue `finalized_block_infos_to_process` and processes
         each block.
         """
-        self.finalized_block_infos_to_process: list[CCD_BlockInfo]
+        self.finalized_block_infos_to_process: PendingBlocks
         while True:
+            self.finalized_blocks_available.clear()
             if len(self.finalized_block_infos_to_process) > 0:
-                pp = copy(self.finalized_block_infos_to_process)
+                first_height = self.finalized_block_infos_to_process.first().height
                 # this is the last block that was processed
-                current_block_to_process = self.process_list_of_blocks(
-                    self.finalized_block_infos_to_process
+                current_block_to_process = await self.run_in_stage(
+                    Stage.process,
+                    self.process_list_of_blocks,
+                    self.finalized_block_infos_to_process,
+                    max_blocks=self.batch_controller.process_batch_size(),
                 )
 
-                self.log_last_processed_message_in_mongo(current_block_to_process)
-                if len(pp) == 1:
-                    console.log(f"Block processed: {pp[0].height:,.0f}")
+                if first_height == current_block_to_process.height:
+                    console.log(f"Block processed: {first_height:,.0f}")
                 else:
                     console.log(
-                        f"Blocks processed: {pp[0].height:,.0f} - {pp[-1].height:,.0f}"
+                        f"Blocks processed: {first_height:,.0f} - {current_block_to_process.height:,.0f}"
                     )
-            await asyncio.sleep(1)
+            if len(self.finalized_block_infos_to_process) > 0:
+                continue
+            # wake up as soon as new blocks are added, or after 1 sec.
+            try:
+                await asyncio.wait_for(self.finalized_blocks_available.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
 
     async def process_special_purpose_blocks(self):
         """
         This method takes the queue `special_purpose_block_infos_to_process` and processes
-        each block.
+        the blocks, SPECIAL_PURPOSE_BATCH_SIZE at a time. Live indexing goes
+        first: no batch is started while blocks are waiting in
+        `finalized_block_infos_to_process`, or while we are catching up, so a
+        large repair request can't stall it.
         """
-        self.special_purpose_block_infos_to_process: list[CCD_BlockInfo]
+        self.special_purpose_block_infos_to_process: PendingBlocks
         while True:
-            if len(self.special_purpose_block_infos_to_process) > 0:
-                pp = copy(self.special_purpose_block_infos_to_process)
+            live_blocks_first = (len(self.finalized_block_infos_to_process) > 0) or (
+                self.batch_controller.mode == BatchMode.catch_up
+            )
+            if (len(self.special_purpose_block_infos_to_process) > 0) and (
+                not live_blocks_first
+            ):
+                first_height = (
+                    self.special_purpose_block_infos_to_process.first().height
+                )
                 # this is the last block that was processed
-
-                _ = self.process_list_of_blocks(
-                    self.special_purpose_block_infos_to_process, special_purpose=True
+                current_block_to_process = await self.run_in_stage(
+                    Stage.process,
+                    self.process_list_of_blocks,
+                    self.special_purpose_block_infos_to_process,
+                    special_purpose=True,
+                    max_blocks=SPECIAL_PURPOSE_BATCH_SIZE,
                 )
 
-                if len(pp) == 1:
-                    console.log(f"SP Block processed: {pp[0].height:,.0f}")
+                if first_height == current_block_to_process.height:
+                    console.log(f"SP Block processed: {first_height:,.0f}")
                 else:
                     console.log(
-                        f"SP Blocks processed: {pp[0].height:,.0f} - {pp[-1].height:,.0f}"
+                        f"SP Blocks processed: {first_height:,.0f} - {current_block_to_process.height:,.0f}"
                     )
-            await asyncio.sleep(5)
+                await asyncio.sleep(1)
+            else:
+                await asyncio.sleep(5)
 
     async def get_special_purpose_blocks(self):
         """
         This methods gets special purpose blocks from the chosen net.
-        It batches blocks up to MAX_BLOCKS_PER_RUN and stores blocks to be
-        processed in the queue `finalized_block_infos_to_process`.
+        `special_purpose_heights` holds the heights that are requested and
+        not yet processed, so every height is fetched once. New heights are
+        fetched concurrently, up to SPECIAL_PURPOSE_MAX_OUTSTANDING at a time,
+        and stored in the queue `special_purpose_block_infos_to_process`.
         """
         while True:
-            result = self.db[Collections.helpers].find_one(
-                {"_id": "special_purpose_block_request"}
+            result = await self.run_in_stage(
+                Stage.io,
+                self.db[Collections.helpers].find_one,
+                {"_id": "special_purpose_block_request"},
             )
             if result:
-                for height in result["heights"]:
-                    self.special_purpose_block_infos_to_process.append(
-                        self.grpcclient.get_finalized_block_at_height(
-                            int(height), NET(self.net)
-                        )
+                requested = {int(height): height for height in result["heights"]}
+                new_heights = [
+                    height
+                    for height in sorted(requested.keys())
+                    if height not in self.special_purpose_heights
+                ][
+                    : max(
+                        0,
+                        SPECIAL_PURPOSE_MAX_OUTSTANDING
+                        - len(self.special_purpose_heights),
                     )
+                ]
+                for height in new_heights:
+                    self.special_purpose_heights[height] = requested[height]
+
+                block_infos = await asyncio.gather(
+                    *[
+                        self.run_in_stage(
+                            Stage.fetch, self.block_fetcher.get_block, height
+                        )
+                        for height in new_heights
+                    ]
+                )
+                for height, block_info in zip(new_heights, block_infos):
+                    if block_info:
+                        self.special_purpose_block_infos_to_process.add(block_info)
+                    else:
+                        self.special_purpose_heights.pop(height, None)
 
             await asyncio.sleep(10)
 
+    def load_checkpoint(self):
+        """
+        Heartbeat keeps its progress in memory, the helper document is only read
+        here, once at startup:
+        - `last_committed_height`: last block added to the queues.
+        - `last_stored_height`: last block for which `send_to_mongo` has stored
+        everything up to and including this block.
+        - `last_persisted_height`: last checkpoint written to the helper
+        `heartbeat_last_processed_block` by `persist_checkpoint`.
+        - `last_spooled_height`: last block in the spool, not yet stored.
+        """
+        result = self.db[Collections.helpers].find_one(
+            {"_id": "heartbeat_last_processed_block"}
+        )
+        self.last_committed_height = max(
+            result["height"], self.last_spooled_height or result["height"]
+        )
+        self.last_stored_height = result["height"]
+        self.last_persisted_height = result["height"]
+
+    def checkpoint_stored(self, height: int | None):
+        """
+        Called after a successful flush, with the last committed height
+        at the time the queues were taken.
+        """
+        if height is None:
+            return
+        if (self.last_stored_height is None) or (height > self.last_stored_height):
+            self.last_stored_height = height
+
+    async def persist_checkpoint(self):
+        """
+        Write-behind for the checkpoint: every CHECKPOINT_INTERVAL sec, the
+        last stored height is written to the helper document, if it has moved.
+        """
+        while True:
+            height = self.last_stored_height
+            if (height is not None) and (height != self.last_persisted_height):
+                try:
+                    await self.run_in_stage(
+                        Stage.io, self.log_last_processed_message_in_mongo, height
+                    )
+                    self.last_persisted_height = height
+                except Exception as e:
+                    console.log(f"Could not persist checkpoint {height:,.0f}: {e}")
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+
+    def persist_checkpoint_on_exit(self):
+        height = self.last_stored_height
+        if (height is not None) and (height != self.last_persisted_height):
+            try:
+                self.log_last_processed_message_in_mongo(height)
+                self.last_persisted_height = height
+            except Exception as e:
+                console.log(f"Could not persist checkpoint {height:,.0f}: {e}")
+
+    def next_height_to_request(self) -> int:
+        """
+        Returns the first height that is neither processed nor in the queue
+        `finalized_block_infos_to_process`.
+        """
+        if self.last_stored_height is None:
+            self.load_checkpoint()
+        # spooled blocks are not stored yet, but don't need to be fetched again.
+        heartbeat_last_processed_block_height = max(
+            self.last_stored_height,
+            self.last_spooled_height or self.last_stored_height,
+        )
+        if DEBUG:
+            console.log(f"{heartbeat_last_processed_block_height=}")
+
+        # blocks that are in the queue, or have been taken from the queue by
+        # the process stage but are not yet logged as processed, do not need
+        # to be requested again, so continue after the last block added.
+        last_height_added = self.finalized_block_infos_to_process.last_height_added
+        if last_height_added is None:
+            last_height_added = heartbeat_last_processed_block_height
+        return max(heartbeat_last_processed_block_height, last_height_added) + 1
+
+    def get_chain_height(self) -> int:
+        """
+        Height of the last finalized block on the node.
+        """
+        consensus_info: CCD_ConsensusInfo = self.grpcclient.get_consensus_info(
+            NET(self.net)
+        )
+        return consensus_info.last_finalized_block_height
+
+    async def fetch_blocks(self, height_to_request: int, blocks_to_request: int):
+        start = dt.datetime.now()
+        finalized_block_infos = await self.block_fetcher.fetch_range(
+            height_to_request, blocks_to_request
+        )
+        self.batch_controller.record(
+            "fetch",
+            len(finalized_block_infos),
+            (dt.datetime.now() - start).total_seconds(),
+        )
+        self.add_finalized_blocks_to_queue(finalized_block_infos)
+        return finalized_block_infos
+
+    def add_finalized_blocks_to_queue(self, finalized_block_infos: list[CCD_BlockInfo]):
+        if len(finalized_block_infos) > 0:
+            self.finalized_block_infos_to_process.extend(finalized_block_infos)
+            self.finalized_blocks_available.set()
+
     async def get_finalized_blocks(self):
         """
         This methods gets finalized blocks from the chosen net.
-        It batches blocks up to MAX_BLOCKS_PER_RUN and stores blocks to be
-        processed in the queue `finalized_block_infos_to_process`.
+        It batches blocks as sized by `batch_controller`, from the lag to the
+        last finalized block, and stores blocks to be processed in the queue
+        `finalized_block_infos_to_process`. Blocks are requested through `block_fetcher`, which keeps up to
+        FETCH_CONCURRENCY requests in flight and returns them in order.
+        When `follow_finalized_blocks` is following the tip, this method
+        only keeps an eye on progress.
         """
         if DEBUG:
             console.log("get_finalized_blocks")
@@ -172,71 +431,44 @@ class BlockLoop(_block_processing):
                 )
                 exit()
 
-            request_counter = 0
-            result = self.db[Collections.helpers].find_one(
-                {"_id": "heartbeat_last_processed_block"}
-            )
-            heartbeat_last_processed_block_height = result["height"]
-            if DEBUG:
-                console.log(f"{heartbeat_last_processed_block_height=}")
-            last_requested_block_not_finalized = False
-            block_to_request_in_queue = False
-
-            while (
-                not (last_requested_block_not_finalized)
-                and (request_counter < MAX_BLOCKS_PER_RUN)
-                and not block_to_request_in_queue
-            ):
-                request_counter += 1
-
-                # increment the block height to request
-                heartbeat_last_processed_block_height += 1
-
-                # check to see if we haven't finished processing the queue
-                # If so, no need to request and add the same block again.
-                block_to_request_in_queue = heartbeat_last_processed_block_height in [
-                    x.height for x in self.finalized_block_infos_to_process
-                ]
-                if DEBUG:
-                    console.log(f"{self.finalized_block_infos_to_process=}")
-                # we haven't previously requested this block
-                if not block_to_request_in_queue:
+            # in tip mode, new blocks arrive through the finalized blocks stream,
+            # polling is only needed to catch up.
+            if not self.following_tip:
+                async with self.fetch_lock:
                     try:
-                        finalized_block_info_at_height = (
-                            self.grpcclient.get_finalized_block_at_height(
-                                heartbeat_last_processed_block_height, NET(self.net)
-                            )
+                        self.batch_controller.update_chain_height(
+                            await self.run_in_stage(Stage.io, self.get_chain_height)
                         )
-                    except:
-                        finalized_block_info_at_height = False
+                    except Exception as e:
+                        console.log(f"Could not get consensus info: {e}")
+                    height_to_request = await self.run_in_stage(
+                        Stage.io, self.next_height_to_request
+                    )
+                    self.batch_controller.update_lag(height_to_request)
+                    blocks_to_request = min(
+                        self.batch_controller.fetch_batch_size()
+                        - len(self.finalized_block_infos_to_process),
+                        self.pending_blocks_room(),
+                    )
 
-                    if finalized_block_info_at_height:
-                        self.finalized_block_infos_to_process.append(
-                            finalized_block_info_at_height
+                    if blocks_to_request > 0:
+                        finalized_block_infos = await self.fetch_blocks(
+                            height_to_request, blocks_to_request
                         )
-                    else:
-                        last_requested_block_not_finalized = True
+                        if len(finalized_block_infos) > 1:
+                            stats = self.block_fetcher.stats()
+                            console.log(
+                                f"Fetcher: {len(finalized_block_infos):,.0f} blocks at {stats['last_throughput']:,.1f} blocks/s, {stats['peak_in_flight']} peak in flight."
+                            )
             if DEBUG:
                 console.log(f"{len(self.finalized_block_infos_to_process)=}")
             if len(self.finalized_block_infos_to_process) > 0:
                 if len(self.finalized_block_infos_to_process) == 1:
                     console.log(
-                        f"Block retrieved: {self.finalized_block_infos_to_process[0].height:,.0f}"
+                        f"Block retrieved: {self.finalized_block_infos_to_process.first().height:,.0f}"
                     )
                 else:
                     console.log(
-                        f"Blocks retrieved: {self.finalized_block_infos_to_process[0].height:,.0f} - {self.finalized_block_infos_to_process[-1].height:,.0f}"
+                        f"Blocks retrieved: {self.finalized_block_infos_to_process.first().height:,.0f} - {self.finalized_block_infos_to_process.last().height:,.0f}"
                     )
-                    if (
-                        self.finalized_block_infos_to_process[0].height
-                        > self.finalized_block_infos_to_process[-1].height
-                    ):
-                        self.tooter.relay(
-                            channel=TooterChannel.NOTIFIER,
-                            title="",
-                            chat_id=ADMIN_CHAT_ID,
-                            body=f"Heartbeat on {self.net} seems to be in a loop? Exiting to restart.",
-                            notifier_type=TooterType.REQUESTS_ERROR,
-                        )
-                        exit()
             await asyncio.sleep(1)
@@ -0,0 +1,161 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.enums import NET
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime as dt
+import threading
+
+END_OF_DAY_TIMEFRAME_START = dt.time(0, 0, 0)
+END_OF_DAY_TIMEFRAME_END = dt.time(0, 2, 0)
+PAYDAY_TIMEFRAME_START = dt.time(8, 55, 0)
+PAYDAY_TIMEFRAME_END = dt.time(9, 10, 0)
+
+
+def in_end_of_day_timeframe(block_info: CCD_BlockInfo) -> bool:
+    return (
+        END_OF_DAY_TIMEFRAME_START
+        <= block_info.slot_time.time()
+        <= END_OF_DAY_TIMEFRAME_END
+    )
+
+
+def in_payday_timeframe(block_info: CCD_BlockInfo) -> bool:
+    return PAYDAY_TIMEFRAME_START < block_info.slot_time.time() < PAYDAY_TIMEFRAME_END
+
+
+class PrefetchedBlock:
+    """
+    The gRPC reads for one block: transaction events (if the block has
+    transactions), special events and, around midnight, the previous block.
+    All are issued at once, each is only waited for when it's needed.
+    """
+
+    def __init__(
+        self,
+        prefetcher: "BlockPrefetcher",
+        block_info: CCD_BlockInfo,
+        transaction_events: Future | None,
+        special_events: Future,
+        previous_block_info: Future | None,
+    ):
+        self.prefetcher = prefetcher
+        self.block_info = block_info
+        self.transaction_events_future = transaction_events
+        self.special_events_future = special_events
+        self.previous_block_info_future = previous_block_info
+
+    def transaction_events(self) -> CCD_Block | None:
+        if self.transaction_events_future is None:
+            return None
+        return self.prefetcher.result(self.transaction_events_future)
+
+    def special_events(self) -> list[CCD_BlockSpecialEvent]:
+        return self.prefetcher.result(self.special_events_future)
+
+    def previous_block_info(self) -> CCD_BlockInfo:
+        if self.previous_block_info_future is None:
+            self.previous_block_info_future = self.prefetcher.submit(
+                self.prefetcher.grpcclient.get_finalized_block_at_height,
+                self.block_info.height - 1,
+            )
+        return self.prefetcher.result(self.previous_block_info_future)
+
+
+class BlockPrefetcher:
+    """
+    Issues the per-block gRPC reads on the fetch stage, ahead of decoding.
+    The decode step and the payday and end of day lookouts share the
+    results through a `PrefetchedBlock`, keyed on block hash, so every read
+    is done once. A block is released when it's committed.
+    """
+
+    def __init__(
+        self,
+        grpcclient: GRPCClient,
+        net: str,
+        read_ahead: int,
+        executor: ThreadPoolExecutor,
+    ):
+        self.grpcclient = grpcclient
+        self.net = net
+        self.read_ahead = max(0, read_ahead)
+        self.executor = executor
+        self.blocks: dict[str, PrefetchedBlock] = {}
+        self.lock = threading.Lock()
+
+        # stats
+        self.blocks_prefetched = 0
+        self.reads_sent = 0
+        self.reads_ready = 0
+        self.reads_waited = 0
+        self.seconds_waited = 0.0
+
+    def submit(self, func, *args) -> Future:
+        self.reads_sent += 1
+        return self.executor.submit(func, *args, NET(self.net))
+
+    def result(self, future: Future):
+        if future.done():
+            self.reads_ready += 1
+            return future.result()
+        start = dt.datetime.now()
+        try:
+            return future.result()
+        finally:
+            self.reads_waited += 1
+            self.seconds_waited += (dt.datetime.now() - start).total_seconds()
+
+    def prefetch(self, block_info: CCD_BlockInfo) -> PrefetchedBlock:
+        with self.lock:
+            prefetched = self.blocks.get(block_info.hash)
+            if prefetched is not None:
+                return prefetched
+
+            prefetched = PrefetchedBlock(
+                self,
+                block_info,
+                (
+                    self.submit(
+                        self.grpcclient.get_block_transaction_events, block_info.hash
+                    )
+                    if block_info.transaction_count > 0
+                    else None
+                ),
+                self.submit(self.grpcclient.get_block_special_events, block_info.hash),
+                (
+                    self.submit(
+                        self.grpcclient.get_finalized_block_at_height,
+                        block_info.height - 1,
+                    )
+                    if in_end_of_day_timeframe(block_info)
+                    else None
+                ),
+            )
+            self.blocks[block_info.hash] = prefetched
+            self.blocks_prefetched += 1
+            return prefetched
+
+    def get(self, block_info: CCD_BlockInfo) -> PrefetchedBlock:
+        """
+        Returns the prefetched block, issuing the reads now if it wasn't
+        prefetched.
+        """
+        return self.prefetch(block_info)
+
+    def release(self, block_info: CCD_BlockInfo):
+        with self.lock:
+            self.blocks.pop(block_info.hash, None)
+
+    def stats(self) -> dict:
+        reads = self.reads_ready + self.reads_waited
+        return {
+            "read_ahead": self.read_ahead,
+            "blocks_held": len(self.blocks),
+            "blocks_prefetched": self.blocks_prefetched,
+            "reads_sent": self.reads_sent,
+            "reads_ready": self.reads_ready,
+            "reads_waited": self.reads_waited,
+            "ready_rate": round(self.reads_ready / reads, 4) if reads > 0 else None,
+            "seconds_waited": round(self.seconds_waited, 3),
+        }
@@ -2,6 +2,8 @@
 from .utils import Queue
 from .module_logic import ModuleLogic as _module_logic
 from .impacted_addresses import ImpactedAddresses as _impacted_addresses
+from .block_prefetcher import in_end_of_day_timeframe, in_payday_timeframe
+from .documents import block_document, transaction_document
 from rich.progress import track
 from ccdexplorer_fundamentals.GRPCClient import GRPCClient
 from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
@@ -12,7 +14,6 @@ from pymongo import ReplaceOne
 from pymongo.collection import Collection
 from env import *
 import asyncio
-import json
 from rich.console import Console
 
 console = Console()
@@ -50,16 +51,11 @@ class AccountTransactionOutcome(Enum):
 class BlockProcessing(_module_logic, _impacted_addresses):
 
     def lookout_for_end_of_day(self, current_block_to_process: CCD_BlockInfo):
-        end_of_day_timeframe_start = dt.time(0, 0, 0)
-        end_of_day_timeframe_end = dt.time(0, 2, 0)
-
-        if (
-            current_block_to_process.slot_time.time() >= end_of_day_timeframe_start
-        ) and (current_block_to_process.slot_time.time() <= end_of_day_timeframe_end):
-            previous_block_height = current_block_to_process.height - 1
-            previous_block_info = self.grpcclient.get_finalized_block_at_height(
-                previous_block_height, NET(self.net)
-            )
+        if in_end_of_day_timeframe(current_block_to_process):
+            # prefetched together with the block itself.
+            previous_block_info = self.block_prefetcher.get(
+                current_block_to_process
+            ).previous_block_info()
 
             if (
                 current_block_to_process.slot_time.day
@@ -103,22 +99,17 @@ class BlockProcessing(_module_logic, _impacted_addresses):
                 )
 
     def lookout_for_payday(self, current_block_to_process: CCD_BlockInfo):
-        payday_timeframe_start = dt.time(8, 55, 0)
-        payday_timeframe_end = dt.time(9, 10, 0)
-
-        if (current_block_to_process.slot_time.time() > payday_timeframe_start) and (
-            current_block_to_process.slot_time.time() < payday_timeframe_end
-        ):
-            special_events = self.grpcclient.get_block_special_events(
-                current_block_to_process.hash, NET(self.net)
-            )
+        if in_payday_timeframe(current_block_to_process):
+            # the same special events that are stored for this block.
+            special_events = self.block_prefetcher.get(
+                current_block_to_process
+            ).special_events()
             found = False
             for se in special_events:
                 if se.payday_account_reward or se.payday_pool_reward:
                     found = True
-                    # this is a special case/place to already log the last_processed message
-                    # as this is holding up the bot v2 in processing the payday block.
-                    self.log_last_processed_message_in_mongo(current_block_to_process)
+                    # the last_processed message for this block is logged as soon as
+                    # send_to_mongo has stored it, which at the tip is right away.
                     # protection for slow payday calculation
                     # first get the current date that we have stored
                     # as last known payday.
@@ -302,13 +293,13 @@ class BlockProcessing(_module_logic, _impacted_addresses):
         self,
         transactions: list[CCD_BlockItemSummary],
         block_info: CCD_BlockInfo,
+        queues: dict[Queue, list],
         special_purpose: bool = False,
     ):
         """
         Given a list of transactions, apply rules to determine which index needs to be updated.
         Add this to a to_be_sent_to_mongo list and do insert_many.
         """
-        self.queues: dict[Collections, list]
         self.db: dict[Collections, Collection]
         self.existing_source_modules: dict[CCD_ModuleRef, set]
         self.existing_instances: dict[str, CCD_ModuleRef]
@@ -318,29 +309,25 @@ class BlockProcessing(_module_logic, _impacted_addresses):
         # classify = 0
         # index_transfer = 0
         # smart_c = 0
-        cis_2_contracts = {}
         for tx in transactions:
             # s = dt.datetime.now()
             (
                 logged_events,
                 token_addresses_to_redo_accounting,
                 provenance_contracts_to_add,
-                cis_2_contracts,
-            ) = self.decode_cis_logged_events(
-                tx, block_info, cis_2_contracts, special_purpose
-            )
+            ) = self.decode_cis_logged_events(tx, block_info, special_purpose)
             # decode += (dt.datetime.now() - s).total_seconds()
 
             if len(logged_events) > 0:
-                self.queues[Queue.logged_events].extend(logged_events)
+                queues[Queue.logged_events].extend(logged_events)
 
             if len(token_addresses_to_redo_accounting) > 0:
-                self.queues[Queue.token_addresses_to_redo_accounting].extend(
+                queues[Queue.token_addresses_to_redo_accounting].extend(
                     token_addresses_to_redo_accounting
                 )
 
             if len(provenance_contracts_to_add) > 0:
-                self.queues[Queue.provenance_contracts_to_add].extend(
+                queues[Queue.provenance_contracts_to_add].extend(
                     provenance_contracts_to_add
                 )
 
@@ -350,7 +337,7 @@ class BlockProcessing(_module_logic, _impacted_addresses):
                 slot_time=block_info.slot_time,
             )
             # s = dt.datetime.now()
-            self.extract_impacted_addesses_from_tx(tx)
+            self.extract_impacted_addesses_from_tx(tx, queues)
             # extract += (dt.datetime.now() - s).total_seconds()
 
             # s = dt.datetime.now()
@@ -361,7 +348,7 @@ class BlockProcessing(_module_logic, _impacted_addresses):
             dct_transfer_and_all = self.index_transfer_and_all(tx, result, block_info)
             # index_transfer += (dt.datetime.now() - s).total_seconds()
             # always store tx in this collection
-            self.queues[Queue.involved_all].append(
+            queues[Queue.involved_all].append(
                 ReplaceOne(
                     {"_id": dct_transfer_and_all["_id"]},
                     dct_transfer_and_all,
@@ -370,11 +357,13 @@ class BlockProcessing(_module_logic, _impacted_addresses):
             )
 
             if result.module_involved:
-                self.get_module_data_and_add_to_queue(result.actual_module_involved)
+                self.get_module_data_and_add_to_queue(
+                    result.actual_module_involved, queues
+                )
 
             # only store tx in this collection if it's a transfer
             if result.accounts_involved_transfer:
-                self.queues[Queue.involved_transfer].append(
+                queues[Queue.involved_transfer].append(
                     ReplaceOne(
                         {"_id": dct_transfer_and_all["_id"]},
                         dct_transfer_and_all,
@@ -391,7 +380,9 @@ class BlockProcessing(_module_logic, _impacted_addresses):
                     )
 
                     try:
-                        if index_contract["contract"] not in self.existing_instances:
+                        if not self.contract_index.has_instance(
+                            index_contract["contract"]
+                        ):
                             instance_info = self.grpcclient.get_instance_info(
                                 index_contract["index"],
                                 index_contract["subindex"],
@@ -410,7 +401,10 @@ class BlockProcessing(_module_logic, _impacted_addresses):
                                 del instance_info["v1"]
                                 _source_module = instance_info["v0"]["source_module"]
 
-                            self.queues[Queue.instances].append(
+                            self.instance_name_cache.set_from_instance(
+                                index_contract["contract"], instance_info
+                            )
+                            queues[Queue.instances].append(
                                 ReplaceOne(
                                     {"_id": index_contract["contract"]},
                                     instance_info,
@@ -418,20 +412,21 @@ class BlockProcessing(_module_logic, _impacted_addresses):
                                 )
                             )
 
-                            if (
-                                _source_module
-                                not in self.existing_source_modules.keys()
-                            ):
-                                self.existing_source_modules[_source_module] = set()
+                            with self.discovery_lock:
+                                if (
+                                    _source_module
+                                    not in self.existing_source_modules.keys()
+                                ):
+                                    self.existing_source_modules[_source_module] = set()
 
-                            self.existing_source_modules[_source_module].add(
-                                index_contract["contract"]
-                            )
-                            self.queues[Queue.updated_modules].append(_source_module)
+                                self.existing_source_modules[_source_module].add(
+                                    index_contract["contract"]
+                                )
+                            queues[Queue.updated_modules].append(_source_module)
 
                             index_contract.update({"source_module": _source_module})
 
-                            self.queues[Queue.involved_contract].append(
+                            queues[Queue.involved_contract].append(
                                 ReplaceOne(
                                     {"_id": index_contract["_id"]},
                                     index_contract,
@@ -452,45 +447,27 @@ class BlockProcessing(_module_logic, _impacted_addresses):
         # console.log(f"{smart_c=:,.4} s")
 
     def add_block_and_txs_to_queue(
-        self, block_info: CCD_BlockInfo, special_purpose: bool = False
+        self,
+        block_info: CCD_BlockInfo,
+        queues: dict[Queue, list],
+        special_purpose: bool = False,
     ):
-        try:
-            json_block_info: dict = json.loads(
-                block_info.model_dump_json(exclude_none=True)
-            )
-        except Exception as e:
-            print(e)
-        json_block_info.update({"_id": block_info.hash})
-        json_block_info.update({"slot_time": block_info.slot_time})
-        del json_block_info["arrive_time"]
-        del json_block_info["receive_time"]
-        json_block_info.update({"transaction_hashes": []})
+        json_block_info = block_document(block_info)
+        # all gRPC reads for this block are issued at once, usually ahead of time.
+        prefetched = self.block_prefetcher.get(block_info)
 
         if block_info.transaction_count > 0:
             # console.log(block_info.height)
             # s = dt.datetime.now()
-            block: CCD_Block = self.grpcclient.get_block_transaction_events(
-                block_info.hash, NET(self.net)
-            )
+            block: CCD_Block = prefetched.transaction_events()
 
             json_block_info.update(
                 {"transaction_hashes": [x.hash for x in block.transaction_summaries]}
             )
 
             for tx in block.transaction_summaries:
-                json_tx: dict = json.loads(tx.model_dump_json(exclude_none=True))
-
-                json_tx.update({"_id": tx.hash})
-                json_tx.update(
-                    {
-                        "block_info": {
-                            "height": block_info.height,
-                            "hash": block_info.hash,
-                            "slot_time": block_info.slot_time,
-                        }
-                    }
-                )
-                self.queues[Queue.transactions].append(
+                json_tx = transaction_document(tx, block_info)
+                queues[Queue.transactions].append(
                     ReplaceOne({"_id": tx.hash}, replacement=json_tx, upsert=True)
                 )
                 # self.lookout_for_account_transaction(block_info, tx)
@@ -499,24 +476,24 @@ class BlockProcessing(_module_logic, _impacted_addresses):
             # )
             # s = dt.datetime.now()
             self.generate_indices_based_on_transactions(
-                block.transaction_summaries, block_info, special_purpose
+                block.transaction_summaries, block_info, queues, special_purpose
             )
             # console.log(
             #     f"generate_indices_based_on_transactions: {(dt.datetime.now()-s).total_seconds():,.4} s for {block_info.transaction_count} txs."
             # )
-        self.queues[Queue.blocks].append(
+        queues[Queue.blocks].append(
             ReplaceOne(
                 {"_id": block_info.hash}, replacement=json_block_info, upsert=True
             )
         )
-        self.queues[Queue.block_heights].append(block_info.height)
+        queues[Queue.block_heights].append(block_info.height)
 
         # add special events
-        se = self.grpcclient.get_block_special_events(block_info.height)
+        se = prefetched.special_events()
         se_list = [x.model_dump(exclude_none=True) for x in se]
 
         d = {"_id": block_info.height, "special_events": se_list}
-        self.queues[Queue.special_events].append(
+        queues[Queue.special_events].append(
             ReplaceOne(
                 {"_id": block_info.height},
                 replacement=d,
@@ -0,0 +1,109 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from pymongo import ReplaceOne, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+# weight of a new measurement in the running chunk latency.
+LATENCY_WEIGHT = 0.2
+
+
+def op_id(op):
+    """
+    The `_id` an operation writes, or None if its filter is more than an `_id`.
+    """
+    if isinstance(op, (ReplaceOne, DeleteOne, UpdateOne)):
+        if len(op._filter) == 1 and "_id" in op._filter:
+            return op._filter["_id"]
+    return None
+
+
+def dedupe_ops(ops: list) -> list:
+    """
+    Unordered writes can be applied in any order, so per `_id` only the last
+    `ReplaceOne` or `DeleteOne` is kept, in its position: what it stores
+    doesn't depend on the operations before it. `UpdateOne` operations are
+    all kept, they add to what is stored (e.g. `$setUnion` in
+    `module_update`), unless a later replace or delete overwrites them.
+    """
+    last_index = {}
+    for index, op in enumerate(ops):
+        if isinstance(op, (ReplaceOne, DeleteOne)):
+            _id = op_id(op)
+            if _id is not None:
+                last_index[_id] = index
+    return [
+        op
+        for index, op in enumerate(ops)
+        if (_id := op_id(op)) is None
+        or _id not in last_index
+        or index >= last_index[_id]
+    ]
+
+
+def chunk_ops(ops: list, max_ops: int, op_bytes: float, max_bytes: int) -> list[list]:
+    """
+    Splits operations in chunks of at most `max_ops` operations and, based on
+    the average size of an operation, about `max_bytes` bytes.
+    """
+    size = max(1, min(max_ops, int(max_bytes / max(1.0, op_bytes))))
+    return [ops[i : i + size] for i in range(0, len(ops), size)]
+
+
+def failed_ops(chunk: list, error: BulkWriteError) -> list:
+    """
+    The operations of an unordered bulk write that were not written.
+    """
+    indices = sorted({x["index"] for x in error.details.get("writeErrors", [])})
+    return [chunk[i] for i in indices]
+
+
+class ChunkWriteError(Exception):
+    """
+    Raised when a chunk could not be written, `ops` are the operations that
+    were not written.
+    """
+
+    def __init__(self, ops: list, error: Exception):
+        super().__init__(f"{len(ops):,.0f} operations not written: {error}")
+        self.ops = ops
+
+
+class FlushStats:
+    """
+    Counters for the chunks `send_to_mongo` writes, per collection.
+    """
+
+    def __init__(self):
+        self.chunks: dict[str, int] = {}
+        self.ops: dict[str, int] = {}
+        self.retries: dict[str, int] = {}
+        self.failed_ops: dict[str, int] = {}
+        self.latency: dict[str, float] = {}
+        self.latency_max: dict[str, float] = {}
+
+    def record_chunk(self, collection: str, ops: int, seconds: float):
+        self.chunks[collection] = self.chunks.get(collection, 0) + 1
+        self.ops[collection] = self.ops.get(collection, 0) + ops
+        previous = self.latency.get(collection, seconds)
+        self.latency[collection] = (
+            1 - LATENCY_WEIGHT
+        ) * previous + LATENCY_WEIGHT * seconds
+        self.latency_max[collection] = max(
+            self.latency_max.get(collection, 0.0), seconds
+        )
+
+    def record_retry(self, collection: str, ops: int):
+        self.retries[collection] = self.retries.get(collection, 0) + 1
+        self.failed_ops[collection] = self.failed_ops.get(collection, 0) + ops
+
+    def stats(self) -> dict:
+        return {
+            collection: {
+                "chunks": self.chunks.get(collection, 0),
+                "ops": self.ops.get(collection, 0),
+                "retries": self.retries.get(collection, 0),
+                "failed_ops": self.failed_ops.get(collection, 0),
+                "chunk_latency": round(self.latency.get(collection, 0.0), 4),
+                "chunk_latency_max": round(self.latency_max.get(collection, 0.0), 4),
+            }
+            for collection in sorted(set(self.chunks) | set(self.retries))
+        }
@@ -0,0 +1,89 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from typing import Callable
+import threading
+import time
+
+
+class CisSupportCache:
+    """
+    Process-wide cache of whether a contract supports CIS-1/CIS-2, keyed on
+    the full contract address ('<index,subindex>'). Positive results are kept
+    for `ttl` sec, negative results for `negative_ttl` sec. An entry is
+    invalidated when an upgrade of the contract is seen.
+    Timestamps are wall clock, so entries can be saved in the snapshot.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # address -> (supported, checked at)
+        self.entries: dict[str, tuple[bool, float]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def get(self, address: str) -> bool | None:
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is None:
+                self.misses += 1
+                return None
+            supported, checked_at = entry
+            ttl = self.ttl if supported else self.negative_ttl
+            if time.time() - checked_at > ttl:
+                del self.entries[address]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return supported
+
+    def set(self, address: str, supported: bool):
+        with self.lock:
+            self.entries[address] = (supported, time.time())
+
+    def supports(self, address: str, check: Callable[[], bool]) -> bool:
+        """
+        Returns the cached result for `address`, or calls `check` (the gRPC
+        invoke of `supports`) and caches its result.
+        """
+        supported = self.get(address)
+        if supported is None:
+            supported = bool(check())
+            self.set(address, supported)
+        return supported
+
+    def invalidate(self, address: str):
+        with self.lock:
+            if self.entries.pop(address, None) is not None:
+                self.invalidations += 1
+
+    def to_snapshot(self) -> dict:
+        with self.lock:
+            return {
+                address: [supported, checked_at]
+                for address, (supported, checked_at) in self.entries.items()
+            }
+
+    def from_snapshot(self, snapshot: dict):
+        with self.lock:
+            self.entries = {
+                address: (supported, checked_at)
+                for address, (supported, checked_at) in snapshot.items()
+            }
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "supported": len([x for x in list(self.entries.values()) if x[0]]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None,
+            "expired": self.expired,
+            "invalidations": self.invalidations,
+            # every miss is a `supports` invoke, every hit is one saved.
+            "invokes_saved": self.hits,
+        }
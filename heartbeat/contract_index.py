@@ -0,0 +1,209 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .instance_name_cache import InstanceNameCache
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo.collection import Collection
+import sys
+from rich.console import Console
+
+console = Console()
+
+# number of contract indices past the highest known one we look for per query.
+INSTANCES_DELTA_WINDOW = 100
+# the init name seeds the `InstanceNameCache`.
+INSTANCES_PROJECTION = {
+    "_id": 1,
+    "v0.source_module": 1,
+    "v1.source_module": 1,
+    "v1.name": 1,
+}
+
+
+def contract_index_from_address(address: str) -> int:
+    """
+    '<1234,0>' -> 1234
+    """
+    try:
+        return int(address[1:-1].split(",")[0])
+    except:
+        return -1
+
+
+def source_module_from_instance(instance: dict) -> CCD_ModuleRef | None:
+    """
+    The source module of a stored instance, which has either `v0` or `v1`.
+    """
+    for version in ["v0", "v1"]:
+        if instance.get(version, {}).get("source_module"):
+            return instance[version]["source_module"]
+    return None
+
+
+class ContractIndex:
+    """
+    Long-lived index of the modules (with their contracts) and instances that
+    are stored. Loaded once (from Mongo or a snapshot), after that it is kept
+    up to date from:
+    - discoveries while decoding blocks (see `add_instance` and
+    `existing_source_modules` in `generate_indices_based_on_transactions`),
+    - a small delta query in `refresh`, for documents written by others.
+    The contracts of a module are the contracts stored in the module document,
+    together with all instances we know of that have it as source module.
+    Instances read from Mongo also go to `instance_name_cache`, if set.
+    """
+
+    def __init__(self, instance_name_cache: InstanceNameCache | None = None):
+        self.instance_name_cache = instance_name_cache
+        self.loaded = False
+        self.modules: dict[CCD_ModuleRef, set] = {}
+        self.instances: dict[str, bool] = {}
+        self.max_contract_index = -1
+        # set after loading a snapshot, the next refresh checks it against Mongo.
+        self.verify = False
+        self.hits = 0
+        self.misses = 0
+        self.full_loads = 0
+        self.delta_refreshes = 0
+
+    def load(self, db: dict[Collections, Collection]):
+        self.load_modules(db)
+        self.load_instances(db)
+        self.loaded = True
+        self.full_loads += 1
+
+    def load_modules(self, db: dict[Collections, Collection]):
+        result = list(db[Collections.modules].find({}, {"contracts": 1}))
+        self.modules = {
+            x["_id"]: set(x["contracts"]) if x.get("contracts") is not None else set()
+            for x in result
+        }
+
+    def load_instances(self, db: dict[Collections, Collection]):
+        self.instances = {}
+        self.max_contract_index = -1
+        for x in db[Collections.instances].find({}, INSTANCES_PROJECTION):
+            self.add_stored_instance(x)
+
+    def refresh(self, db: dict[Collections, Collection]):
+        """
+        Loads the index on first use. After that, only looks for instances
+        with a contract index past the highest one we know (adding them to
+        the contracts of their module), and for modules we don't know yet.
+        """
+        if not self.loaded:
+            self.load(db)
+            return
+        verify = self.verify
+        self.verify = False
+        if verify:
+            # the contracts of a module in a snapshot may be behind Mongo, or
+            # ahead of it (discovered, never stored), with the same number of
+            # modules. The modules are few, reload them.
+            console.log("Contract index: reloading modules after the snapshot.")
+            self.load_modules(db)
+
+        while True:
+            candidates = [
+                f"<{index},0>"
+                for index in range(
+                    self.max_contract_index + 1,
+                    self.max_contract_index + 1 + INSTANCES_DELTA_WINDOW,
+                )
+            ]
+            found = list(
+                db[Collections.instances].find(
+                    {"_id": {"$in": candidates}}, INSTANCES_PROJECTION
+                )
+            )
+            for x in found:
+                self.add_stored_instance(x)
+            if len(found) < INSTANCES_DELTA_WINDOW:
+                break
+
+        # instances we can't find by index, or (from a snapshot) instances
+        # that never made it to Mongo, reload.
+        instances_count = db[Collections.instances].estimated_document_count()
+        if (instances_count > len(self.instances)) or (
+            verify and instances_count != len(self.instances)
+        ):
+            console.log("Contract index: instances out of sync, reloading.")
+            self.load_instances(db)
+            self.full_loads += 1
+
+        modules_count = db[Collections.modules].estimated_document_count()
+        if modules_count > len(self.modules):
+            for x in db[Collections.modules].find(
+                {"_id": {"$nin": list(self.modules.keys())}}, {"contracts": 1}
+            ):
+                self.modules.setdefault(x["_id"], set()).update(
+                    x["contracts"] if x.get("contracts") is not None else []
+                )
+        self.delta_refreshes += 1
+
+    def has_instance(self, address: str) -> bool:
+        if address in self.instances:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add_instance(self, address: str, source_module: CCD_ModuleRef | None = None):
+        self.instances[address] = True
+        if source_module is not None:
+            self.modules.setdefault(source_module, set()).add(address)
+        self.max_contract_index = max(
+            self.max_contract_index, contract_index_from_address(address)
+        )
+
+    def add_stored_instance(self, instance: dict):
+        """
+        `instance` is (a projection of) an instance document.
+        """
+        self.add_instance(instance["_id"], source_module_from_instance(instance))
+        if self.instance_name_cache is not None:
+            self.instance_name_cache.set_from_instance(instance["_id"], instance)
+
+    def to_snapshot(self) -> dict:
+        return {
+            "modules": {
+                module_ref: list(contracts)
+                for module_ref, contracts in list(self.modules.items())
+            },
+            "instances": list(self.instances.keys()),
+            "max_contract_index": self.max_contract_index,
+        }
+
+    def from_snapshot(self, snapshot: dict):
+        self.modules = {
+            module_ref: set(contracts)
+            for module_ref, contracts in snapshot["modules"].items()
+        }
+        self.instances = {x: True for x in snapshot["instances"]}
+        self.max_contract_index = snapshot["max_contract_index"]
+        self.loaded = True
+        self.verify = True
+
+    def memory_bytes(self) -> int:
+        """
+        Rough estimate of the memory held by the index.
+        """
+        size = sys.getsizeof(self.modules) + sys.getsizeof(self.instances)
+        for module_ref, contracts in list(self.modules.items()):
+            size += sys.getsizeof(module_ref) + sys.getsizeof(contracts)
+            size += sum([sys.getsizeof(x) for x in contracts])
+        size += sum([sys.getsizeof(x) for x in list(self.instances.keys())])
+        return size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "modules": len(self.modules),
+            "instances": len(self.instances),
+            "max_contract_index": self.max_contract_index,
+            "memory_mb": round(self.memory_bytes() / 1_000_000, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None,
+            "full_loads": self.full_loads,
+            "delta_refreshes": self.delta_refreshes,
+        }
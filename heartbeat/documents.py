@@ -0,0 +1,37 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+
+# block info fields that are not stored.
+BLOCK_FIELDS_NOT_STORED = {"arrive_time", "receive_time"}
+
+
+def block_document(
+    block_info: CCD_BlockInfo, transaction_hashes: list[str] | None = None
+) -> dict:
+    """
+    The document stored in the blocks collection. Serialized in a single
+    pass with `model_dump(mode="json")`, which gives the same result as the
+    `json.loads(model_dump_json())` round trip, without building and
+    parsing a JSON string. `slot_time` is kept as datetime.
+    """
+    doc: dict = block_info.model_dump(
+        mode="json", exclude_none=True, exclude=BLOCK_FIELDS_NOT_STORED
+    )
+    doc["_id"] = block_info.hash
+    doc["slot_time"] = block_info.slot_time
+    doc["transaction_hashes"] = transaction_hashes or []
+    return doc
+
+
+def transaction_document(tx: CCD_BlockItemSummary, block_info: CCD_BlockInfo) -> dict:
+    """
+    The document stored in the transactions collection, see `block_document`.
+    """
+    doc: dict = tx.model_dump(mode="json", exclude_none=True)
+    doc["_id"] = tx.hash
+    doc["block_info"] = {
+        "height": block_info.height,
+        "hash": block_info.hash,
+        "slot_time": block_info.slot_time,
+    }
+    return doc
@@ -0,0 +1,153 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .utils import Utils, Stage
+from ccdexplorer_fundamentals.mongodb import Collections
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pymongo.collection import Collection
+from env import *
+import datetime as dt
+import asyncio
+from rich.console import Console
+
+console = Console()
+
+
+class StageStats:
+    """
+    Counters for the work that runs on a stage's thread pool.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.seconds_busy = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "seconds_busy": round(self.seconds_busy, 3),
+        }
+
+
+class Execution(Utils):
+    def create_stage_executors(self):
+        """
+        Blocking gRPC and pymongo calls and CPU-bound decoding run on a thread pool
+        per stage, so the event loop stays free and stages really overlap.
+        """
+        workers = {
+            Stage.fetch: FETCH_CONCURRENCY,
+            Stage.process: PROCESS_WORKERS,
+            Stage.decode: DECODE_WORKERS,
+            Stage.flush: FLUSH_WORKERS,
+            Stage.accounting: ACCOUNTING_WORKERS,
+            Stage.partitions: TOKEN_ACCOUNTING_PARTITIONS,
+            Stage.io: IO_WORKERS,
+        }
+        self.executors: dict[Stage, ThreadPoolExecutor] = {}
+        self.stage_stats: dict[Stage, StageStats] = {}
+        for stage in Stage:
+            self.executors[stage] = ThreadPoolExecutor(
+                max_workers=max(1, workers[stage]), thread_name_prefix=stage.value
+            )
+            self.stage_stats[stage] = StageStats(max(1, workers[stage]))
+
+        self.event_loop_lag = 0.0
+        self.event_loop_lag_max = 0.0
+
+    async def run_in_stage(self, stage: Stage, func, *args, **kwargs):
+        """
+        Runs `func` on the thread pool for `stage` and returns its result.
+        """
+        stats = self.stage_stats[stage]
+        stats.in_flight += 1
+        start = dt.datetime.now()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executors[stage], partial(func, *args, **kwargs)
+            )
+            stats.completed += 1
+            return result
+        except:
+            stats.failed += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+            stats.seconds_busy += (dt.datetime.now() - start).total_seconds()
+
+    async def monitor_event_loop_lag(self, interval: float = 0.5):
+        """
+        Measures how late the event loop wakes up from a sleep. If this is
+        more than a few ms, something is blocking the loop.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.event_loop_lag = max(0.0, loop.time() - start - interval)
+            self.event_loop_lag_max = max(self.event_loop_lag_max, self.event_loop_lag)
+
+    def pipeline_metrics(self) -> dict:
+        return {
+            "event_loop_lag": round(self.event_loop_lag, 4),
+            "event_loop_lag_max": round(self.event_loop_lag_max, 4),
+            "stages": {
+                stage.value: stats.to_dict()
+                for stage, stats in self.stage_stats.items()
+            },
+            "fetcher": self.block_fetcher.stats(),
+            "prefetcher": self.block_prefetcher.stats(),
+            "blocks_in_queue": len(self.finalized_block_infos_to_process),
+            "special_purpose_blocks_in_queue": len(
+                self.special_purpose_block_infos_to_process
+            ),
+            "fill_levels": self.fill_levels(),
+            "flush": self.flush_stats.stats(),
+            "spool": self.spool.stats() if self.spool else None,
+            "batch_controller": self.batch_controller.stats(),
+            "contract_index": self.contract_index.stats(),
+            "cis_support_cache": self.cis_support_cache.stats(),
+            "instance_name_cache": self.instance_name_cache.stats(),
+            "token_ledger": self.token_ledger.stats(),
+            "logged_event_stream": self.logged_event_stream.stats(),
+        }
+
+    def log_pipeline_metrics_in_mongo(self, metrics: dict):
+        self.db: dict[Collections, Collection]
+        query = {"_id": "heartbeat_pipeline_metrics"}
+        self.db[Collections.helpers].replace_one(
+            query,
+            {
+                "_id": "heartbeat_pipeline_metrics",
+                "date": dt.datetime.now().astimezone(tz=dt.timezone.utc),
+                "metrics": metrics,
+            },
+            upsert=True,
+        )
+
+    async def report_pipeline_metrics(self):
+        """
+        Logs the pipeline metrics every METRICS_INTERVAL sec and stores them
+        in the helper document `heartbeat_pipeline_metrics`.
+        """
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            try:
+                metrics = self.pipeline_metrics()
+                console.log(f"Pipeline metrics: {metrics}")
+                await self.run_in_stage(
+                    Stage.io, self.log_pipeline_metrics_in_mongo, metrics
+                )
+                # max lag is per reporting interval
+                self.event_loop_lag_max = 0.0
+            except Exception as e:
+                console.log(e)
+
+    def shutdown_stage_executors(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
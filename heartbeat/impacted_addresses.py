@@ -140,8 +140,9 @@ class ImpactedAddresses(Utils):
             balance_movement,
         )
 
-    def extract_impacted_addesses_from_tx(self, tx: CCD_BlockItemSummary):
-        self.queues: dict[Collections, list]
+    def extract_impacted_addesses_from_tx(
+        self, tx: CCD_BlockItemSummary, queues: dict[Queue, list]
+    ):
         impacted_addresses_in_tx: dict[str:MongoImpactedAddress] = {}
         if tx.account_creation:
             balance_movement = AccountStatementEntryType()
@@ -272,7 +273,7 @@ class ImpactedAddresses(Utils):
             if "id" in repl_dict:
                 del repl_dict["id"]
 
-            self.queues[Queue.impacted_addresses].append(
+            queues[Queue.impacted_addresses].append(
                 ReplaceOne(
                     {"_id": ia.id},
                     repl_dict,
@@ -0,0 +1,58 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from collections import OrderedDict
+import threading
+
+
+class InstanceNameCache:
+    """
+    LRU cache of contract address ('<index,subindex>') -> init name of a V1
+    instance (`None` for a V0 instance). Filled from instances discovered
+    while decoding blocks, and from the instances collection on a miss, so
+    CIS decoding of interrupted effects doesn't read Mongo for contracts it
+    has already seen.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[str, str | None] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, address: str) -> tuple[bool, str | None]:
+        """
+        Returns (found, name).
+        """
+        with self.lock:
+            if address in self.entries:
+                self.entries.move_to_end(address)
+                self.hits += 1
+                return True, self.entries[address]
+            self.misses += 1
+            return False, None
+
+    def set(self, address: str, name: str | None):
+        with self.lock:
+            self.entries[address] = name
+            self.entries.move_to_end(address)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_from_instance(self, address: str, instance: dict):
+        """
+        `instance` is an instance document, as stored in the instances collection.
+        """
+        v1 = instance.get("v1")
+        self.set(address, v1.get("name") if v1 else None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None,
+            "evictions": self.evictions,
+        }
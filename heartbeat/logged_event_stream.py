@@ -0,0 +1,148 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from typing import NamedTuple
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+# weight of a new measurement in the running accounting rate.
+RATE_WEIGHT = 0.2
+
+LOGGED_EVENTS_SORT = [
+    ("block_height", ASCENDING),
+    ("tx_index", ASCENDING),
+    ("ordering", ASCENDING),
+]
+# the fields token accounting uses, so the (large) logged_event itself,
+# hashes and dates are not sent.
+LOGGED_EVENTS_PROJECTION = {
+    "_id": 0,
+    "block_height": 1,
+    "tx_index": 1,
+    "ordering": 1,
+    "token_address": 1,
+    "tag": 1,
+    "result": 1,
+}
+
+
+class StreamedLoggedEvent(NamedTuple):
+    """
+    The part of a `MongoTypeLoggedEvent` that token accounting needs.
+    """
+
+    block_height: int
+    tx_index: int
+    ordering: int
+    token_address: str
+    tag: int
+    result: dict
+
+
+def after_key(block_height: int, tx_index: int, ordering: int) -> dict:
+    """
+    Filter for the events in `block_height` after (tx_index, ordering).
+    """
+    return {
+        "block_height": block_height,
+        "$or": [
+            {"tx_index": {"$gt": tx_index}},
+            {"tx_index": tx_index, "ordering": {"$gt": ordering}},
+        ],
+    }
+
+
+class LoggedEventStream:
+    """
+    Reads logged events for token accounting in pages that always hold whole
+    blocks: a page is read up to `page_size` events and, if that cuts a block,
+    the rest of that block is read with the resume key (block_height,
+    tx_index, ordering) of the last event. A block is never split between
+    pages, so the checkpoint (a block height) can move to the last block of
+    a page.
+
+    The page size follows the accounting rate, a page holds about
+    `target_seconds` of accounting work, between `min_page_size` and
+    `max_page_size`.
+    """
+
+    def __init__(self, min_page_size: int, max_page_size: int, target_seconds: float):
+        self.min_page_size = max(1, min_page_size)
+        self.max_page_size = max(self.min_page_size, max_page_size)
+        self.target_seconds = target_seconds
+        # running average of events accounted for per second.
+        self.events_per_second: float | None = None
+
+        # stats
+        self.pages = 0
+        self.events = 0
+        self.blocks_completed = 0
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+
+    def page_size(self) -> int:
+        if not self.events_per_second:
+            return self.min_page_size
+        size = int(self.events_per_second * self.target_seconds)
+        return min(self.max_page_size, max(self.min_page_size, size))
+
+    def record(self, events: int, seconds: float):
+        if (events <= 0) or (seconds <= 0):
+            return
+        rate = events / seconds
+        previous = self.events_per_second or rate
+        self.events_per_second = (1 - RATE_WEIGHT) * previous + RATE_WEIGHT * rate
+
+    def read_page(
+        self,
+        collection: Collection,
+        after_height: int,
+        max_height: int | None = None,
+    ) -> list[StreamedLoggedEvent]:
+        """
+        Logged events in the blocks after `after_height` (up to and including
+        `max_height`, if set), in order, ending with a whole block.
+        """
+        query = {"block_height": {"$gt": after_height}}
+        if max_height is not None:
+            query["block_height"]["$lte"] = max_height
+
+        page_size = self.page_size()
+        page = [
+            StreamedLoggedEvent(**x)
+            for x in collection.find(query, LOGGED_EVENTS_PROJECTION)
+            .sort(LOGGED_EVENTS_SORT)
+            .limit(page_size)
+        ]
+        if len(page) == page_size:
+            # the page may end in the middle of a block, read the rest of it.
+            last = page[-1]
+            rest = [
+                StreamedLoggedEvent(**x)
+                for x in collection.find(
+                    after_key(last.block_height, last.tx_index, last.ordering),
+                    LOGGED_EVENTS_PROJECTION,
+                ).sort(LOGGED_EVENTS_SORT)
+            ]
+            if len(rest) > 0:
+                page.extend(rest)
+                self.blocks_completed += 1
+
+        self.pages += 1
+        self.events += len(page)
+        return page
+
+    def stats(self) -> dict:
+        prefetches = self.prefetch_hits + self.prefetch_misses
+        return {
+            "page_size": self.page_size(),
+            "events_per_second": (
+                round(self.events_per_second, 1) if self.events_per_second else None
+            ),
+            "pages": self.pages,
+            "events": self.events,
+            "blocks_completed": self.blocks_completed,
+            "prefetch_hits": self.prefetch_hits,
+            "prefetch_misses": self.prefetch_misses,
+            "prefetch_hit_rate": (
+                round(self.prefetch_hits / prefetches, 4) if prefetches > 0 else None
+            ),
+        }
@@ -4,7 +4,7 @@ from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
 from ccdexplorer_fundamentals.enums import NET
 from ccdexplorer_fundamentals.GRPCClient import GRPCClient
 from ccdexplorer_fundamentals.mongodb import Collections
-from pymongo import ReplaceOne
+from pymongo import UpdateOne
 from env import *
 import ccdexplorer_fundamentals.GRPCClient.wadze as wadze
 import io
@@ -13,6 +13,25 @@ from rich.console import Console
 console = Console()
 
 
+def module_update(
+    module_ref: CCD_ModuleRef, module: dict, contracts: list
+) -> UpdateOne:
+    """
+    Upserts a module, adding `contracts` to the contracts that are stored.
+    Contracts are never removed, so a module written from a stale view of its
+    contracts doesn't drop the contracts added by others. `contracts` stays
+    None as long as there are none, as before.
+    """
+    update = {f: {"$literal": v} for f, v in module.items()}
+    if len(contracts) > 0:
+        update["contracts"] = {
+            "$setUnion": [{"$ifNull": ["$contracts", []]}, {"$literal": contracts}]
+        }
+    else:
+        update["contracts"] = {"$ifNull": ["$contracts", None]}
+    return UpdateOne({"_id": module_ref}, [{"$set": update}], upsert=True)
+
+
 class ModuleLogic(Utils):
     def get_module_metadata(self, block_hash: str, module_ref: str) -> dict[str, str]:
         self.grpcclient: GRPCClient
@@ -45,38 +64,34 @@ class ModuleLogic(Utils):
 
         return results
 
-    def add_back_updated_modules_to_queue(
-        self, current_block_to_process: CCD_BlockInfo
-    ):
+    def add_back_updated_modules_to_queue(self, updated_modules: list[CCD_ModuleRef]):
+        """
+        Queues the modules that have new contracts. Reading the module sources
+        is gRPC, so the operations are built without the queues lock, which
+        is only taken to add them to the queue.
+        """
         self.queues: dict[Collections, list]
-        self.queues[Queue.modules] = []
-
+        module_queues = {Queue.modules: []}
         # make this into a set to remove duplicates...remember testnet with 991K module updates in 1K blocks...
-        self.queues[Queue.updated_modules] = list(
-            set(self.queues[Queue.updated_modules])
-        )
-        # for module_ref in self.existing_source_modules.keys():
-        for module_ref in self.queues[Queue.updated_modules]:
-            self.get_module_data_and_add_to_queue(module_ref)
+        for module_ref in set(updated_modules):
+            self.get_module_data_and_add_to_queue(module_ref, module_queues)
+        with self.queues_lock:
+            self.queues[Queue.modules].extend(module_queues[Queue.modules])
 
-    def get_module_data_and_add_to_queue(self, module_ref: CCD_ModuleRef):
+    def get_module_data_and_add_to_queue(
+        self, module_ref: CCD_ModuleRef, queues: dict[Queue, list]
+    ):
         self.existing_source_modules: dict[CCD_ModuleRef, set]
         try:
             results = self.get_module_metadata("last_final", module_ref)
         except:
             results = {"module_name": "", "methods": []}
+        with self.discovery_lock:
+            contracts = list(self.existing_source_modules.get(module_ref, []))
         module = {
-            "_id": module_ref,
             "module_name": (
                 results["module_name"] if "module_name" in results.keys() else None
             ),
             "methods": results["methods"] if "methods" in results.keys() else None,
-            "contracts": (
-                list(self.existing_source_modules.get(module_ref, []))
-                if self.existing_source_modules.get(module_ref)
-                else None
-            ),
         }
-        self.queues[Queue.modules].append(
-            ReplaceOne({"_id": module_ref}, module, upsert=True)
-        )
+        queues[Queue.modules].append(module_update(module_ref, module, contracts))
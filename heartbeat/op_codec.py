@@ -0,0 +1,80 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .utils import Queue
+from pymongo import ReplaceOne, UpdateOne
+from bson.raw_bson import RawBSONDocument
+import bson
+import zlib
+
+# level 1 is plenty, the payload is mostly repeated keys.
+COMPRESSION_LEVEL = 1
+
+# queues that hold the bulk of the documents, see `pre_encode_queues`.
+PRE_ENCODED_QUEUES = [
+    Queue.blocks,
+    Queue.special_events,
+    Queue.transactions,
+    Queue.involved_all,
+    Queue.involved_transfer,
+    Queue.involved_contract,
+    Queue.logged_events,
+    Queue.impacted_addresses,
+]
+
+
+def pre_encode_queues(queues: dict[Queue, list]) -> int:
+    """
+    Replaces the documents of the `ReplaceOne` operations in the bulk queues
+    with `RawBSONDocument`s, so they are encoded on the thread that decoded
+    the block. When the operations are written, the driver copies the bytes
+    instead of encoding the documents again. Returns the number of bytes
+    encoded.
+    """
+    encoded_bytes = 0
+    for q in PRE_ENCODED_QUEUES:
+        queue = queues[q]
+        for index, op in enumerate(queue):
+            if isinstance(op, ReplaceOne) and not isinstance(op._doc, RawBSONDocument):
+                raw = RawBSONDocument(bson.encode(op._doc))
+                queue[index] = ReplaceOne(op._filter, raw, upsert=op._upsert)
+                encoded_bytes += len(raw.raw)
+    return encoded_bytes
+
+
+def encode_queues(queues: dict[Queue, list]) -> bytes:
+    """
+    Encodes the queues of one or more decoded blocks into a compact payload
+    that can be sent between processes: a single BSON document with a list
+    per queue, zlib compressed. `ReplaceOne` and `UpdateOne` operations are
+    stored as their filter, document or update and upsert flag, other queues
+    (heights, module refs, token addresses) as plain values.
+    """
+    doc = {}
+    for q, queue in queues.items():
+        if len(queue) == 0:
+            continue
+        doc[q.name] = [encode_op(x) for x in queue]
+    return zlib.compress(bson.encode(doc), COMPRESSION_LEVEL)
+
+
+def encode_op(op) -> dict:
+    if isinstance(op, ReplaceOne):
+        return {"f": op._filter, "d": op._doc, "u": op._upsert}
+    if isinstance(op, UpdateOne):
+        return {"f": op._filter, "up": op._doc, "u": op._upsert}
+    return {"v": op}
+
+
+def decode_op(x: dict):
+    if "d" in x:
+        return ReplaceOne(x["f"], x["d"], upsert=x["u"])
+    if "up" in x:
+        return UpdateOne(x["f"], x["up"], upsert=x["u"])
+    return x["v"]
+
+
+def decode_queues(payload: bytes) -> dict[Queue, list]:
+    queues = {q: [] for q in Queue}
+    doc = bson.decode(zlib.decompress(payload))
+    for name, items in doc.items():
+        queues[Queue[name]] = [decode_op(x) for x in items]
+    return queues
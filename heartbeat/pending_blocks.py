@@ -0,0 +1,117 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from collections import deque
+from typing import Iterator
+import bisect
+import threading
+import sys
+
+# block infos are all about the same size, so only one in SAMPLE_EVERY blocks
+# is serialized to measure it.
+SAMPLE_EVERY = 100
+
+
+class PendingBlocks:
+    """
+    Queue of blocks waiting to be processed, keyed on height.
+    A height can only be in the queue once, membership checks are a dict
+    lookup and blocks are popped in order of height.
+
+    Blocks are almost always added in increasing height order, which is an
+    append to `heights`. A block with a lower height than the last one
+    (special purpose requests can come in any order) is inserted in place.
+
+    Blocks are added on the event loop and popped by the processing thread,
+    hence the lock.
+
+    `estimated_bytes` keeps a running estimate of the memory the queue holds,
+    based on the serialized size of a sample of the block infos.
+    """
+
+    def __init__(self):
+        self.blocks: dict[int, CCD_BlockInfo] = {}
+        self.heights: deque[int] = deque()
+        # highest height ever added, this does not go down when a block is popped.
+        self.last_height_added: int | None = None
+        self.estimated_bytes = 0
+        self.block_bytes: dict[int, int] = {}
+        self.average_block_bytes: float | None = None
+        self.blocks_estimated = 0
+        self.lock = threading.Lock()
+
+    def estimate_block_bytes(self, block_info: CCD_BlockInfo) -> int:
+        self.blocks_estimated += 1
+        if (self.average_block_bytes is None) or (
+            self.blocks_estimated % SAMPLE_EVERY == 0
+        ):
+            try:
+                block_bytes = len(block_info.model_dump_json(exclude_none=True))
+            except:
+                block_bytes = sys.getsizeof(block_info)
+            self.average_block_bytes = (
+                block_bytes
+                if self.average_block_bytes is None
+                else 0.8 * self.average_block_bytes + 0.2 * block_bytes
+            )
+        return int(self.average_block_bytes)
+
+    def add(self, block_info: CCD_BlockInfo) -> bool:
+        """
+        Adds a block to the queue. Returns False if a block at this height
+        is already in the queue.
+        """
+        height = block_info.height
+        block_bytes = self.estimate_block_bytes(block_info)
+        with self.lock:
+            if height in self.blocks:
+                return False
+
+            self.blocks[height] = block_info
+            self.block_bytes[height] = block_bytes
+            self.estimated_bytes += block_bytes
+            if len(self.heights) == 0 or height > self.heights[-1]:
+                self.heights.append(height)
+            else:
+                bisect.insort(self.heights, height)
+            if self.last_height_added is None or height > self.last_height_added:
+                self.last_height_added = height
+        return True
+
+    def extend(self, block_infos: list[CCD_BlockInfo]) -> int:
+        """
+        Adds blocks to the queue, returns the number of blocks added.
+        """
+        return sum([self.add(x) for x in block_infos])
+
+    def popleft(self) -> CCD_BlockInfo:
+        with self.lock:
+            height = self.heights.popleft()
+            self.estimated_bytes -= self.block_bytes.pop(height)
+            return self.blocks.pop(height)
+
+    def first(self) -> CCD_BlockInfo | None:
+        with self.lock:
+            return self.blocks[self.heights[0]] if len(self.heights) > 0 else None
+
+    def last(self) -> CCD_BlockInfo | None:
+        with self.lock:
+            return self.blocks[self.heights[-1]] if len(self.heights) > 0 else None
+
+    def peek(self, n: int) -> list[CCD_BlockInfo]:
+        """
+        The first `n` blocks, without removing them.
+        """
+        with self.lock:
+            return [
+                self.blocks[self.heights[i]] for i in range(min(n, len(self.heights)))
+            ]
+
+    def __contains__(self, height: int) -> bool:
+        return height in self.blocks
+
+    def __len__(self) -> int:
+        return len(self.heights)
+
+    def __iter__(self) -> Iterator[CCD_BlockInfo]:
+        with self.lock:
+            return iter([self.blocks[height] for height in self.heights])
@@ -1,204 +1,418 @@
 # ruff: noqa: F403, F405, E402, E501, E722
-from .utils import Utils, Queue
+from .utils import Utils, Queue, Stage
+from .backpressure import DEFAULT_OP_BYTES
+from .bulk_writes import ChunkWriteError, chunk_ops, dedupe_ops, failed_ops
+from .op_codec import encode_queues, decode_queues
 from ccdexplorer_fundamentals.mongodb import Collections
 from ccdexplorer_fundamentals.tooter import TooterChannel, TooterType
 
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 from pymongo.results import BulkWriteResult
 from env import *
+import datetime as dt
 import asyncio
+import os
 from rich.console import Console
 
 console = Console()
 
+# these queues are filled by the process stage and emptied by `send_to_mongo`.
+QUEUES_TO_FLUSH = [
+    Queue.blocks,
+    Queue.block_heights,
+    Queue.special_events,
+    Queue.transactions,
+    Queue.involved_all,
+    Queue.involved_transfer,
+    Queue.involved_contract,
+    Queue.instances,
+    Queue.modules,
+    Queue.block_per_day,
+    Queue.logged_events,
+    Queue.impacted_addresses,
+    Queue.token_addresses_to_redo_accounting,
+    Queue.provenance_contracts_to_add,
+]
+
+
+def collection_for_queue() -> dict[Queue, Collections]:
+    """
+    Queues that are written to a collection with a bulk write.
+    """
+    return {
+        Queue.blocks: Collections.blocks,
+        Queue.special_events: Collections.special_events,
+        Queue.transactions: Collections.transactions,
+        Queue.involved_all: Collections.involved_accounts_all,
+        Queue.involved_transfer: Collections.involved_accounts_transfer,
+        Queue.involved_contract: Collections.involved_contracts,
+        Queue.instances: Collections.instances,
+        Queue.modules: Collections.modules,
+        Queue.block_per_day: Collections.blocks_per_day,
+        Queue.logged_events: Collections.tokens_logged_events,
+        Queue.impacted_addresses: Collections.impacted_addresses,
+    }
+
+
+LOG_LABEL_FOR_QUEUE = {
+    Queue.blocks: "B: ",
+    Queue.transactions: "T: ",
+    Queue.involved_all: "A: ",
+    Queue.involved_transfer: "Tr:",
+    Queue.involved_contract: "C: ",
+    Queue.instances: "I: ",
+    Queue.modules: "M: ",
+    Queue.logged_events: "E: ",
+    Queue.impacted_addresses: "IA:",
+}
+
 
 class SendToMongo(Utils):
-    async def send_to_mongo(self):
+    def take_queues_to_flush(self) -> tuple[dict[Queue, list], int | None]:
         """
-        This method takes all queues with mongoDB messages and sends them to the
-        respective collections.
+        Takes the contents of all queues that need to be sent to MongoDB
+        and leaves empty queues behind for the process stage. Also returns
+        the last committed height: once these queues are stored, everything
+        up to and including this height is stored.
         """
         self.queues: dict[Collections, list]
-        self.db: dict[Collections, Collection]
+        with self.queues_lock:
+            queues = {q: self.queues[q] for q in QUEUES_TO_FLUSH}
+            for q in QUEUES_TO_FLUSH:
+                self.queues[q] = []
+            checkpoint_height = self.last_committed_height
+        self.record_op_sizes(queues)
+        return queues, checkpoint_height
+
+    def return_queues_to_flush(self, queues: dict[Queue, list]):
+        """
+        Puts queue contents that could not be sent back in front of the
+        queues, so they are retried with the next flush.
+        """
+        with self.queues_lock:
+            for q, queue in queues.items():
+                if len(queue) > 0:
+                    self.queues[q] = queue + self.queues[q]
+
+    def save_provenance_contracts(self, provenance_contracts_to_add: list):
+        query = {"_id": "provenance-tags"}
+        current_content = self.db[Collections.tokens_tags].find_one(query)
+        if not current_content:
+            current_content = {
+                "_id": "provenance-tags",
+                "contracts": [],
+                "token_type": "non-fungible",
+                "tag_template": True,
+                "single_use_token": False,
+            }
+        current_contracts: list = current_content["contracts"]
+        current_contracts.extend(list(set(provenance_contracts_to_add)))
+
+        current_contracts = list(set(current_contracts))
+        current_contracts.sort()
+        current_content.update({"contracts": current_contracts})
+        self.db[Collections.tokens_tags].replace_one(
+            query,
+            replacement=current_content,
+            upsert=True,
+        )
+        console.log(
+            f"Added {len(list(set(provenance_contracts_to_add))):,.0f} contracts to provenance for {self.net}."
+        )
+        self.tooter.send(
+            channel=TooterChannel.NOTIFIER,
+            message=f"Added {' | '.join(list(set(provenance_contracts_to_add)))} contracts to provenance-tags for {self.net}.",
+            notifier_type=TooterType.REQUESTS_ERROR,
+        )
+
+    async def write_chunk(
+        self,
+        collection: Collections,
+        chunk: list,
+        semaphore: asyncio.Semaphore,
+    ) -> dict[str, int]:
+        """
+        Writes a chunk with an unordered bulk write. Operations that fail are
+        retried, with exponential backoff, up to FLUSH_RETRIES times. Returns
+        the matched, modified and upserted counts. If operations are still
+        not written, raises `ChunkWriteError` with only those operations.
+        """
         self.motordb: dict[Collections, Collection]
-        while True:
+        counts = {"matched": 0, "modified": 0, "upserted": 0}
+        ops = chunk
+        for attempt in range(FLUSH_RETRIES + 1):
+            if attempt > 0:
+                self.flush_stats.record_retry(collection.value, len(ops))
+                await asyncio.sleep(FLUSH_RETRY_BACKOFF * 2 ** (attempt - 1))
+            start = dt.datetime.now()
             try:
-                if len(self.queues[Queue.blocks]) > 0:
-                    result = self.db[Collections.blocks].bulk_write(
-                        self.queues[Queue.blocks]
-                    )
-                    if len(self.queues[Queue.block_heights]) == 1:
-                        console.log(
-                            f"Sent to Mongo  : {self.queues[Queue.block_heights][0]:,.0f}"
-                        )
-                    else:
-                        console.log(
-                            f"Sent to Mongo   : {self.queues[Queue.block_heights][0]:,.0f} - {self.queues[Queue.block_heights][-1]:,.0f}"
-                        )
-                    console.log(
-                        f"B:  {len(self.queues[Queue.blocks]):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.blocks] = []
-                    self.queues[Queue.block_heights] = []
-                else:
-                    pass
-                    # update_ = False
-
-                if len(self.queues[Queue.special_events]) > 0:
-                    result = self.db[Collections.special_events].bulk_write(
-                        self.queues[Queue.special_events]
-                    )
-                    self.queues[Queue.special_events] = []
-
-                if len(self.queues[Queue.transactions]) > 0:
-                    tx_queue = self.queues[Queue.transactions]
-                    self.queues[Queue.transactions] = []
-                    result: BulkWriteResult = await self.motordb[
-                        Collections.transactions
-                    ].bulk_write(tx_queue)
-                    console.log(
-                        f"T:  {len(tx_queue):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
+                async with semaphore:
+                    result: BulkWriteResult = await self.motordb[collection].bulk_write(
+                        ops, ordered=False
                     )
+                self.flush_stats.record_chunk(
+                    collection.value,
+                    len(ops),
+                    (dt.datetime.now() - start).total_seconds(),
+                )
+                counts["matched"] += result.matched_count
+                counts["modified"] += result.modified_count
+                counts["upserted"] += result.upserted_count
+                return counts
+            except BulkWriteError as e:
+                self.flush_stats.record_chunk(
+                    collection.value,
+                    len(ops),
+                    (dt.datetime.now() - start).total_seconds(),
+                )
+                counts["matched"] += e.details.get("nMatched", 0)
+                counts["modified"] += e.details.get("nModified", 0)
+                counts["upserted"] += e.details.get("nUpserted", 0)
+                error = e
+                not_written = failed_ops(ops, e)
+                # a write concern error doesn't say which operations were applied.
+                if (
+                    len(not_written) == 0
+                    and len(e.details.get("writeConcernErrors", [])) == 0
+                ):
+                    return counts
+                ops = not_written or ops
+            except Exception as e:
+                error = e
+            console.log(
+                f"{collection.value}: {len(ops):,.0f} operations not written (attempt {attempt + 1}): {error}"
+            )
+        raise ChunkWriteError(ops, error)
 
-                if len(self.queues[Queue.involved_all]) > 0:
-                    ia_queue = self.queues[Queue.involved_all]
-                    self.queues[Queue.involved_all] = []
-                    result: BulkWriteResult = await self.motordb[
-                        Collections.involved_accounts_all
-                    ].bulk_write(ia_queue)
-                    console.log(
-                        f"A:  {len(ia_queue):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.involved_all] = []
+    async def flush_queue(
+        self,
+        queues: dict[Queue, list],
+        q: Queue,
+        collection: Collections,
+        semaphore: asyncio.Semaphore,
+    ):
+        """
+        Sends one queue to its collection through the async client, in chunks of
+        at most FLUSH_CHUNK_OPS operations and about FLUSH_CHUNK_BYTES bytes.
+        Afterwards the queue only holds the operations that were not written.
+        """
+        ops = dedupe_ops(queues[q])
+        chunks = chunk_ops(
+            ops,
+            FLUSH_CHUNK_OPS,
+            self.average_op_bytes.get(q, DEFAULT_OP_BYTES),
+            FLUSH_CHUNK_BYTES,
+        )
+        results = await asyncio.gather(
+            *[self.write_chunk(collection, chunk, semaphore) for chunk in chunks],
+            return_exceptions=True,
+        )
+        counts = {"matched": 0, "modified": 0, "upserted": 0}
+        not_written = []
+        errors = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, ChunkWriteError):
+                not_written.extend(result.ops)
+                errors.append(result)
+            elif isinstance(result, Exception):
+                not_written.extend(chunk)
+                errors.append(result)
+            else:
+                for k, v in result.items():
+                    counts[k] += v
+        queues[q] = not_written
+        if len(errors) > 0:
+            raise errors[0]
 
-                if len(self.queues[Queue.involved_transfer]) > 0:
-                    result = self.db[Collections.involved_accounts_transfer].bulk_write(
-                        self.queues[Queue.involved_transfer]
-                    )
-                    console.log(
-                        f"Tr: {len(self.queues[Queue.involved_transfer]):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.involved_transfer] = []
+        if q == Queue.blocks:
+            if len(queues[Queue.block_heights]) == 1:
+                console.log(f"Sent to Mongo  : {queues[Queue.block_heights][0]:,.0f}")
+            elif len(queues[Queue.block_heights]) > 1:
+                console.log(
+                    f"Sent to Mongo   : {queues[Queue.block_heights][0]:,.0f} - {queues[Queue.block_heights][-1]:,.0f}"
+                )
+            queues[Queue.block_heights] = []
+        if q == Queue.block_per_day:
+            console.log(f"End of day: U {counts['upserted']:5,.0f}")
+        elif q in LOG_LABEL_FOR_QUEUE:
+            console.log(
+                f"{LOG_LABEL_FOR_QUEUE[q]} {len(ops):5,.0f} | M {counts['matched']:5,.0f} | Mod {counts['modified']:5,.0f} | U {counts['upserted']:5,.0f}"
+            )
 
-                if len(self.queues[Queue.involved_contract]) > 0:
-                    result = self.db[Collections.involved_contracts].bulk_write(
-                        self.queues[Queue.involved_contract]
-                    )
-                    console.log(
-                        f"C:  {len(self.queues[Queue.involved_contract]):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.involved_contract] = []
+    async def flush_helpers(
+        self, queues: dict[Queue, list], semaphore: asyncio.Semaphore
+    ):
+        """
+        Helper documents that are read and rewritten, these run on the flush
+        stage thread pool.
+        """
+        async with semaphore:
+            if len(queues[Queue.token_addresses_to_redo_accounting]) > 0:
+                query = {"_id": "redo_token_addresses"}
+                await self.run_in_stage(
+                    Stage.flush,
+                    self.db[Collections.helpers].replace_one,
+                    query,
+                    {
+                        "_id": "redo_token_addresses",
+                        "token_addresses": list(
+                            set(queues[Queue.token_addresses_to_redo_accounting])
+                        ),
+                    },
+                    upsert=True,
+                )
+                console.log(
+                    f"Added {len(queues[Queue.token_addresses_to_redo_accounting]):,.0f} token_addresses to redo accounting."
+                )
+                queues[Queue.token_addresses_to_redo_accounting] = []
 
-                if len(self.queues[Queue.instances]) > 0:
-                    result = self.db[Collections.instances].bulk_write(
-                        self.queues[Queue.instances]
-                    )
-                    console.log(
-                        f"I:  {len(self.queues[Queue.instances]):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.instances] = []
+            if len(queues[Queue.provenance_contracts_to_add]) > 0:
+                await self.run_in_stage(
+                    Stage.flush,
+                    self.save_provenance_contracts,
+                    queues[Queue.provenance_contracts_to_add],
+                )
+                queues[Queue.provenance_contracts_to_add] = []
 
-                if len(self.queues[Queue.modules]) > 0:
-                    result = self.db[Collections.modules].bulk_write(
-                        self.queues[Queue.modules]
-                    )
-                    console.log(
-                        f"M:  {len(self.queues[Queue.modules]):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
-                    self.queues[Queue.modules] = []
+    async def flush_queues(self, queues: dict[Queue, list]) -> list[Exception]:
+        """
+        Writes all queues concurrently, at most FLUSH_CONCURRENCY writes at a
+        time. Afterwards the queues only hold what was not written, the errors
+        are returned.
+        """
+        flushes = [
+            self.flush_queue(queues, q, collection, self.flush_semaphore)
+            for q, collection in collection_for_queue().items()
+            if len(queues[q]) > 0
+        ]
+        flushes.append(self.flush_helpers(queues, self.flush_semaphore))
+        results = await asyncio.gather(*flushes, return_exceptions=True)
+        return [x for x in results if isinstance(x, Exception)]
 
-                if len(self.queues[Queue.block_per_day]) > 0:
-                    result = self.db[Collections.blocks_per_day].bulk_write(
-                        self.queues[Queue.block_per_day]
-                    )
-                    console.log(f"End of day: U {result.upserted_count:5,.0f}")
-                    self.queues[Queue.block_per_day] = []
-
-                if len(self.queues[Queue.logged_events]) > 0:
-                    le_queue = self.queues[Queue.logged_events]
-                    self.queues[Queue.logged_events] = []
-                    result: BulkWriteResult = await self.motordb[
-                        Collections.tokens_logged_events
-                    ].bulk_write(le_queue)
-                    console.log(
-                        f"E:  {len(le_queue):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
+    async def spool_queues(
+        self, queues: dict[Queue, list], checkpoint_height: int | None
+    ) -> bool:
+        """
+        Appends the queues to the spool, to be written by `replay_spool`.
+        Returns False if that didn't work.
+        """
+        try:
+            payload = await self.run_in_stage(Stage.flush, encode_queues, queues)
+            await self.run_in_stage(
+                Stage.io, self.spool.append, payload, checkpoint_height
+            )
+        except Exception as e:
+            console.log(f"Could not spool queues: {e}")
+            return False
+        if (checkpoint_height is not None) and (
+            (self.last_spooled_height is None)
+            or (checkpoint_height > self.last_spooled_height)
+        ):
+            self.last_spooled_height = checkpoint_height
+        # spooled blocks are progress, as far as `get_finalized_blocks` is concerned.
+        self.internal_freqency_timer = dt.datetime.now().astimezone(tz=dt.timezone.utc)
+        return True
 
-                if len(self.queues[Queue.impacted_addresses]) > 0:
-                    ia_queue = self.queues[Queue.impacted_addresses]
-                    self.queues[Queue.impacted_addresses] = []
-                    result: BulkWriteResult = await self.motordb[
-                        Collections.impacted_addresses
-                    ].bulk_write(ia_queue)
-                    console.log(
-                        f"IA: {len(ia_queue):5,.0f} | M {result.matched_count:5,.0f} | Mod {result.modified_count:5,.0f} | U {result.upserted_count:5,.0f}"
-                    )
+    async def send_to_mongo(self):
+        """
+        This method takes all queues with mongoDB messages and sends them to the
+        respective collections. The collections are independent, so they are
+        written concurrently through the async client, at most FLUSH_CONCURRENCY
+        at a time. Only if all writes succeed, the checkpoint moves.
+        If a write fails, what has not been written goes to the spool (with
+        SPOOL_DIR set) or is put back in the queues, to be retried next time.
+        While the spool is not empty, new batches go to the spool as well, so
+        they are written in order.
+        """
+        self.queues: dict[Collections, list]
+        self.db: dict[Collections, Collection]
+        last_flush = dt.datetime.now()
+        while True:
+            # at the tip, every processed block is sent right away. When catching up,
+            # wait for a batch of blocks, but at most FLUSH_INTERVAL sec.
+            while (
+                len(self.queues[Queue.block_heights])
+                < self.batch_controller.flush_batch_size()
+            ) and ((dt.datetime.now() - last_flush).total_seconds() < FLUSH_INTERVAL):
+                await asyncio.sleep(0.05)
+            last_flush = dt.datetime.now()
 
-                if len(self.queues[Queue.token_addresses_to_redo_accounting]) > 0:
-                    query = {"_id": "redo_token_addresses"}
-                    self.db[Collections.helpers].replace_one(
-                        query,
-                        {
-                            "_id": "redo_token_addresses",
-                            "token_addresses": list(
-                                set(
-                                    self.queues[
-                                        Queue.token_addresses_to_redo_accounting
-                                    ]
-                                )
-                            ),
-                        },
-                        upsert=True,
-                    )
-                    console.log(
-                        f"Added {len(self.queues[Queue.token_addresses_to_redo_accounting]):,.0f} token_addresses to redo accounting."
-                    )
-                    self.queues[Queue.token_addresses_to_redo_accounting] = []
-
-                if len(self.queues[Queue.provenance_contracts_to_add]) > 0:
-                    query = {"_id": "provenance-tags"}
-                    current_content = self.db[Collections.tokens_tags].find_one(query)
-                    if not current_content:
-                        current_content = {
-                            "_id": "provenance-tags",
-                            "contracts": [],
-                            "token_type": "non-fungible",
-                            "tag_template": True,
-                            "single_use_token": False,
-                        }
-                    current_contracts: list = current_content["contracts"]
-                    current_contracts.extend(
-                        list(set(self.queues[Queue.provenance_contracts_to_add]))
-                    )
+            # the queues taken, until they are stored, spooled or given back.
+            taken = None
+            try:
+                queues, checkpoint_height = await self.run_in_stage(
+                    Stage.flush, self.take_queues_to_flush
+                )
+                taken = queues
+                blocks_to_flush = len(queues[Queue.block_heights])
+                if (self.spool is not None) and not self.spool.is_empty():
+                    if (sum([len(x) for x in queues.values()]) > 0) and not (
+                        await self.spool_queues(queues, checkpoint_height)
+                    ):
+                        self.return_queues_to_flush(queues)
+                        taken = None
+                        await asyncio.sleep(1)
+                    taken = None
+                    continue
 
-                    current_contracts = list(set(current_contracts))
-                    current_contracts.sort()
-                    current_content.update({"contracts": current_contracts})
-                    self.db[Collections.tokens_tags].replace_one(
-                        query,
-                        replacement=current_content,
-                        upsert=True,
-                    )
-                    console.log(
-                        f"Added {len(list(set(self.queues[Queue.provenance_contracts_to_add]))):,.0f} contracts to provenance for {self.net}."
+                errors = await self.flush_queues(queues)
+                if len(errors) == 0:
+                    # every collection for these heights is acknowledged.
+                    self.checkpoint_stored(checkpoint_height)
+                    taken = None
+                    self.batch_controller.record(
+                        "flush",
+                        blocks_to_flush,
+                        (dt.datetime.now() - last_flush).total_seconds(),
                     )
-                    self.tooter.send(
+                else:
+                    for e in errors:
+                        console.log(e)
+                    if (self.spool is None) or not await self.spool_queues(
+                        queues, checkpoint_height
+                    ):
+                        self.return_queues_to_flush(queues)
+                    taken = None
+                    self.tooter.relay(
                         channel=TooterChannel.NOTIFIER,
-                        message=f"Added {' | '.join(list(set(self.queues[Queue.provenance_contracts_to_add])))} contracts to provenance-tags for {self.net}.",
-                        notifier_type=TooterType.REQUESTS_ERROR,
+                        title="",
+                        chat_id=ADMIN_CHAT_ID,
+                        body=f"Heartbeat on {self.net} send_to_mongo: {errors[0]}",
+                        notifier_type=TooterType.MONGODB_ERROR,
                     )
-                    self.queues[Queue.provenance_contracts_to_add] = []
-                # this will only be set if the above store methods do not fail.
-
             except Exception as e:
-                # pass
-                console.log(e)
-                self.tooter.relay(
-                    channel=TooterChannel.NOTIFIER,
-                    title="",
-                    chat_id=ADMIN_CHAT_ID,
-                    body=f"Heartbeat on {self.net} send_to_mongo: {e}",
-                    notifier_type=TooterType.MONGODB_ERROR,
-                )
+                console.log(f"send_to_mongo: {e}")
+                # what has not been written is retried with the next flush.
+                if taken is not None:
+                    self.return_queues_to_flush(taken)
+                await asyncio.sleep(1)
 
-            await asyncio.sleep(1)
+    async def replay_spool(self):
+        """
+        Writes the batches in the spool to MongoDB, oldest first. A batch that
+        fails is retried every SPOOL_REPLAY_INTERVAL sec, later batches wait
+        for it. Once a batch is written, the checkpoint moves to its height,
+        once a segment is written, it is removed.
+        """
+        if self.spool is None:
+            return
+        while True:
+            path = await self.run_in_stage(Stage.io, self.spool.oldest_segment)
+            if path is None:
+                await asyncio.sleep(SPOOL_REPLAY_INTERVAL)
+                continue
+            records = await self.run_in_stage(Stage.io, self.spool.read_segment, path)
+            for checkpoint_height, payload in records:
+                queues = await self.run_in_stage(Stage.flush, decode_queues, payload)
+                while True:
+                    errors = await self.flush_queues(queues)
+                    if len(errors) == 0:
+                        break
+                    console.log(f"Spool replay: {errors[0]}")
+                    await asyncio.sleep(SPOOL_REPLAY_INTERVAL)
+                self.checkpoint_stored(checkpoint_height)
+            await self.run_in_stage(Stage.io, self.spool.remove, path)
+            console.log(
+                f"Spool replay: {len(records):,.0f} batches from {os.path.basename(path)} written."
+            )
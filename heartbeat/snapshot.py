@@ -0,0 +1,82 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .utils import Utils, Stage
+from .contract_index import ContractIndex
+from .cis_support_cache import CisSupportCache
+from env import *
+import datetime as dt
+import asyncio
+import gzip
+import json
+import os
+from rich.console import Console
+
+console = Console()
+
+SNAPSHOT_VERSION = 2
+
+
+class Snapshot(Utils):
+    def snapshot_path(self) -> str:
+        return SNAPSHOT_PATH or f"heartbeat_{self.net}_snapshot.json.gz"
+
+    def save_snapshot(self):
+        """
+        Saves the `contract_index` (instances and module-to-contracts) and the
+        `cis_support_cache` to a gzipped json file, so a restart doesn't start cold.
+        Written to a temporary file first, so a crash never leaves a half
+        written snapshot behind.
+        """
+        self.contract_index: ContractIndex
+        self.cis_support_cache: CisSupportCache
+        if not self.contract_index.loaded:
+            return
+        path = self.snapshot_path()
+        # decode threads may be adding contracts to modules.
+        with self.discovery_lock:
+            contract_index = self.contract_index.to_snapshot()
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "net": self.net,
+            "date": f"{dt.datetime.now().astimezone(tz=dt.timezone.utc):%Y-%m-%d %H:%M:%S}",
+            "contract_index": contract_index,
+            "cis_support": self.cis_support_cache.to_snapshot(),
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", compresslevel=1) as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self):
+        """
+        Called at startup. The next refresh of the `contract_index` reloads the
+        modules and checks the instances against Mongo with a delta query,
+        instead of loading them all.
+        """
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return
+        try:
+            with gzip.open(path, "rt") as f:
+                snapshot = json.load(f)
+            if (snapshot["version"] != SNAPSHOT_VERSION) or (
+                snapshot["net"] != self.net
+            ):
+                return
+            self.contract_index.from_snapshot(snapshot["contract_index"])
+            # expired entries are dropped on first use.
+            self.cis_support_cache.from_snapshot(snapshot["cis_support"])
+            self.existing_source_modules = self.contract_index.modules
+            self.existing_instances = self.contract_index.instances
+            console.log(
+                f"Loaded snapshot from {snapshot['date']}: {len(self.contract_index.instances):,.0f} instances, {len(self.contract_index.modules):,.0f} modules."
+            )
+        except Exception as e:
+            console.log(f"Could not load snapshot {path}: {e}")
+
+    async def save_snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.run_in_stage(Stage.io, self.save_snapshot)
+            except Exception as e:
+                console.log(f"Could not save snapshot: {e}")
@@ -0,0 +1,160 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from typing import BinaryIO
+import os
+import struct
+import threading
+import zlib
+from rich.console import Console
+
+console = Console()
+
+# payload length, checkpoint height (-1 for none) and crc32 of the payload.
+RECORD_HEADER = struct.Struct(">IqI")
+SEGMENT_SUFFIX = ".spool"
+
+
+class Spool:
+    """
+    Durable local spool for flush batches that could not be written to
+    MongoDB. Batches are appended as records to segment files, which are only
+    appended to and are replayed (and removed) oldest first. Every record
+    holds a batch encoded with `op_codec` and the checkpoint height that is
+    stored once the batch is written.
+
+    A record that was only partly written (a crash during an append) ends a
+    segment, it's ignored when the segment is read.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.active: BinaryIO | None = None
+        self.active_path: str | None = None
+        self.active_bytes = 0
+
+        paths = self.segment_paths()
+        self.next_segment = (
+            int(os.path.basename(paths[-1])[: -len(SEGMENT_SUFFIX)]) + 1
+            if len(paths) > 0
+            else 0
+        )
+        # highest checkpoint in the spool, a restart continues after it.
+        self.last_checkpoint_height: int | None = None
+        for path in paths:
+            for checkpoint_height, _ in self.read_segment(path):
+                self.update_last_checkpoint_height(checkpoint_height)
+
+        # stats
+        self.records_appended = 0
+        self.bytes_appended = 0
+        self.segments_replayed = 0
+
+    def segment_paths(self) -> list[str]:
+        return sorted(
+            [
+                os.path.join(self.directory, x)
+                for x in os.listdir(self.directory)
+                if x.endswith(SEGMENT_SUFFIX)
+            ]
+        )
+
+    def update_last_checkpoint_height(self, checkpoint_height: int | None):
+        if checkpoint_height is None:
+            return
+        if (self.last_checkpoint_height is None) or (
+            checkpoint_height > self.last_checkpoint_height
+        ):
+            self.last_checkpoint_height = checkpoint_height
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return len(self.segment_paths()) == 0
+
+    def append(self, payload: bytes, checkpoint_height: int | None):
+        """
+        Appends a record and syncs it to disk before returning.
+        """
+        header = RECORD_HEADER.pack(
+            len(payload),
+            checkpoint_height if checkpoint_height is not None else -1,
+            zlib.crc32(payload),
+        )
+        with self.lock:
+            if (self.active is None) or (self.active_bytes >= self.segment_bytes):
+                self.close_active_segment()
+                self.active_path = os.path.join(
+                    self.directory, f"{self.next_segment:012d}{SEGMENT_SUFFIX}"
+                )
+                self.next_segment += 1
+                self.active = open(self.active_path, "ab")
+                self.active_bytes = 0
+            self.active.write(header + payload)
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active_bytes += len(header) + len(payload)
+            self.records_appended += 1
+            self.bytes_appended += len(header) + len(payload)
+            self.update_last_checkpoint_height(checkpoint_height)
+
+    def close_active_segment(self):
+        if self.active is not None:
+            self.active.close()
+        self.active = None
+        self.active_path = None
+        self.active_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.close_active_segment()
+
+    def oldest_segment(self) -> str | None:
+        """
+        The oldest segment, to be replayed. If that is the segment we are
+        appending to, it is closed first, new records go to a new segment.
+        """
+        with self.lock:
+            paths = self.segment_paths()
+            if len(paths) == 0:
+                return None
+            if paths[0] == self.active_path:
+                self.close_active_segment()
+            return paths[0]
+
+    def read_segment(self, path: str) -> list[tuple[int | None, bytes]]:
+        records = []
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, checkpoint_height, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if (len(payload) < length) or (zlib.crc32(payload) != crc):
+                    console.log(
+                        f"Spool: incomplete record in {path}, skipping the rest."
+                    )
+                    break
+                records.append(
+                    (checkpoint_height if checkpoint_height >= 0 else None, payload)
+                )
+        return records
+
+    def remove(self, path: str):
+        with self.lock:
+            os.remove(path)
+            self.segments_replayed += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            paths = self.segment_paths()
+            nbytes = sum([os.path.getsize(x) for x in paths])
+        return {
+            "segments": len(paths),
+            "bytes": nbytes,
+            "last_checkpoint_height": self.last_checkpoint_height,
+            "records_appended": self.records_appended,
+            "bytes_appended": self.bytes_appended,
+            "segments_replayed": self.segments_replayed,
+        }
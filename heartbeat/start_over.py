@@ -28,9 +28,10 @@ class StartOver(Utils):
         dd["hash_for_first_block"] = start_block.hash
         dd["hash_for_last_block"] = end_block.hash
 
-        self.queues[Queue.block_per_day].append(
-            ReplaceOne({"_id": date_string}, dd, upsert=True)
-        )
+        with self.queues_lock:
+            self.queues[Queue.block_per_day].append(
+                ReplaceOne({"_id": date_string}, dd, upsert=True)
+            )
 
     def date_range_generator(self, start, end):
         """
@@ -0,0 +1,112 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from .utils import Utils, Stage
+from .batch_controller import BatchMode
+from ccdexplorer_fundamentals.GRPCClient import GRPCClient
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from ccdexplorer_fundamentals.GRPCClient.types_pb2 import Empty
+from ccdexplorer_fundamentals.enums import NET
+from env import *
+import asyncio
+from rich.console import Console
+
+console = Console()
+
+
+class TipFollower(Utils):
+    def read_finalized_blocks_stream(
+        self, loop: asyncio.AbstractEventLoop, stream_queue: asyncio.Queue
+    ):
+        """
+        Runs in a thread. Reads the blocking `GetFinalizedBlocks` stream and
+        hands every finalized block to the event loop. When the stream ends or
+        fails, `None` is put on the queue so the consumer can reconnect.
+        """
+        self.grpcclient: GRPCClient
+        try:
+            self.grpcclient.check_connection(NET(self.net))
+            stub = (
+                self.grpcclient.stub_mainnet
+                if NET(self.net) == NET.MAINNET
+                else self.grpcclient.stub_testnet
+            )
+            # no timeout here, this stream is supposed to stay open.
+            self.finalized_blocks_stream = stub.GetFinalizedBlocks(Empty())
+            for block in self.finalized_blocks_stream:
+                finalized_block = self.grpcclient.convertFinalizedBlock(block)
+                loop.call_soon_threadsafe(stream_queue.put_nowait, finalized_block)
+        except Exception as e:
+            console.log(f"Finalized blocks stream on {self.net} stopped: {e}")
+        finally:
+            self.finalized_blocks_stream = None
+            loop.call_soon_threadsafe(stream_queue.put_nowait, None)
+
+    async def follow_finalized_blocks(self):
+        """
+        Tip mode. Subscribes to the node's finalized blocks stream and adds
+        new blocks to `finalized_block_infos_to_process` as soon as they are
+        finalized. If the stream skips heights (or we reconnect after a drop),
+        the missing heights are backfilled through the `block_fetcher`.
+        If `batch_controller` says we are catching up, we leave it
+        to `get_finalized_blocks`.
+        """
+        loop = asyncio.get_running_loop()
+        reconnect_delay = 1
+        while True:
+            stream_queue: asyncio.Queue = asyncio.Queue()
+            reader = loop.run_in_executor(
+                None, self.read_finalized_blocks_stream, loop, stream_queue
+            )
+
+            while True:
+                finalized_block: CCD_FinalizedBlockInfo = await stream_queue.get()
+                if finalized_block is None:
+                    break
+                reconnect_delay = 1
+
+                # the stream may have delivered multiple blocks while we were busy,
+                # only the most recent one matters.
+                while not stream_queue.empty():
+                    next_in_stream = stream_queue.get_nowait()
+                    if next_in_stream is None:
+                        stream_queue.put_nowait(None)
+                        break
+                    finalized_block = next_in_stream
+
+                self.batch_controller.update_chain_height(finalized_block.height)
+                async with self.fetch_lock:
+                    height_to_request = await self.run_in_stage(
+                        Stage.io, self.next_height_to_request
+                    )
+                    blocks_to_request = finalized_block.height - height_to_request + 1
+                    self.batch_controller.update_lag(height_to_request)
+                    if blocks_to_request <= 0:
+                        continue
+
+                    if (
+                        self.batch_controller.mode == BatchMode.catch_up
+                        or blocks_to_request > self.pending_blocks_room()
+                    ):
+                        if self.following_tip:
+                            console.log(
+                                f"Tip mode: {blocks_to_request:,.0f} blocks behind, catching up through polling."
+                            )
+                        self.following_tip = False
+                        continue
+
+                    finalized_block_infos = await self.fetch_blocks(
+                        height_to_request, blocks_to_request
+                    )
+
+                    if not self.following_tip:
+                        console.log(
+                            f"Tip mode: following finalized blocks stream on {self.net} from {finalized_block.height:,.0f}."
+                        )
+                    self.following_tip = len(finalized_block_infos) == blocks_to_request
+
+            await reader
+            self.following_tip = False
+            console.log(
+                f"Tip mode: reconnecting to finalized blocks stream in {reconnect_delay} sec."
+            )
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, 30)
@@ -1,5 +1,6 @@
 # ruff: noqa: F403, F405, E402, E501, E722
-from .utils import Utils, Queue
+from .utils import Utils, Queue, Stage
+from .logged_event_stream import StreamedLoggedEvent
 from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
 from ccdexplorer_fundamentals.mongodb import (
     Collections,
@@ -20,8 +21,9 @@ from ccdexplorer_fundamentals.cis import (
 )
 import aiohttp
 from itertools import chain
-from pymongo import ReplaceOne, ASCENDING, DeleteOne
+from pymongo import ReplaceOne, ASCENDING, DeleteOne, UpdateOne
 from pymongo.collection import Collection
+from env import *
 import requests
 from datetime import timezone
 from rich.console import Console
@@ -31,6 +33,34 @@ import asyncio
 console = Console()
 
 
+def discard_future(future: asyncio.Future):
+    """
+    Cancels a read that is no longer needed, without logging its result.
+    """
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    future.cancel()
+
+
+def partition_token_addresses(
+    events_by_token_address: dict[str, list], partitions: int
+) -> list[list[str]]:
+    """
+    Splits token addresses in at most `partitions` partitions with about the
+    same number of events, the busiest token addresses are placed first.
+    """
+    result: list[list[str]] = [[] for _ in range(max(1, partitions))]
+    load = [0] * len(result)
+    for token_address in sorted(
+        events_by_token_address,
+        key=lambda x: len(events_by_token_address[x]),
+        reverse=True,
+    ):
+        index = load.index(min(load))
+        result[index].append(token_address)
+        load[index] += len(events_by_token_address[token_address])
+    return [x for x in result if len(x) > 0]
+
+
 ########### Token Accounting
 class TokenAccounting(Utils):
     async def get_domain_name_from_metadata(self, dom: MongoTypeTokenAddress):
@@ -53,150 +83,354 @@ class TokenAccounting(Utils):
         'token_accounting_last_processed_block', if that is either
         not there or set to -1, all token_addresses (and associated
         token_accounts) will be reset.
+        Logged events are read in pages of whole blocks (see
+        `LoggedEventStream`) on the io stage, the next page is read while
+        the current page is accounted for.
+        With `TOKEN_ACCOUNTING_PARTITIONS` > 1, the token addresses of a
+        page are accounted for in parallel partitions.
         """
-        self.db: dict[Collections, Collection]
+        # the next page: (the checkpoint it was read after, future).
+        prefetched: tuple[int, asyncio.Future] | None = None
         while True:
+            result = []
             try:
-                start = dt.datetime.now()
-                # Read token_accounting_last_processed_block
-                result = self.db[Collections.helpers].find_one(
-                    {"_id": "token_accounting_last_processed_block_v2"}
+                token_accounting_last_processed_block = await self.run_in_stage(
+                    Stage.io, self.read_token_accounting_checkpoint
                 )
-                # If it's not set, set to -1, which leads to resetting
-                # all token addresses and accounts, basically starting
-                # over with token accounting.
-                if result:
-                    token_accounting_last_processed_block = result["height"]
+                if (prefetched is not None) and (
+                    prefetched[0] == token_accounting_last_processed_block
+                ):
+                    self.logged_event_stream.prefetch_hits += 1
+                    result = await prefetched[1]
                 else:
-                    token_accounting_last_processed_block = -1
-
-                # Query the logged events collection for all logged events
-                # after 'token_accounting_last_processed_block'.
-                # Logged events are ordered by block_height, then by
-                # transaction index (tx_index) and finally by event index
-                # (ordering).
-                result: list[MongoTypeLoggedEvent] = [
-                    MongoTypeLoggedEvent(**x)
-                    for x in self.db[Collections.tokens_logged_events]
-                    .find(
-                        {"block_height": {"$gt": token_accounting_last_processed_block}}
-                    )
-                    .sort(
-                        [
-                            ("block_height", ASCENDING),
-                            ("tx_index", ASCENDING),
-                            ("ordering", ASCENDING),
-                        ]
+                    # nothing read ahead, or the checkpoint was changed by
+                    # others (a reset to -1).
+                    if prefetched is not None:
+                        discard_future(prefetched[1])
+                        self.logged_event_stream.prefetch_misses += 1
+                    result = await self.run_in_stage(
+                        Stage.io,
+                        self.read_logged_events_page,
+                        token_accounting_last_processed_block,
                     )
-                    .limit(1000)
-                ]
+                prefetched = None
 
-                # Only continue if there are logged events to process...
                 if len(result) > 0:
-                    # When all logged events are processed,
-                    # 'token_accounting_last_processed_block' is set to
-                    # 'token_accounting_last_processed_block_when_done'
-                    # such that next iteration, we will not be re-processing
-                    # logged events we already have processed.
-                    token_accounting_last_processed_block_when_done = max(
-                        [x.block_height for x in result]
+                    # the page ends with a whole block, the checkpoint moves
+                    # to it once the page is accounted for.
+                    token_accounting_last_processed_block_when_done = result[
+                        -1
+                    ].block_height
+                    prefetched = (
+                        token_accounting_last_processed_block_when_done,
+                        asyncio.ensure_future(
+                            self.run_in_stage(
+                                Stage.io,
+                                self.read_logged_events_page,
+                                token_accounting_last_processed_block_when_done,
+                            )
+                        ),
                     )
 
-                    # Dict 'events_by_token_address' is keyed on token_address
-                    # and contains an ordered list of logged events related to
-                    # this token_address.
-                    events_by_token_address: dict[str, list] = {}
-                    for log in result:
-                        events_by_token_address[log.token_address] = (
-                            events_by_token_address.get(log.token_address, [])
+                    start = dt.datetime.now()
+                    if TOKEN_ACCOUNTING_PARTITIONS > 1:
+                        await self.run_token_accounting_partitioned(
+                            token_accounting_last_processed_block, result
                         )
-                        events_by_token_address[log.token_address].append(log)
-
-                    console.log(
-                        f"Token accounting: Starting at {(token_accounting_last_processed_block+1):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process from {len(list(events_by_token_address.keys())):,.0f} token addresses."
-                    )
-
-                    # Looping through all token_addresses that have logged_events
-
-                    # Retrieve the token_addresses for all from the collection
-                    token_addresses_as_class_from_collection = {
-                        x["_id"]: MongoTypeTokenAddress(**x)
-                        for x in self.db[Collections.tokens_token_addresses_v2].find(
-                            {"_id": {"$in": list(events_by_token_address.keys())}}
-                        )
-                    }
-
-                    # Retrieve all current links for this set of token_addresses.
-                    token_links_from_collection_result = list(
-                        self.db[Collections.tokens_links_v2].find(
-                            {
-                                "token_holding.token_address": {
-                                    "$in": list(events_by_token_address.keys())
-                                }
-                            }
-                        )
-                    )
-                    token_links_from_collection_by_token_address = {}
-                    for link in token_links_from_collection_result:
-                        link_token_address = link["token_holding"]["token_address"]
-                        link_account_address = link["account_address"]
-                        if not token_links_from_collection_by_token_address.get(
-                            link_token_address
-                        ):
-                            token_links_from_collection_by_token_address[
-                                link_token_address
-                            ] = {}
-
-                        # Double dict, so first lookup token address, then account address.
-                        token_links_from_collection_by_token_address[
-                            link_token_address
-                        ][link_account_address] = MongoTypeTokenLink(**link)
-
-                    for index, token_address in enumerate(
-                        list(events_by_token_address.keys())
-                    ):
-                        self.token_accounting_for_token_address(
-                            token_address,
-                            events_by_token_address,
-                            token_addresses_as_class_from_collection,
-                            token_links_from_collection_by_token_address,
+                    else:
+                        await self.run_in_stage(
+                            Stage.accounting,
+                            self.run_token_accounting,
                             token_accounting_last_processed_block,
+                            result,
                         )
-
-                    self.send_token_queues_to_mongo(0)
-                    self.log_last_token_accounted_message_in_mongo(
-                        token_accounting_last_processed_block_when_done
-                    )
-                    end = dt.datetime.now()
-                    console.log(
-                        f"update token accounting for {len(result):,.0f} events took {(end-start).total_seconds():,.3f}s"
+                    self.logged_event_stream.record(
+                        len(result), (dt.datetime.now() - start).total_seconds()
                     )
             except Exception as e:
                 console.log(e)
+                if prefetched is not None:
+                    discard_future(prefetched[1])
+                    prefetched = None
+                result = []
 
-            await asyncio.sleep(1)
+            # keep going while there are events to process.
+            if len(result) == 0:
+                await asyncio.sleep(1)
 
-    def send_token_queues_to_mongo(self, limit: int = 0):
-        self.queues: dict[Collections, list]
-        if len(self.queues[Queue.token_addresses]) > limit:
-            _ = self.db[Collections.tokens_token_addresses_v2].bulk_write(
-                self.queues[Queue.token_addresses]
+    def read_token_accounting_checkpoint(self) -> int:
+        self.db: dict[Collections, Collection]
+        # Read token_accounting_last_processed_block
+        result = self.db[Collections.helpers].find_one(
+            {"_id": "token_accounting_last_processed_block_v2"}
+        )
+        # If it's not set, set to -1, which leads to resetting
+        # all token addresses and accounts, basically starting
+        # over with token accounting.
+        if result:
+            return result["height"]
+        else:
+            return -1
+
+    def read_logged_events_page(
+        self, token_accounting_last_processed_block: int
+    ) -> list[StreamedLoggedEvent]:
+        """
+        The logged events after 'token_accounting_last_processed_block',
+        ordered by block_height, then by transaction index (tx_index) and
+        finally by event index (ordering). Only blocks that heartbeat has
+        stored completely (`last_stored_height`) are read.
+        """
+        return self.logged_event_stream.read_page(
+            self.db[Collections.tokens_logged_events],
+            token_accounting_last_processed_block,
+            self.last_stored_height,
+        )
+
+    def group_events_by_token_address(
+        self, result: list[StreamedLoggedEvent]
+    ) -> dict[str, list]:
+        # Dict 'events_by_token_address' is keyed on token_address
+        # and contains an ordered list of logged events related to
+        # this token_address.
+        events_by_token_address: dict[str, list] = {}
+        for log in result:
+            events_by_token_address[log.token_address] = events_by_token_address.get(
+                log.token_address, []
             )
+            events_by_token_address[log.token_address].append(log)
+        return events_by_token_address
+
+    def run_token_accounting(
+        self,
+        token_accounting_last_processed_block: int,
+        result: list[StreamedLoggedEvent],
+    ):
+        start = dt.datetime.now()
+        # When all logged events are processed,
+        # 'token_accounting_last_processed_block' is set to
+        # 'token_accounting_last_processed_block_when_done'
+        # such that next iteration, we will not be re-processing
+        # logged events we already have processed.
+        token_accounting_last_processed_block_when_done = max(
+            [x.block_height for x in result]
+        )
+        events_by_token_address = self.group_events_by_token_address(result)
+
+        console.log(
+            f"Token accounting: Starting at {(token_accounting_last_processed_block+1):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process from {len(list(events_by_token_address.keys())):,.0f} token addresses."
+        )
+
+        if token_accounting_last_processed_block == -1:
+            # starting over, nothing in the ledger is valid.
+            self.token_ledger.clear()
+
+        # Looping through all token_addresses that have logged_events
+        self.account_for_token_addresses(
+            list(events_by_token_address.keys()),
+            events_by_token_address,
+            token_accounting_last_processed_block,
+        )
+
+        self.log_last_token_accounted_message_in_mongo(
+            token_accounting_last_processed_block_when_done
+        )
+        end = dt.datetime.now()
+        console.log(
+            f"update token accounting for {len(result):,.0f} events took {(end-start).total_seconds():,.3f}s"
+        )
+
+    async def run_token_accounting_partitioned(
+        self,
+        token_accounting_last_processed_block: int,
+        result: list[StreamedLoggedEvent],
+    ):
+        """
+        As `run_token_accounting`, but the token addresses of the page are
+        split in `TOKEN_ACCOUNTING_PARTITIONS` partitions that are accounted
+        for and written in parallel on the partitions stage (sized to the
+        number of partitions). Token addresses share no state, so partitions
+        are independent. The checkpoint only moves when every partition has
+        been written.
+        """
+        start = dt.datetime.now()
+        token_accounting_last_processed_block_when_done = max(
+            [x.block_height for x in result]
+        )
+        events_by_token_address = self.group_events_by_token_address(result)
+        partitions = partition_token_addresses(
+            events_by_token_address, TOKEN_ACCOUNTING_PARTITIONS
+        )
+        console.log(
+            f"Token accounting: Starting at {(token_accounting_last_processed_block+1):,.0f}, I found {len(result):,.0f} logged events on {self.net} to process from {len(list(events_by_token_address.keys())):,.0f} token addresses in {len(partitions):,.0f} partitions."
+        )
+
+        if token_accounting_last_processed_block == -1:
+            # starting over, nothing in the ledger is valid.
+            self.token_ledger.clear()
+
+        results = await asyncio.gather(
+            *[
+                self.run_in_stage(
+                    Stage.partitions,
+                    self.account_for_token_addresses,
+                    partition,
+                    events_by_token_address,
+                    token_accounting_last_processed_block,
+                )
+                for partition in partitions
+            ],
+            return_exceptions=True,
+        )
+        errors = [x for x in results if isinstance(x, BaseException)]
+        if len(errors) > 0:
+            # partitions that were written are skipped when the batch is
+            # retried, see `token_accounting_for_token_address`.
             console.log(
-                f"Updated accounting for {len(self.queues[Queue.token_addresses])} token addresses."
+                f"Token accounting: {len(errors):,.0f} of {len(partitions):,.0f} partitions failed, not moving the checkpoint."
             )
+            raise errors[0]
 
-            self.queues[Queue.token_addresses] = []
+        await self.run_in_stage(
+            Stage.accounting,
+            self.log_last_token_accounted_message_in_mongo,
+            token_accounting_last_processed_block_when_done,
+        )
+        end = dt.datetime.now()
+        console.log(
+            f"update token accounting for {len(result):,.0f} events in {len(partitions):,.0f} partitions took {(end-start).total_seconds():,.3f}s"
+        )
 
-        if len(self.queues[Queue.token_links]) > limit:
+    def account_for_token_addresses(
+        self,
+        token_addresses: list[str],
+        events_by_token_address: dict,
+        token_accounting_last_processed_block: int,
+    ):
+        """
+        Accounts for `token_addresses` (a batch, or a partition of one) and
+        writes the result. The token addresses are locked until written, so
+        a redo can't be marked or run for them in between.
+        """
+        queues = {Queue.token_addresses: [], Queue.token_links: []}
+        with self.token_address_locks.hold(token_addresses):
+            self.account_for_locked_token_addresses(
+                token_addresses,
+                events_by_token_address,
+                token_accounting_last_processed_block,
+                queues,
+            )
+
+    def account_for_locked_token_addresses(
+        self,
+        token_addresses: list[str],
+        events_by_token_address: dict,
+        token_accounting_last_processed_block: int,
+        queues: dict[Queue, list],
+    ):
+        try:
+            if token_accounting_last_processed_block == -1:
+                token_addresses_as_class = {}
+            else:
+                token_addresses_as_class = self.token_addresses_for_accounting(
+                    token_addresses
+                )
+
+            for token_address in token_addresses:
+                self.token_accounting_for_token_address(
+                    token_address,
+                    events_by_token_address,
+                    token_addresses_as_class,
+                    token_accounting_last_processed_block,
+                    queues,
+                )
+
+            self.send_token_queues_to_mongo(0, queues)
+        except:
+            # the ledger may now be ahead of what is stored.
+            for token_address in token_addresses:
+                self.token_ledger.invalidate(token_address)
+            raise
+
+    def token_addresses_for_accounting(
+        self, token_addresses: list[str]
+    ) -> dict[str, MongoTypeTokenAddress]:
+        """
+        Token addresses with their current `token_holders`, from the token
+        ledger. Only token addresses that are not in the ledger are read
+        from the token addresses and links collections. The supply and
+        balances are ints while accounting, see `mongo_save_for_token_address`
+        and `copy_token_holders_to_links` for the stored str form.
+        """
+        token_addresses_as_class: dict[str, MongoTypeTokenAddress] = {}
+        misses = []
+        for token_address in token_addresses:
+            token_address_as_class = self.token_ledger.get(token_address)
+            if token_address_as_class is None:
+                misses.append(token_address)
+            else:
+                token_addresses_as_class[token_address] = token_address_as_class
+
+        if len(misses) == 0:
+            return token_addresses_as_class
+
+        for x in self.db[Collections.tokens_token_addresses_v2].find(
+            {"_id": {"$in": misses}}
+        ):
+            token_address_as_class = MongoTypeTokenAddress(**x)
+            token_address_as_class.token_amount = int(
+                token_address_as_class.token_amount
+            )
+            token_address_as_class.token_holders = {}
+            token_addresses_as_class[token_address_as_class.id] = token_address_as_class
+
+        # Retrieve all current links for the token addresses we had to read.
+        for link in self.db[Collections.tokens_links_v2].find(
+            {"token_holding.token_address": {"$in": misses}},
+            {
+                "account_address": 1,
+                "token_holding.token_address": 1,
+                "token_holding.token_amount": 1,
+            },
+        ):
+            token_address_as_class = token_addresses_as_class.get(
+                link["token_holding"]["token_address"]
+            )
+            if token_address_as_class is not None:
+                token_address_as_class.token_holders[link["account_address"]] = int(
+                    link["token_holding"]["token_amount"]
+                )
+
+        return token_addresses_as_class
+
+    def send_token_queues_to_mongo(
+        self, limit: int = 0, queues: dict[Queue, list] | None = None
+    ):
+        """
+        Links are written before the token addresses, so a token address with
+        a new `last_height_processed` also has its links written.
+        """
+        if queues is None:
+            queues = self.queues
+        if len(queues[Queue.token_links]) > limit:
             _ = self.db[Collections.tokens_links_v2].bulk_write(
-                self.queues[Queue.token_links]
+                queues[Queue.token_links]
+            )
+            console.log(
+                f"Updated accounting for {len(queues[Queue.token_links])} token links."
+            )
+
+            queues[Queue.token_links] = []
+
+        if len(queues[Queue.token_addresses]) > limit:
+            _ = self.db[Collections.tokens_token_addresses_v2].bulk_write(
+                queues[Queue.token_addresses]
             )
             console.log(
-                f"Updated accounting for {len(self.queues[Queue.token_links])} token links."
+                f"Updated accounting for {len(queues[Queue.token_addresses])} token addresses."
             )
 
-            self.queues[Queue.token_links] = []
+            queues[Queue.token_addresses] = []
 
     async def special_purpose_token_accounting(self):
         """
@@ -208,103 +442,76 @@ class TokenAccounting(Utils):
         """
         while True:
             try:
-                result = [
-                    MongoTypeTokenAddress(**x)
-                    for x in self.db[Collections.tokens_token_addresses_v2].find(
-                        {"last_height_processed": -1}
-                    )
-                ]
+                await self.run_in_stage(
+                    Stage.accounting, self.run_special_purpose_token_accounting
+                )
+            except Exception as e:
+                console.log(e)
 
-                token_addresses_to_process = [x.id for x in result]
-
-                # Logged events are ordered by block_height, then by
-                # transaction index (tx_index) and finally by event index
-                # (ordering).
-                for token_address in token_addresses_to_process:
-                    events_for_token_address = [
-                        MongoTypeLoggedEvent(**x)
-                        for x in self.db[Collections.tokens_logged_events]
-                        .find({"token_address": token_address})
-                        .sort(
-                            [
-                                ("block_height", ASCENDING),
-                                ("tx_index", ASCENDING),
-                                ("ordering", ASCENDING),
-                            ]
-                        )
+            await asyncio.sleep(10)
+
+    def run_special_purpose_token_accounting(self):
+        result = [
+            MongoTypeTokenAddress(**x)
+            for x in self.db[Collections.tokens_token_addresses_v2].find(
+                {"last_height_processed": -1}
+            )
+        ]
+
+        token_addresses_to_process = [x.id for x in result]
+
+        # Logged events are ordered by block_height, then by
+        # transaction index (tx_index) and finally by event index
+        # (ordering).
+        for token_address in token_addresses_to_process:
+            events_for_token_address = [
+                MongoTypeLoggedEvent(**x)
+                for x in self.db[Collections.tokens_logged_events]
+                .find({"token_address": token_address})
+                .sort(
+                    [
+                        ("block_height", ASCENDING),
+                        ("tx_index", ASCENDING),
+                        ("ordering", ASCENDING),
                     ]
-                    events_by_token_address = {}
-                    events_by_token_address[token_address] = events_for_token_address
-                    # Only continue if there are logged events to process...
-                    if len(events_for_token_address) > 0:
-                        # When all logged events are processed,
-                        # 'token_accounting_last_processed_block' is set to
-                        # 'token_accounting_last_processed_block_when_done'
-                        # such that next iteration, we will not be re-processing
-                        # logged events we already have processed.
-                        # token_accounting_last_processed_block_when_done = max(
-                        #     [x.block_height for x in events_for_token_address]
-                        # )
-
-                        console.log(
-                            f"Token accounting for Special purpose: Redo {token_address} with {len(events_for_token_address):,.0f} logged events on {self.net}."
-                        )
+                )
+            ]
+            events_by_token_address = {}
+            events_by_token_address[token_address] = events_for_token_address
+            # Only continue if there are logged events to process...
+            if len(events_for_token_address) > 0:
+                # When all logged events are processed,
+                # 'token_accounting_last_processed_block' is set to
+                # 'token_accounting_last_processed_block_when_done'
+                # such that next iteration, we will not be re-processing
+                # logged events we already have processed.
+                # token_accounting_last_processed_block_when_done = max(
+                #     [x.block_height for x in events_for_token_address]
+                # )
 
-                        # Retrieve the token_addresses for all from the collection
-                        token_addresses_as_class_from_collection = {
-                            x["_id"]: MongoTypeTokenAddress(**x)
-                            for x in self.db[
-                                Collections.tokens_token_addresses_v2
-                            ].find(
-                                {"_id": {"$in": list(events_by_token_address.keys())}}
-                            )
-                        }
-                        # Retrieve all current links for this set of token_addresses.
-                        token_links_from_collection_result = list(
-                            self.db[Collections.tokens_links_v2].find(
-                                {
-                                    "token_holding.token_address": {
-                                        "$in": list(events_by_token_address.keys())
-                                    }
-                                }
-                            )
-                        )
-                        token_links_from_collection_by_token_address = {}
-                        for link in token_links_from_collection_result:
-                            link_token_address = link["token_holding"]["token_address"]
-                            link_account_address = link["account_address"]
-                            if not token_links_from_collection_by_token_address.get(
-                                link_token_address
-                            ):
-                                token_links_from_collection_by_token_address[
-                                    link_token_address
-                                ] = {}
-
-                            # Double dict, so first lookup token address, then account address.
-                            token_links_from_collection_by_token_address[
-                                link_token_address
-                            ][link_account_address] = MongoTypeTokenLink(**link)
-
-                        # token_accounts_from_collection = {
-                        #     x["_id"]: MongoTypeTokenHolderAddress(**x)
-                        #     for x in self.db[Collections.tokens_accounts].find({})
-                        # }
-                        # Looping through all token_addresses that have logged_events
-                        # for log in events_for_token_address:
+                console.log(
+                    f"Token accounting for Special purpose: Redo {token_address} with {len(events_for_token_address):,.0f} logged events on {self.net}."
+                )
+
+                # Starting over for this token address, so nothing needs to
+                # be read, the ledger entry is replaced with the result. The
+                # links are deleted and rewritten while main accounting waits
+                # for this token address.
+                queues = {Queue.token_addresses: [], Queue.token_links: []}
+                with self.token_address_locks.hold([token_address]):
+                    self.token_ledger.invalidate(token_address)
+                    try:
                         self.token_accounting_for_token_address(
                             token_address,
                             events_by_token_address,
-                            token_addresses_as_class_from_collection,
-                            token_links_from_collection_by_token_address,
+                            {},
                             -1,
+                            queues,
                         )
-
-                    self.send_token_queues_to_mongo(0)
-
-            except Exception as e:
-                console.log(e)
-
-            await asyncio.sleep(10)
+                        self.send_token_queues_to_mongo(0, queues)
+                    except:
+                        self.token_ledger.invalidate(token_address)
+                        raise
 
     async def get_redo_token_addresses(self):
         """
@@ -312,58 +519,74 @@ class TokenAccounting(Utils):
         token accounting redone.
         """
         while True:
-            result = self.db[Collections.helpers].find_one(
-                {"_id": "redo_token_addresses"}
-            )
-            if result:
-                # this is the address we are going to print account statements from during the token accounting
-                # useful to redo a token address and see the impact on this account
-                self.address_to_follow = result.get("address_to_follow")
-
-                # looping over all token addresses we have listed in the helper to redo.
-                for token_address in result["token_addresses"]:
-                    request_result = self.db[
-                        Collections.tokens_token_addresses_v2
-                    ].find_one({"_id": token_address})
-                    if request_result:
-                        token_address_as_class = MongoTypeTokenAddress(**request_result)
-                    else:
-                        token_address_as_class = self.create_new_token_address(
-                            token_address
-                        )
-                    # update the last_height_processed to -1, this will trigger
-                    # a redo of the token accounting.
-                    token_address_as_class.last_height_processed = -1
+            await self.run_in_stage(Stage.accounting, self.mark_redo_token_addresses)
+            await asyncio.sleep(10)
 
-                    # Write the token_address_as_class back to the collection.
-                    _ = self.db[Collections.tokens_token_addresses_v2].bulk_write(
-                        [self.mongo_save_for_token_address(token_address_as_class)]
+    def mark_redo_token_addresses(self):
+        result = self.db[Collections.helpers].find_one({"_id": "redo_token_addresses"})
+        if result:
+            # this is the address we are going to print account statements from during the token accounting
+            # useful to redo a token address and see the impact on this account
+            self.address_to_follow = result.get("address_to_follow")
+
+            # looping over all token addresses we have listed in the helper to redo.
+            for token_address in result["token_addresses"]:
+                # wait for accounting that holds this token address to be
+                # written, else it would overwrite the marker below.
+                with self.token_address_locks.hold([token_address]):
+                    self.mark_redo_token_address(token_address)
+
+            _ = self.db[Collections.helpers].bulk_write(
+                [
+                    ReplaceOne(
+                        {"_id": "redo_token_addresses"},
+                        replacement={
+                            "token_addresses": [],
+                            "address_to_follow": result.get("address_to_follow"),
+                        },
+                        upsert=True,
                     )
+                ]
+            )
 
-                _ = self.db[Collections.helpers].bulk_write(
-                    [
-                        ReplaceOne(
-                            {"_id": "redo_token_addresses"},
-                            replacement={
-                                "token_addresses": [],
-                                "address_to_follow": result.get("address_to_follow"),
-                            },
-                            upsert=True,
-                        )
-                    ]
-                )
-            await asyncio.sleep(10)
+    def mark_redo_token_address(self, token_address: str):
+        request_result = self.db[Collections.tokens_token_addresses_v2].find_one(
+            {"_id": token_address}
+        )
+        if request_result:
+            token_address_as_class = MongoTypeTokenAddress(**request_result)
+        else:
+            token_address_as_class = self.create_new_token_address(token_address)
+        # update the last_height_processed to -1, this will trigger
+        # a redo of the token accounting.
+        token_address_as_class.last_height_processed = -1
+        self.token_ledger.invalidate(token_address)
+
+        # Write the token_address_as_class back to the collection.
+        _ = self.db[Collections.tokens_token_addresses_v2].bulk_write(
+            [self.mongo_save_for_token_address(token_address_as_class)]
+        )
 
     def token_accounting_for_token_address(
         self,
         token_address: str,
         events_by_token_address: dict,
-        token_addresses_as_class_from_collection: dict,
-        token_links_from_collection_by_token_address: dict,
+        token_addresses_as_class: dict[str, MongoTypeTokenAddress],
         token_accounting_last_processed_block: int = -1,
+        queues: dict[Queue, list] | None = None,
     ):
+        """
+        Applies the logged events for `token_address` to its token address
+        (with `token_holders`, see `token_addresses_for_accounting`), queues
+        the writes (in `queues`, default `self.queues`) and keeps the result
+        in the token ledger.
+        """
         self.queues: dict[Collections, list]
+        if queues is None:
+            queues = self.queues
         queue = []
+        # This is the list of logged events for the selected token_address
+        logs_for_token_address = events_by_token_address[token_address]
         # if we start at the beginning of the chain for token accounting
         # create an empty token address as class to start
         if token_accounting_last_processed_block == -1:
@@ -377,42 +600,38 @@ class TokenAccounting(Utils):
             )
 
         else:
-            # Retrieve the token_address document from the collection
-            token_address_as_class = token_addresses_as_class_from_collection.get(
-                token_address
-            )
+            # The token address with its current token holders.
+            token_address_as_class = token_addresses_as_class.get(token_address)
 
             # If it's not there, create an new token_address
             if not token_address_as_class:
                 token_address_as_class = self.create_new_token_address(token_address)
-            else:
-                # make sure the token_address_as_call is actually typed correctly.
-                if type(token_address_as_class) is not MongoTypeTokenAddress:
-                    token_address_as_class = MongoTypeTokenAddress(
-                        **token_address_as_class
-                    )
-                # Need to read in the current token holders from the links collection
-                current_token_holders = (
-                    token_links_from_collection_by_token_address.get(token_address)
-                )
-                if current_token_holders:
-                    token_address_as_class.token_holders = {
-                        x.account_address: x.token_holding.token_amount
-                        for x in token_links_from_collection_by_token_address.get(
-                            token_address
-                        ).values()
-                    }
-                else:
-                    token_address_as_class.token_holders = {}
-
-        # This is the list of logged events for the selected token_address
-        logs_for_token_address = events_by_token_address[token_address]
+            elif token_address_as_class.last_height_processed == -1:
+                # marked for a redo, special purpose accounting replays all
+                # its logged events (these included), so the marker is kept.
+                return
+
+            # Events this token address has already processed are not applied
+            # again. A batch is retried after a partition failed, while others
+            # were written, and a redo may have processed newer events.
+            logs_for_token_address = [
+                x
+                for x in logs_for_token_address
+                if x.block_height > token_address_as_class.last_height_processed
+            ]
+            if len(logs_for_token_address) == 0:
+                return
+
+        # The holders whose balance changed in this run, only their links
+        # are written.
+        changed_holders = set()
         for log in logs_for_token_address:
             # Perform token accounting for this logged event
             # This function works on and returns 'token_address_as_class'.
             token_address_as_class = self.execute_logged_event(
                 token_address_as_class,
                 log,
+                changed_holders,
             )
 
         # Set the last block_height that affected the token accounting
@@ -420,29 +639,41 @@ class TokenAccounting(Utils):
         token_address_as_class.last_height_processed = log.block_height
 
         queue = self.copy_token_holders_to_links(
-            token_address_as_class, token_links_from_collection_by_token_address
+            token_address_as_class, changed_holders
         )
-        self.queues[Queue.token_links].extend(queue)
+        queues[Queue.token_links].extend(queue)
+        # links of holders with a zero balance are deleted, so these are
+        # not kept in the ledger either.
+        for address in changed_holders:
+            if token_address_as_class.token_holders.get(address, 0) == 0:
+                token_address_as_class.token_holders.pop(address, None)
 
         # Write the token_address_as_class back to the collection.
         # now token holders information is stored in links
-        self.queues[Queue.token_addresses].append(
-            self.mongo_save_for_token_address(token_address_as_class)
-        )
-        #
+        if token_accounting_last_processed_block == -1:
+            queues[Queue.token_addresses].append(
+                self.mongo_save_for_token_address(token_address_as_class)
+            )
+        else:
+            queues[Queue.token_addresses].append(
+                self.mongo_update_for_token_address(token_address_as_class)
+            )
+        self.token_ledger.set(token_address_as_class)
 
     def mongo_save_for_token_address(
         self, token_address_as_class: MongoTypeTokenAddress
     ):
-        repl_dict = token_address_as_class.model_dump(exclude_none=True)
+        # token holders are only an intermediate result, actual holdings
+        # are stored in the link collection. The supply is stored as str.
+        repl_dict = token_address_as_class.model_copy(
+            update={
+                "token_amount": str(token_address_as_class.token_amount),
+                "token_holders": None,
+            }
+        ).model_dump(exclude_none=True)
         if "id" in repl_dict:
             del repl_dict["id"]
 
-        # remove token holders again, as that's only an intermediate result.
-        # actual holding are stored in the link collection.
-        if "token_holders" in repl_dict:
-            del repl_dict["token_holders"]
-
         queue_item = ReplaceOne(
             {"_id": token_address_as_class.id},
             replacement=repl_dict,
@@ -450,32 +681,56 @@ class TokenAccounting(Utils):
         )
         return queue_item
 
+    def mongo_update_for_token_address(
+        self, token_address_as_class: MongoTypeTokenAddress
+    ):
+        """
+        Only sets the fields token accounting owns. The token address may come
+        from the token ledger, other fields (metadata, tags) can have been
+        written since it was read and must not be overwritten.
+        """
+        set_dict = {
+            "token_amount": str(token_address_as_class.token_amount),
+            "last_height_processed": token_address_as_class.last_height_processed,
+        }
+        if token_address_as_class.metadata_url is not None:
+            set_dict["metadata_url"] = token_address_as_class.metadata_url
+
+        queue_item = UpdateOne(
+            {"_id": token_address_as_class.id},
+            {
+                "$set": set_dict,
+                "$setOnInsert": {
+                    "contract": token_address_as_class.contract,
+                    "token_id": token_address_as_class.token_id,
+                    "hidden": False,
+                },
+            },
+            upsert=True,
+        )
+        return queue_item
+
     def copy_token_holders_to_links(
         self,
         token_address_as_class: MongoTypeTokenAddress,
-        token_links_from_collection_by_token_address: dict,
+        changed_holders: set | None = None,
     ):
+        """
+        Link writes for the holders in `changed_holders` (all holders if
+        None), holders with a zero balance have their link deleted.
+        """
         _queue = []
-        for address, token_amount in token_address_as_class.token_holders.items():
-            # address_to_save = self.db[Collections.tokens_accounts].find_one(
-            #     {"_id": address}
-            # )
-            account_address_to_save = token_links_from_collection_by_token_address.get(
-                address
+        if changed_holders is None:
+            changed_holders = token_address_as_class.token_holders.keys()
+        for address in changed_holders:
+            token_amount = token_address_as_class.token_holders.get(address, 0)
+            link_to_save = MongoTypeTokenLink(
+                **{
+                    "_id": f"{token_address_as_class.id}-{address}",
+                    "account_address": address,
+                    "account_address_canonical": address[:29],
+                }
             )
-            # if this account does not exist yet, create empty dict.
-            if not account_address_to_save:
-                link_to_save = MongoTypeTokenLink(
-                    **{
-                        "_id": f"{token_address_as_class.id}-{address}",
-                        "account_address": address,
-                        "account_address_canonical": address[:29],
-                        # "token_holding": address_as_class,
-                    }
-                )
-            else:
-                if type(link_to_save) is not MongoTypeTokenHolderAddress:
-                    link_to_save = MongoTypeTokenHolderAddress(**link_to_save)
 
             token_to_save = MongoTypeTokenForAddress(
                 **{
@@ -492,7 +747,7 @@ class TokenAccounting(Utils):
             if "id" in repl_dict:
                 del repl_dict["id"]
 
-            if int(token_amount) == 0:
+            if token_amount == 0:
                 queue_item = DeleteOne({"_id": link_to_save.id})
             else:
                 queue_item = ReplaceOne(
@@ -513,21 +768,21 @@ class TokenAccounting(Utils):
 
                 if result.tag == 254:
                     after_value = str(
-                        int(token_holders.get(address, "0")) + result.token_amount
+                        token_holders.get(address, 0) + result.token_amount
                     )
                 if result.tag == 253:
                     after_value = str(
-                        int(token_holders.get(address, "0")) - result.token_amount
+                        token_holders.get(address, 0) - result.token_amount
                     )
 
                 if result.tag == 255:
                     if result.to_address == address:
                         after_value = str(
-                            int(token_holders.get(address, "0")) + result.token_amount
+                            token_holders.get(address, 0) + result.token_amount
                         )
                     if result.from_address == address:
                         after_value = str(
-                            int(token_holders.get(address, "0")) - result.token_amount
+                            token_holders.get(address, 0) - result.token_amount
                         )
 
                 console.log(
@@ -539,18 +794,16 @@ class TokenAccounting(Utils):
     ):
         result = mintEvent(**log.result)
 
-        token_holders: dict[CCD_AccountAddress, str] = (
+        token_holders: dict[CCD_AccountAddress, int] = (
             token_address_as_class.token_holders
         )
 
         self.log_address_to_follow(result, result.to_address, token_holders, "Mint")
 
-        token_holders[result.to_address] = str(
-            int(token_holders.get(result.to_address, "0")) + result.token_amount
-        )
-        token_address_as_class.token_amount = str(
-            (int(token_address_as_class.token_amount) + result.token_amount)
+        token_holders[result.to_address] = (
+            token_holders.get(result.to_address, 0) + result.token_amount
         )
+        token_address_as_class.token_amount += result.token_amount
         token_address_as_class.token_holders = token_holders
         return token_address_as_class
 
@@ -660,7 +913,7 @@ class TokenAccounting(Utils):
     ):
         result = transferEvent(**log.result)
         try:
-            token_holders: dict[CCD_AccountAddress, str] = (
+            token_holders: dict[CCD_AccountAddress, int] = (
                 token_address_as_class.token_holders
             )
         except:
@@ -673,12 +926,12 @@ class TokenAccounting(Utils):
             result, result.from_address, token_holders, "Transfer"
         )
 
-        token_holders[result.to_address] = str(
-            int(token_holders.get(result.to_address, "0")) + result.token_amount
+        token_holders[result.to_address] = (
+            token_holders.get(result.to_address, 0) + result.token_amount
         )
         try:
-            token_holders[result.from_address] = str(
-                int(token_holders.get(result.from_address, "0")) - result.token_amount
+            token_holders[result.from_address] = (
+                token_holders.get(result.from_address, 0) - result.token_amount
             )
             # if int(token_holders[result.from_address]) == 0:
             #     del token_holders[result.from_address]
@@ -696,20 +949,18 @@ class TokenAccounting(Utils):
         self, token_address_as_class: MongoTypeTokenAddress, log: MongoTypeLoggedEvent
     ):
         result = burnEvent(**log.result)
-        token_holders: dict[CCD_AccountAddress, str] = (
+        token_holders: dict[CCD_AccountAddress, int] = (
             token_address_as_class.token_holders
         )
         self.log_address_to_follow(result, result.from_address, token_holders, "Burn")
         try:
-            token_holders[result.from_address] = str(
-                int(token_holders.get(result.from_address, "0")) - result.token_amount
+            token_holders[result.from_address] = (
+                token_holders.get(result.from_address, 0) - result.token_amount
             )
             # if int(token_holders[result.from_address]) == 0:
             #     del token_holders[result.from_address]
 
-            token_address_as_class.token_amount = str(
-                (int(token_address_as_class.token_amount) - result.token_amount)
-            )
+            token_address_as_class.token_amount -= result.token_amount
             token_address_as_class.token_holders = token_holders
 
         except:
@@ -731,18 +982,30 @@ class TokenAccounting(Utils):
                 "token_id": token_id,
                 "token_amount": str(int(0)),  # mongo limitation on int size
                 # not that we need to include the token_holders here, because we use it in code (but do not store it!)
-                "token_holders": {},  # {CCD_AccountAddress, str(token_amount)}
+                "token_holders": {},  # {CCD_AccountAddress, token_amount}
                 "last_height_processed": -1,
                 "hidden": False,
             }
         )
+        # while accounting, amounts are ints, these are stored as str.
+        token_address.token_amount = 0
         return token_address
 
     def execute_logged_event(
         self,
         token_address_as_class: MongoTypeTokenAddress,
         log: MongoTypeLoggedEvent,
+        changed_holders: set | None = None,
     ):
+        """
+        Applies a logged event, the holders it changes are added to
+        `changed_holders`.
+        """
+        if (changed_holders is not None) and (log.tag in [255, 254, 253]):
+            for key in ["from_address", "to_address"]:
+                if log.result.get(key) is not None:
+                    changed_holders.add(log.result[key])
+
         if log.tag == 255:
             token_address_as_class = self.save_transfer(
                 token_address_as_class,
@@ -0,0 +1,133 @@
+# ruff: noqa: F403, F405, E402, E501, E722
+from ccdexplorer_fundamentals.cis import MongoTypeTokenAddress
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+# rough memory held by a token address without holders, and per holder
+# (account address, amount and the dict slot).
+ENTRY_BYTES = 2_000
+HOLDER_BYTES = 250
+
+
+def estimate_bytes(token_address_as_class: MongoTypeTokenAddress) -> int:
+    holders = token_address_as_class.token_holders
+    return ENTRY_BYTES + HOLDER_BYTES * (len(holders) if holders else 0)
+
+
+class TokenLedger:
+    """
+    Resident ledger of token addresses (supply, last height processed) with
+    their holder balances in `token_holders`, for the token addresses that
+    have recently seen logged events. Token accounting applies new events to
+    the ledger entry and only reads the token address and its links from
+    Mongo on a miss.
+
+    Least recently used token addresses are evicted when the estimated
+    memory exceeds `max_bytes`. An entry that may no longer match Mongo (a
+    failed write, a redo) must be invalidated.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, MongoTypeTokenAddress] = OrderedDict()
+        self.entry_bytes: dict[str, int] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, token_address: str) -> MongoTypeTokenAddress | None:
+        with self.lock:
+            token_address_as_class = self.entries.get(token_address)
+            if token_address_as_class is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token_address)
+            self.hits += 1
+            return token_address_as_class
+
+    def set(self, token_address_as_class: MongoTypeTokenAddress):
+        """
+        Stores (or re-measures, after events were applied) a token address.
+        The entry that is set is never evicted by its own size.
+        """
+        token_address = token_address_as_class.id
+        nbytes = estimate_bytes(token_address_as_class)
+        with self.lock:
+            self.total_bytes -= self.entry_bytes.get(token_address, 0)
+            self.entries[token_address] = token_address_as_class
+            self.entries.move_to_end(token_address)
+            self.entry_bytes[token_address] = nbytes
+            self.total_bytes += nbytes
+            while (self.total_bytes > self.max_bytes) and (len(self.entries) > 1):
+                evicted, _ = self.entries.popitem(last=False)
+                self.total_bytes -= self.entry_bytes.pop(evicted)
+                self.evictions += 1
+
+    def invalidate(self, token_address: str):
+        with self.lock:
+            if self.entries.pop(token_address, None) is not None:
+                self.total_bytes -= self.entry_bytes.pop(token_address)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.entry_bytes.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "memory_mb": round(self.total_bytes / 1_000_000, 2),
+            "max_memory_mb": round(self.max_bytes / 1_000_000, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class TokenAddressLocks:
+    """
+    A lock per token address, held while a token address is read, accounted
+    for and written. Main accounting (possibly in parallel partitions), the
+    redo marking and special purpose accounting run on different threads and
+    must not interleave on the same token address. Locks only exist while
+    they are held or waited for.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # token address -> [lock, number of threads holding or waiting for it]
+        self.locks: dict[str, list] = {}
+
+    @contextmanager
+    def hold(self, token_addresses: list[str]):
+        # always acquired in the same order, so two holders can't deadlock.
+        token_addresses = sorted(set(token_addresses))
+        with self.lock:
+            for token_address in token_addresses:
+                entry = self.locks.setdefault(token_address, [threading.Lock(), 0])
+                entry[1] += 1
+        acquired = []
+        try:
+            for token_address in token_addresses:
+                self.locks[token_address][0].acquire()
+                acquired.append(token_address)
+            yield
+        finally:
+            for token_address in reversed(acquired):
+                self.locks[token_address][0].release()
+            with self.lock:
+                for token_address in token_addresses:
+                    entry = self.locks[token_address]
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self.locks[token_address]
@@ -1,11 +1,12 @@
 # ruff: noqa: F403, F405, E402, E501, E722
 from enum import Enum
 from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
-from ccdexplorer_fundamentals.mongodb import Collections, MongoTypeInstance
+from ccdexplorer_fundamentals.mongodb import Collections
 from ccdexplorer_fundamentals.cis import CIS, StandardIdentifiers
 from ccdexplorer_fundamentals.tooter import TooterChannel, TooterType
 from ccdexplorer_fundamentals.enums import NET
 from pymongo import ReplaceOne
+from functools import partial
 import io
 
 import asyncio
@@ -38,6 +39,21 @@ class Queue(Enum):
     token_links = 15
 
 
+class Stage(Enum):
+    """
+    Stages of the pipeline that run blocking gRPC, pymongo or CPU-bound work.
+    Every stage has its own thread pool, sized from env.
+    """
+
+    fetch = "fetch"
+    process = "process"
+    decode = "decode"
+    flush = "flush"
+    accounting = "accounting"
+    partitions = "partitions"
+    io = "io"
+
+
 class ProvenanceMintAddress(Enum):
     mainnet = ["3suZfxcME62akyyss72hjNhkzXeZuyhoyQz1tvNSXY2yxvwo53"]
     testnet = [
@@ -82,15 +98,13 @@ class Utils:
             upsert=True,
         )
 
-    def log_last_processed_message_in_mongo(
-        self, current_block_to_process: CCD_BlockInfo
-    ):
+    def log_last_processed_message_in_mongo(self, height: int):
         query = {"_id": "heartbeat_last_processed_block"}
         self.db[Collections.helpers].replace_one(
             query,
             {
                 "_id": "heartbeat_last_processed_block",
-                "height": current_block_to_process.height,
+                "height": height,
             },
             upsert=True,
         )
@@ -144,12 +158,30 @@ class Utils:
 
         return cis
 
+    def get_instance_init_name(self, instance_address: str) -> str | None:
+        """
+        Init name of a V1 instance, from `instance_name_cache`, falling back
+        to the instances collection.
+        """
+        found, init_name = self.instance_name_cache.get(instance_address)
+        if found:
+            return init_name
+        try:
+            instance = self.db[Collections.instances].find_one(
+                {"_id": instance_address}, {"v1.name": 1}
+            )
+        except:
+            instance = None
+        if instance is None:
+            # not stored (yet), don't cache.
+            return None
+        self.instance_name_cache.set_from_instance(instance_address, instance)
+        return self.instance_name_cache.get(instance_address)[1]
+
     def decode_cis_logged_events(
         self,
         tx: CCD_BlockItemSummary,
         block_info: CCD_BlockInfo,
-        # used to speed up, this stores whether a contract is CIS-2 compliant.
-        cis_2_contracts: dict[bool],
         special_purpose: bool = False,
     ):
         """
@@ -158,6 +190,7 @@ class Utils:
         Logged events are stored in a collection. Depending on the tag,
         the logged event is executed and the result is stored in the
         collections accounts and token_addresses.
+        Whether a contract is CIS-2 compliant comes from `cis_support_cache`.
         """
 
         # this is the ordering of effects as encountered in the transaction
@@ -170,7 +203,6 @@ class Utils:
                 logged_events,
                 token_addresses_to_redo_accounting,
                 provenance_contracts_to_add,
-                cis_2_contracts,
             )
 
         if tx.account_transaction.effects.contract_initialized:
@@ -181,15 +213,19 @@ class Utils:
                 tx.account_transaction.effects.contract_initialized.address.subindex
             )
             instance_address = f"<{contract_index},{contract_subindex}>"
+            self.instance_name_cache.set(
+                instance_address,
+                tx.account_transaction.effects.contract_initialized.init_name,
+            )
             entrypoint = f"{tx.account_transaction.effects.contract_initialized.init_name[5:]}.supports"
             cis = self.init_cis(contract_index, contract_subindex, entrypoint)
-            if contract_index not in cis_2_contracts:
-                supports_cis_1_2 = cis.supports_standards(
-                    [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2]
-                )
-                cis_2_contracts[contract_index] = supports_cis_1_2
-            else:
-                supports_cis_1_2 = cis_2_contracts[contract_index]
+            supports_cis_1_2 = self.cis_support_cache.supports(
+                instance_address,
+                partial(
+                    cis.supports_standards,
+                    [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2],
+                ),
+            )
 
             if supports_cis_1_2:
 
@@ -225,30 +261,28 @@ class Utils:
             for effect_index, effect in enumerate(
                 tx.account_transaction.effects.contract_update_issued.effects
             ):
+                if effect.upgraded:
+                    # a contract can gain (or lose) CIS-2 support with an upgrade.
+                    self.cis_support_cache.invalidate(
+                        f"<{effect.upgraded.address.index},{effect.upgraded.address.subindex}>"
+                    )
                 if effect.interrupted:
                     contract_index = effect.interrupted.address.index
                     contract_subindex = effect.interrupted.address.subindex
                     instance_address = f"<{contract_index},{contract_subindex}>"
-                    try:
-                        instance = MongoTypeInstance(
-                            **self.db[Collections.instances].find_one(
-                                {"_id": instance_address}
-                            )
-                        )
-                    except:
-                        instance = None
-                    if instance and instance.v1:
-                        entrypoint = instance.v1.name[5:] + ".supports"
+                    init_name = self.get_instance_init_name(instance_address)
+                    if init_name:
+                        entrypoint = init_name[5:] + ".supports"
                         cis = self.init_cis(
                             contract_index, contract_subindex, entrypoint
                         )
-                        if contract_index not in cis_2_contracts:
-                            supports_cis_1_2 = cis.supports_standards(
-                                [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2]
-                            )
-                            cis_2_contracts[contract_index] = supports_cis_1_2
-                        else:
-                            supports_cis_1_2 = cis_2_contracts[contract_index]
+                        supports_cis_1_2 = self.cis_support_cache.supports(
+                            instance_address,
+                            partial(
+                                cis.supports_standards,
+                                [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2],
+                            ),
+                        )
 
                         if supports_cis_1_2:
                             for index, event in enumerate(effect.interrupted.events):
@@ -293,13 +327,13 @@ class Utils:
                         entrypoint,
                         NET(self.net),
                     )
-                    if contract_index not in cis_2_contracts:
-                        supports_cis_1_2 = cis.supports_standards(
-                            [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2]
-                        )
-                        cis_2_contracts[contract_index] = supports_cis_1_2
-                    else:
-                        supports_cis_1_2 = cis_2_contracts[contract_index]
+                    supports_cis_1_2 = self.cis_support_cache.supports(
+                        instance_address,
+                        partial(
+                            cis.supports_standards,
+                            [StandardIdentifiers.CIS_1, StandardIdentifiers.CIS_2],
+                        ),
+                    )
                     if supports_cis_1_2:
                         for index, event in enumerate(effect.updated.events):
                             ordering += 1
@@ -335,7 +369,6 @@ class Utils:
             logged_events,
             token_addresses_to_redo_accounting,
             provenance_contracts_to_add,
-            cis_2_contracts,
         )
 
     # currently not used
@@ -29,14 +29,16 @@ def main():
     1. `get_finalized_blocks`: this method looks up the last processed block
     in a mongoDB helper collection, and determines how many finalized
     blocks it needs to request from the node. These blocks are then added
-    to the queue `finalized_block_infos_to_process`.
+    to the queue `finalized_block_infos_to_process`. At the tip, new blocks
+    are added by `follow_finalized_blocks` from the node's finalized blocks stream.
     2. `process_blocks` picks up this queue of blocks to process, and
     continues processing until the queue is empty again. For every block,
     we store the block_info (including tx hashes) into the collection `blocks`.
     Furthermore, we inspect all transactions for a block to determine whether we need
     to create any indices for them.
     3. `send_to_mongo`: this method takes all queues and sends them to the respective
-    MongoDB collections.
+    MongoDB collections. Once stored, `persist_checkpoint` writes the last stored
+    block to the helper `heartbeat_last_processed_block`.
     """
     console.log(f"{RUN_ON_NET=}")
     grpcclient = GRPCClient()
@@ -53,8 +55,13 @@ def main():
     loop = asyncio.get_event_loop()
 
     loop.create_task(heartbeat.get_finalized_blocks())
+    if TIP_MODE == "stream":
+        loop.create_task(heartbeat.follow_finalized_blocks())
     loop.create_task(heartbeat.process_blocks())
     loop.create_task(heartbeat.send_to_mongo())
+    loop.create_task(heartbeat.replay_spool())
+    loop.create_task(heartbeat.persist_checkpoint())
+    loop.create_task(heartbeat.save_snapshot_periodically())
 
     loop.create_task(heartbeat.update_token_accounting())
 
@@ -64,6 +71,9 @@ def main():
     loop.create_task(heartbeat.get_redo_token_addresses())
     loop.create_task(heartbeat.special_purpose_token_accounting())
 
+    loop.create_task(heartbeat.monitor_event_loop_lag())
+    loop.create_task(heartbeat.report_pipeline_metrics())
+
     loop.run_forever()
 
 
@@ -0,0 +1,68 @@
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+import datetime as dt
+
+
+class FakeBlockInfo:
+    """
+    The fields of a CCD_BlockInfo the block pipeline reads.
+    """
+
+    def __init__(
+        self,
+        height: int,
+        slot_time: dt.datetime = dt.datetime(2024, 1, 1, 12, 0),
+        transaction_count: int = 0,
+    ):
+        self.height = height
+        self.hash = f"hash-{height}"
+        self.slot_time = slot_time
+        self.transaction_count = transaction_count
+
+
+class FakeCollection:
+    """
+    A sync collection over `docs`, filtering `find` on `_id` `$in` / `$nin`
+    only; every other query returns all docs. `finds` counts the reads.
+    """
+
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+        self.finds = 0
+
+    def find(self, query: dict, projection: dict = None):
+        self.finds += 1
+        if "_id" not in query:
+            return list(self.docs)
+        if "$in" in query["_id"]:
+            return [x for x in self.docs if x["_id"] in query["_id"]["$in"]]
+        return [x for x in self.docs if x["_id"] not in query["_id"]["$nin"]]
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+
+class FakeAsyncCollection:
+    """
+    An async (motor) collection for bulk writes. Every bulk write takes the
+    next entry of `failures` (the details of a `BulkWriteError`) and raises
+    it, the operations without a write error are written. Once `failures`
+    is used up, bulk writes succeed.
+    """
+
+    def __init__(self, failures: list[dict] = None):
+        self.failures = list(failures or [])
+        self.calls: list[list] = []
+        self.written: list = []
+
+    async def bulk_write(self, ops: list, ordered: bool = True):
+        self.calls.append(list(ops))
+        if len(self.failures) > 0:
+            details = self.failures.pop(0)
+            failed = {x["index"] for x in details.get("writeErrors", [])}
+            self.written.extend([x for i, x in enumerate(ops) if i not in failed])
+            raise BulkWriteError(details)
+        self.written.extend(ops)
+        return BulkWriteResult(
+            {"nMatched": 0, "nModified": 0, "nUpserted": len(ops)}, True
+        )
@@ -0,0 +1,28 @@
+from heartbeat.backpressure import Budget
+from heartbeat.pending_blocks import PendingBlocks
+from tests.fakes import FakeBlockInfo
+
+
+def test_budget_room_by_items_and_bytes():
+    budget = Budget("test", max_items=10, max_bytes=1_000)
+    budget.update(4, 100)
+    assert not budget.is_full()
+    assert budget.items_room() == 6
+
+    budget.update(4, 1_000)
+    assert budget.is_full()
+    assert budget.items_room() == 0
+
+    budget.update(10, 0)
+    assert budget.is_full()
+    assert budget.items_room() == 0
+
+
+def test_pending_blocks_tracks_estimated_bytes():
+    pending = PendingBlocks()
+    pending.extend([FakeBlockInfo(x) for x in [1, 2, 3]])
+    assert pending.estimated_bytes > 0
+
+    while len(pending) > 0:
+        pending.popleft()
+    assert pending.estimated_bytes == 0
@@ -0,0 +1,28 @@
+from heartbeat.batch_controller import BatchController, BatchMode
+
+
+def test_small_batches_at_the_tip():
+    controller = BatchController(1, 1_000, 5, 5)
+    controller.update_chain_height(100)
+    controller.update_lag(98)
+
+    assert controller.mode == BatchMode.tip
+    assert controller.fetch_batch_size() == 3
+    assert controller.flush_batch_size() == 1
+
+
+def test_catch_up_batches_follow_slowest_stage():
+    controller = BatchController(1, 1_000, 5, 5)
+    controller.update_chain_height(100_000)
+    controller.update_lag(1)
+    controller.record("fetch", 100, 1)
+    controller.record("flush", 100, 2)
+
+    assert controller.mode == BatchMode.catch_up
+    # slowest stage takes 0.02 sec per block
+    assert controller.fetch_batch_size() == 250
+    assert controller.process_batch_size() == 250
+
+    controller.record("process", 1, 0)
+    controller.update_lag(99_900)
+    assert controller.fetch_batch_size() == 101
@@ -0,0 +1,58 @@
+import asyncio
+import random
+import time
+from heartbeat.block_fetcher import BlockFetcher
+from tests.fakes import FakeBlockInfo
+
+
+class FakeGRPCClient:
+    """
+    Returns a block for every height up to `last_finalized_height`,
+    with a random delay to make responses arrive out of order.
+    """
+
+    def __init__(self, last_finalized_height: int):
+        self.last_finalized_height = last_finalized_height
+        self.requested_heights = []
+
+    def get_finalized_block_at_height(self, height, net):
+        self.requested_heights.append(height)
+        time.sleep(random.uniform(0, 0.01))
+        if height <= self.last_finalized_height:
+            return FakeBlockInfo(height)
+        return None
+
+
+def test_fetch_range_is_ordered_without_gaps():
+    grpcclient = FakeGRPCClient(last_finalized_height=150)
+    fetcher = BlockFetcher(grpcclient, "mainnet", concurrency=8)
+
+    blocks = asyncio.run(fetcher.fetch_range(101, 100))
+
+    assert [x.height for x in blocks] == list(range(101, 151))
+    assert fetcher.stats()["blocks_fetched"] == 50
+    assert fetcher.stats()["in_flight"] == 0
+    assert fetcher.stats()["peak_in_flight"] <= 8
+    fetcher.shutdown()
+
+
+def test_fetch_range_respects_max_blocks():
+    grpcclient = FakeGRPCClient(last_finalized_height=1_000)
+    fetcher = BlockFetcher(grpcclient, "mainnet", concurrency=4)
+
+    blocks = asyncio.run(fetcher.fetch_range(1, 10))
+
+    assert [x.height for x in blocks] == list(range(1, 11))
+    assert max(grpcclient.requested_heights) == 10
+    fetcher.shutdown()
+
+
+def test_fetch_range_at_tip_probes_one_height():
+    grpcclient = FakeGRPCClient(last_finalized_height=100)
+    fetcher = BlockFetcher(grpcclient, "mainnet", concurrency=8)
+
+    blocks = asyncio.run(fetcher.fetch_range(101, 100))
+
+    assert blocks == []
+    assert grpcclient.requested_heights == [101]
+    fetcher.shutdown()
@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReplaceOne
+from heartbeat.batch_controller import BatchController
+from heartbeat.block_loop import BlockLoop
+from heartbeat.contract_index import ContractIndex
+from heartbeat.pending_blocks import PendingBlocks
+from heartbeat.utils import Queue, Stage
+from tests.fakes import FakeBlockInfo
+import threading
+import time
+
+
+class FakePrefetcher:
+    read_ahead = 0
+
+    def prefetch(self, block_info):
+        pass
+
+    def release(self, block_info):
+        pass
+
+
+class FakeBlockLoop(BlockLoop):
+    """
+    Decodes every block into a new instance of module `m1`, and flushes the
+    instances queue after every commit, like send_to_mongo can.
+    """
+
+    def __init__(self):
+        self.queues = {q: [] for q in Queue}
+        self.queues_lock = threading.Lock()
+        self.executors = {Stage.decode: ThreadPoolExecutor(max_workers=2)}
+        self.block_prefetcher = FakePrefetcher()
+        self.batch_controller = BatchController(1, 10, 2, 1)
+        self.contract_index = ContractIndex()
+        self.special_purpose_heights = {}
+        self.modules_added_back = 0
+        self.added_back = []
+        self.lookouts_under_lock = 0
+
+    def load_existing_modules_and_instances(self):
+        pass
+
+    def decode_block(self, block_info, special_purpose=False):
+        block_queues = {q: [] for q in Queue}
+        contract = f"<{block_info.height},0>"
+        block_queues[Queue.instances].append(
+            ReplaceOne({"_id": contract}, {"_id": contract}, upsert=True)
+        )
+        block_queues[Queue.updated_modules].append("sp" if special_purpose else "m1")
+        time.sleep(0.01)
+        return block_queues
+
+    def wait_for_room_in_queues(self):
+        pass
+
+    def commit_decoded_block(self, block_info, block_queues, special_purpose=False):
+        super().commit_decoded_block(block_info, block_queues, special_purpose)
+        with self.queues_lock:
+            self.queues[Queue.instances] = []
+
+    def lookout_for_payday(self, block_info):
+        self.lookouts_under_lock += self.queues_lock.locked()
+
+    def lookout_for_end_of_day(self, block_info):
+        self.lookouts_under_lock += self.queues_lock.locked()
+
+    def add_back_updated_modules_to_queue(self, updated_modules):
+        self.modules_added_back += 1
+        self.added_back.append(updated_modules)
+        self.added_back_under_lock = self.queues_lock.locked()
+
+
+def test_modules_are_added_back_when_instances_were_flushed():
+    loop = FakeBlockLoop()
+    pending = PendingBlocks()
+    pending.extend([FakeBlockInfo(x) for x in [1, 2, 3]])
+
+    last = loop.process_list_of_blocks(pending)
+    assert last.height == 3
+    assert len(loop.queues[Queue.instances]) == 0
+    assert loop.added_back == [["m1"]]
+    assert loop.modules_added_back == 1
+    assert loop.lookouts_under_lock == 0
+    assert not loop.added_back_under_lock
+
+
+def test_concurrent_batches_keep_their_own_updated_modules():
+    loop = FakeBlockLoop()
+    live = PendingBlocks()
+    live.extend([FakeBlockInfo(x) for x in range(10, 20)])
+    special = PendingBlocks()
+    special.extend([FakeBlockInfo(x) for x in range(1, 5)])
+
+    batches = [
+        threading.Thread(target=loop.process_list_of_blocks, args=(live,)),
+        threading.Thread(
+            target=loop.process_list_of_blocks,
+            args=(special,),
+            kwargs={"special_purpose": True},
+        ),
+    ]
+    for batch in batches:
+        batch.start()
+    for batch in batches:
+        batch.join()
+    assert sorted(loop.added_back) == [["m1"], ["sp"]]
@@ -0,0 +1,57 @@
+from heartbeat.block_prefetcher import BlockPrefetcher
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import threading
+from tests.fakes import FakeBlockInfo
+
+
+class FakeGRPCClient:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, name, block_input):
+        with self.lock:
+            self.calls.append((name, block_input))
+        return (name, block_input)
+
+    def get_block_transaction_events(self, block_input, net):
+        return self.record("transaction_events", block_input)
+
+    def get_block_special_events(self, block_input, net):
+        return self.record("special_events", block_input)
+
+    def get_finalized_block_at_height(self, block_input, net):
+        return self.record("block_info", block_input)
+
+
+def test_reads_are_shared_until_released():
+    grpcclient = FakeGRPCClient()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        prefetcher = BlockPrefetcher(grpcclient, "mainnet", 8, executor)
+        midday = FakeBlockInfo(10, dt.datetime(2024, 1, 2, 12, 0), 3)
+        prefetcher.prefetch(midday)
+
+        prefetched = prefetcher.get(midday)
+        assert prefetched.transaction_events() == ("transaction_events", "hash-10")
+        assert prefetched.special_events() == ("special_events", "hash-10")
+        assert prefetcher.get(midday).special_events() == prefetched.special_events()
+        assert len(grpcclient.calls) == 2
+
+        prefetcher.release(midday)
+        assert prefetcher.stats()["blocks_held"] == 0
+
+
+def test_previous_block_only_around_midnight():
+    grpcclient = FakeGRPCClient()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        prefetcher = BlockPrefetcher(grpcclient, "mainnet", 8, executor)
+        midnight = FakeBlockInfo(20, dt.datetime(2024, 1, 2, 0, 1), 0)
+        prefetched = prefetcher.prefetch(midnight)
+
+        assert prefetched.transaction_events() is None
+        assert prefetched.previous_block_info() == ("block_info", 19)
+        assert sorted(grpcclient.calls) == [
+            ("block_info", 19),
+            ("special_events", "hash-20"),
+        ]
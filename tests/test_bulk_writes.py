@@ -0,0 +1,234 @@
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from heartbeat import send_to_mongo
+from heartbeat.bulk_writes import (
+    ChunkWriteError,
+    FlushStats,
+    chunk_ops,
+    dedupe_ops,
+    failed_ops,
+)
+from heartbeat.module_logic import module_update
+from heartbeat.send_to_mongo import SendToMongo
+from heartbeat.utils import Queue
+from tests.fakes import FakeAsyncCollection
+import asyncio
+import pytest
+import threading
+
+
+def test_dedupe_keeps_last_operation_per_id():
+    ops = [
+        ReplaceOne({"_id": "a"}, {"v": 1}, upsert=True),
+        ReplaceOne({"_id": "b"}, {"v": 1}, upsert=True),
+        UpdateOne({"token_address": "x"}, {"$set": {"v": 1}}),
+        ReplaceOne({"_id": "a"}, {"v": 2}, upsert=True),
+    ]
+
+    deduped = dedupe_ops(ops)
+
+    assert deduped == [ops[1], ops[2], ops[3]]
+
+
+def test_dedupe_keeps_every_module_update():
+    # contracts found by blocks decoded concurrently, neither is a superset.
+    ops = [
+        module_update("m1", {"module_name": "a", "methods": []}, ["<1,0>"]),
+        module_update("m1", {"module_name": "a", "methods": []}, ["<2,0>"]),
+    ]
+    assert dedupe_ops(ops) == ops
+
+    # a replace overwrites what the updates before it added.
+    replace = ReplaceOne({"_id": "m1"}, {"contracts": None}, upsert=True)
+    assert dedupe_ops(ops + [replace]) == [replace]
+
+
+def test_chunks_and_failed_ops():
+    ops = [ReplaceOne({"_id": i}, {"v": i}, upsert=True) for i in range(10)]
+
+    assert [len(x) for x in chunk_ops(ops, 4, 100, 1_000_000)] == [4, 4, 2]
+    # 250 bytes per op, 1,000 bytes per chunk.
+    assert [len(x) for x in chunk_ops(ops, 100, 250, 1_000)] == [4, 4, 2]
+
+    error = BulkWriteError(
+        {
+            "writeErrors": [{"index": 3, "code": 11000}, {"index": 1, "code": 11000}],
+            "nUpserted": 8,
+        }
+    )
+    assert failed_ops(ops, error) == [ops[1], ops[3]]
+
+
+class FakeTooter:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.relayed = []
+
+    def relay(self, **kwargs):
+        self.relayed.append(kwargs["body"])
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("tooter is down")
+
+
+class FakeBatchController:
+    def flush_batch_size(self) -> int:
+        return 1_000
+
+    def record(self, stage: str, blocks: int, seconds: float):
+        pass
+
+
+class FakeFlusher(SendToMongo):
+    """
+    `send_to_mongo` and its helpers, writing to fake async collections.
+    """
+
+    def __init__(self, motordb: dict, tooter: FakeTooter = None):
+        self.motordb = motordb
+        self.tooter = tooter or FakeTooter()
+        self.net = "testnet"
+        self.queues = {q: [] for q in Queue}
+        self.queues_lock = threading.Lock()
+        self.last_committed_height = None
+        self.spool = None
+        self.flush_stats = FlushStats()
+        self.flush_semaphore = asyncio.Semaphore(4)
+        self.average_op_bytes = {}
+        self.batch_controller = FakeBatchController()
+        # (height, transactions written at the time) per stored checkpoint.
+        self.checkpoints = []
+
+    async def run_in_stage(self, stage, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def record_op_sizes(self, queues):
+        pass
+
+    def checkpoint_stored(self, height):
+        written = len(self.motordb[Collections.transactions].written)
+        self.checkpoints.append((height, written))
+
+
+def replace_ops(n: int) -> list:
+    return [ReplaceOne({"_id": i}, {"v": i}, upsert=True) for i in range(n)]
+
+
+def test_write_chunk_retries_only_failed_ops_with_backoff(monkeypatch):
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(send_to_mongo.asyncio, "sleep", sleep)
+    monkeypatch.setattr(send_to_mongo, "FLUSH_RETRIES", 2)
+    monkeypatch.setattr(send_to_mongo, "FLUSH_RETRY_BACKOFF", 0.5)
+    ops = replace_ops(4)
+    collection = FakeAsyncCollection(
+        [
+            {"writeErrors": [{"index": 1}, {"index": 3}], "nUpserted": 2},
+            {"writeErrors": [{"index": 0}], "nUpserted": 1},
+        ]
+    )
+    flusher = FakeFlusher({Collections.transactions: collection})
+
+    counts = asyncio.run(
+        flusher.write_chunk(Collections.transactions, ops, asyncio.Semaphore(1))
+    )
+    assert collection.calls == [ops, [ops[1], ops[3]], [ops[1]]]
+    assert delays == [0.5, 1.0]
+    assert counts["upserted"] == 4
+    assert flusher.flush_stats.stats()["transactions"]["retries"] == 2
+
+    # when retries run out, only what was not written is left.
+    collection = FakeAsyncCollection(
+        [{"writeErrors": [{"index": 2}]}, {"writeErrors": [{"index": 0}]}]
+    )
+    flusher = FakeFlusher({Collections.transactions: collection})
+    monkeypatch.setattr(send_to_mongo, "FLUSH_RETRIES", 1)
+    with pytest.raises(ChunkWriteError) as e:
+        asyncio.run(
+            flusher.write_chunk(Collections.transactions, ops, asyncio.Semaphore(1))
+        )
+    assert e.value.ops == [ops[2]]
+
+
+def test_write_chunk_retries_all_ops_after_write_concern_error(monkeypatch):
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(send_to_mongo.asyncio, "sleep", sleep)
+    ops = replace_ops(3)
+    # a write concern error doesn't say which operations were applied.
+    collection = FakeAsyncCollection(
+        [{"writeErrors": [], "writeConcernErrors": [{"code": 64}], "nUpserted": 3}]
+    )
+    flusher = FakeFlusher({Collections.transactions: collection})
+
+    asyncio.run(
+        flusher.write_chunk(Collections.transactions, ops, asyncio.Semaphore(1))
+    )
+    assert collection.calls == [ops, ops]
+
+
+def test_flush_queue_leaves_only_unwritten_ops(monkeypatch):
+    monkeypatch.setattr(send_to_mongo, "FLUSH_RETRIES", 0)
+    monkeypatch.setattr(send_to_mongo, "FLUSH_CHUNK_OPS", 2)
+    ops = replace_ops(4)
+    collection = FakeAsyncCollection([{"writeErrors": [{"index": 1}]}])
+    flusher = FakeFlusher({Collections.transactions: collection})
+    queues = {q: [] for q in Queue}
+    queues[Queue.transactions] = list(ops)
+
+    with pytest.raises(ChunkWriteError):
+        asyncio.run(
+            flusher.flush_queue(
+                queues,
+                Queue.transactions,
+                Collections.transactions,
+                asyncio.Semaphore(1),
+            )
+        )
+    assert queues[Queue.transactions] == [ops[1]]
+    assert sorted([x._filter["_id"] for x in collection.written]) == [0, 2, 3]
+
+
+def test_checkpoint_moves_only_when_every_collection_is_written(monkeypatch):
+    monkeypatch.setattr(send_to_mongo, "FLUSH_RETRIES", 0)
+    monkeypatch.setattr(send_to_mongo, "FLUSH_INTERVAL", 0.01)
+    monkeypatch.setattr(
+        send_to_mongo,
+        "collection_for_queue",
+        lambda: {
+            Queue.blocks: Collections.blocks,
+            Queue.transactions: Collections.transactions,
+        },
+    )
+    motordb = {
+        Collections.blocks: FakeAsyncCollection(),
+        Collections.transactions: FakeAsyncCollection(
+            [{"writeErrors": [{"index": 1}]}]
+        ),
+    }
+    # the error notification failing doesn't stop the flusher either.
+    flusher = FakeFlusher(motordb, FakeTooter(fail=True))
+    flusher.queues[Queue.blocks] = replace_ops(1)
+    flusher.queues[Queue.block_heights] = [5]
+    flusher.queues[Queue.transactions] = replace_ops(2)
+    flusher.last_committed_height = 5
+
+    async def flush_until_stored():
+        task = asyncio.create_task(flusher.send_to_mongo())
+        for _ in range(500):
+            await asyncio.sleep(0.01)
+            if len(flusher.checkpoints) > 0:
+                break
+        task.cancel()
+
+    asyncio.run(flush_until_stored())
+    assert len(flusher.tooter.relayed) == 1
+    assert flusher.checkpoints[0] == (5, 2)
+    # the failed operation was retried, once.
+    assert len(motordb[Collections.transactions].calls) == 2
+    assert len(motordb[Collections.blocks].calls) == 1
@@ -0,0 +1,35 @@
+import time
+from heartbeat.cis_support_cache import CisSupportCache
+
+
+def test_caches_positive_and_negative_results():
+    cache = CisSupportCache(ttl=60, negative_ttl=60)
+    calls = []
+
+    def check(result: bool):
+        calls.append(result)
+        return result
+
+    assert cache.supports("<1,0>", lambda: check(True))
+    assert cache.supports("<1,0>", lambda: check(False))
+    assert not cache.supports("<1,1>", lambda: check(False))
+    assert not cache.supports("<1,1>", lambda: check(True))
+
+    assert calls == [True, False]
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+
+
+def test_expiry_and_invalidation():
+    cache = CisSupportCache(ttl=60, negative_ttl=0)
+    cache.set("<1,0>", True)
+    cache.set("<2,0>", False)
+    time.sleep(0.01)
+
+    assert cache.get("<2,0>") is None
+    assert cache.get("<1,0>") is True
+
+    cache.invalidate("<1,0>")
+    assert cache.get("<1,0>") is None
+    assert cache.stats()["invalidations"] == 1
+    assert cache.stats()["expired"] == 1
@@ -0,0 +1,93 @@
+from ccdexplorer_fundamentals.mongodb import Collections
+from heartbeat.contract_index import ContractIndex
+from heartbeat.instance_name_cache import InstanceNameCache
+from tests.fakes import FakeCollection
+
+
+def test_loads_once_then_picks_up_delta():
+    db = {
+        Collections.modules: FakeCollection([{"_id": "m1", "contracts": ["<1,0>"]}]),
+        Collections.instances: FakeCollection([{"_id": "<0,0>"}, {"_id": "<1,0>"}]),
+    }
+    index = ContractIndex()
+    index.refresh(db)
+    assert index.full_loads == 1
+    assert index.max_contract_index == 1
+    assert index.modules == {"m1": {"<1,0>"}}
+
+    db[Collections.instances].docs.append({"_id": "<2,0>"})
+    db[Collections.modules].docs.append({"_id": "m2", "contracts": None})
+    index.refresh(db)
+    assert index.full_loads == 1
+    assert index.has_instance("<2,0>")
+    assert not index.has_instance("<3,0>")
+    assert index.modules["m2"] == set()
+
+    # written by others, its module knows about it.
+    db[Collections.instances].docs.append(
+        {"_id": "<3,0>", "v1": {"source_module": "m1"}}
+    )
+    index.refresh(db)
+    assert index.modules["m1"] == {"<1,0>", "<3,0>"}
+
+    index.add_instance("<4,0>")
+    assert index.max_contract_index == 4
+    assert index.stats()["hit_rate"] == 0.5
+
+
+def test_snapshot_is_checked_against_mongo():
+    db = {
+        Collections.modules: FakeCollection([{"_id": "m1", "contracts": ["<1,0>"]}]),
+        Collections.instances: FakeCollection([{"_id": "<0,0>"}, {"_id": "<1,0>"}]),
+    }
+    index = ContractIndex()
+    index.refresh(db)
+    # discovered, but never stored
+    index.add_instance("<2,0>")
+
+    restarted = ContractIndex()
+    restarted.from_snapshot(index.to_snapshot())
+
+    restarted.refresh(db)
+    assert restarted.full_loads == 1
+    assert not restarted.has_instance("<2,0>")
+    assert restarted.modules == {"m1": {"<1,0>"}}
+
+
+def test_stale_modules_in_snapshot_are_reloaded():
+    db = {
+        Collections.modules: FakeCollection([{"_id": "m1", "contracts": ["<1,0>"]}]),
+        Collections.instances: FakeCollection([{"_id": "<0,0>"}, {"_id": "<1,0>"}]),
+    }
+    index = ContractIndex()
+    index.refresh(db)
+    # discovered, but never stored
+    index.modules["m1"].add("<9,0>")
+    snapshot = index.to_snapshot()
+
+    # same number of modules and instances, other contracts.
+    db[Collections.modules].docs[0]["contracts"] = ["<0,0>", "<1,0>"]
+
+    restarted = ContractIndex()
+    restarted.from_snapshot(snapshot)
+    restarted.refresh(db)
+    assert restarted.modules == {"m1": {"<0,0>", "<1,0>"}}
+
+
+def test_instances_read_from_mongo_seed_the_name_cache():
+    db = {
+        Collections.modules: FakeCollection([]),
+        Collections.instances: FakeCollection(
+            [{"_id": "<0,0>", "v0": {"source_module": "m0"}}]
+        ),
+    }
+    cache = InstanceNameCache(10)
+    index = ContractIndex(cache)
+    index.refresh(db)
+    db[Collections.instances].docs.append(
+        {"_id": "<1,0>", "v1": {"source_module": "m1", "name": "init_cis2"}}
+    )
+    index.refresh(db)
+
+    assert cache.get("<0,0>") == (True, None)
+    assert cache.get("<1,0>") == (True, "init_cis2")
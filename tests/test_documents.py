@@ -0,0 +1,88 @@
+from ccdexplorer_fundamentals.GRPCClient.CCD_Types import *
+from heartbeat.documents import block_document, transaction_document
+import datetime as dt
+import json
+
+BLOCK_INFO = CCD_BlockInfo(
+    arrive_time=dt.datetime(2024, 3, 1, 12, 0, 1, tzinfo=dt.timezone.utc),
+    receive_time=dt.datetime(2024, 3, 1, 12, 0, 0, tzinfo=dt.timezone.utc),
+    baker=7,
+    hash="aa" * 32,
+    height=1_000,
+    last_finalized_block="bb" * 32,
+    parent_block="cc" * 32,
+    slot_time=dt.datetime(2024, 3, 1, 11, 59, 59, 500_000, tzinfo=dt.timezone.utc),
+    era_block_height=1_000,
+    finalized=True,
+    genesis_index=1,
+    transaction_count=1,
+    transactions_energy_cost=1_234,
+    transactions_size=567,
+    state_hash="dd" * 32,
+    protocol_version="ProtocolVersion6",
+    round=12,
+    epoch=3,
+)
+
+TX = CCD_BlockItemSummary.model_validate(
+    {
+        "index": 0,
+        "energy_cost": 1_234,
+        "hash": "ee" * 32,
+        "type": {"type": "account_transaction", "contents": "update"},
+        "account_transaction": {
+            "cost": 5_000,
+            "sender": "3BFChzvx3783jGUKgHVCanFVxyDAn5xT3Y5NL5FKydVMuBa7Bm",
+            "outcome": "success",
+            "effects": {
+                "contract_update_issued": {
+                    "effects": [
+                        {
+                            "updated": {
+                                "contract_version": 1,
+                                "address": {"index": 9_337, "subindex": 0},
+                                "instigator": {
+                                    "account": "3BFChzvx3783jGUKgHVCanFVxyDAn5xT3Y5NL5FKydVMuBa7Bm"
+                                },
+                                "amount": 10**18,
+                                "parameter": "0100",
+                                "receive_name": "cis2.transfer",
+                                "events": ["ff00", "fe01"],
+                            }
+                        }
+                    ]
+                }
+            },
+        },
+    }
+)
+
+
+def json_round_trip_block(block_info: CCD_BlockInfo) -> dict:
+    doc = json.loads(block_info.model_dump_json(exclude_none=True))
+    doc.update({"_id": block_info.hash})
+    doc.update({"slot_time": block_info.slot_time})
+    del doc["arrive_time"]
+    del doc["receive_time"]
+    doc.update({"transaction_hashes": []})
+    return doc
+
+
+def json_round_trip_tx(tx: CCD_BlockItemSummary, block_info: CCD_BlockInfo) -> dict:
+    doc = json.loads(tx.model_dump_json(exclude_none=True))
+    doc.update({"_id": tx.hash})
+    doc.update(
+        {
+            "block_info": {
+                "height": block_info.height,
+                "hash": block_info.hash,
+                "slot_time": block_info.slot_time,
+            }
+        }
+    )
+    return doc
+
+
+def test_same_documents_as_json_round_trip():
+    assert block_document(BLOCK_INFO) == json_round_trip_block(BLOCK_INFO)
+    assert transaction_document(TX, BLOCK_INFO) == json_round_trip_tx(TX, BLOCK_INFO)
@@ -0,0 +1,17 @@
+from heartbeat.instance_name_cache import InstanceNameCache
+
+
+def test_lru_eviction_and_v0_instances():
+    cache = InstanceNameCache(maxsize=2)
+    cache.set_from_instance("<1,0>", {"_id": "<1,0>", "v1": {"name": "init_dex"}})
+    cache.set_from_instance("<2,0>", {"_id": "<2,0>", "v0": {"name": "init_old"}})
+
+    assert cache.get("<1,0>") == (True, "init_dex")
+    assert cache.get("<2,0>") == (True, None)
+
+    # <1,0> was used before <2,0>, so it is evicted first.
+    cache.get("<2,0>")
+    cache.set("<3,0>", "init_router")
+    assert cache.get("<1,0>") == (False, None)
+    assert cache.get("<3,0>") == (True, "init_router")
+    assert cache.stats()["evictions"] == 1
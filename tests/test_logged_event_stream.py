@@ -0,0 +1,77 @@
+from heartbeat.logged_event_stream import LoggedEventStream
+
+
+class FakeCursor(list):
+    def sort(self, keys):
+        return FakeCursor(sorted(self, key=lambda x: tuple([x[k] for k, _ in keys])))
+
+    def limit(self, n):
+        return FakeCursor(self[:n])
+
+
+class FakeLoggedEvents:
+    def __init__(self, keys: list[tuple[int, int, int]]):
+        self.docs = [
+            {
+                "block_height": h,
+                "tx_index": t,
+                "ordering": o,
+                "token_address": "<1,0>-",
+                "tag": 254,
+                "result": {},
+            }
+            for h, t, o in keys
+        ]
+
+    def matches(self, doc: dict, query: dict) -> bool:
+        height = query["block_height"]
+        if isinstance(height, dict):
+            return (doc["block_height"] > height["$gt"]) and (
+                ("$lte" not in height) or (doc["block_height"] <= height["$lte"])
+            )
+        return (doc["block_height"] == height) and any(
+            [
+                all(
+                    [
+                        doc[k] > v["$gt"] if isinstance(v, dict) else doc[k] == v
+                        for k, v in x.items()
+                    ]
+                )
+                for x in query["$or"]
+            ]
+        )
+
+    def find(self, query, projection):
+        return FakeCursor([x for x in self.docs if self.matches(x, query)])
+
+
+def test_pages_end_with_whole_blocks():
+    collection = FakeLoggedEvents(
+        [(10, 0, 0), (10, 0, 1), (11, 0, 0), (11, 0, 1), (11, 1, 0), (12, 0, 0)]
+    )
+    stream = LoggedEventStream(min_page_size=3, max_page_size=10, target_seconds=1)
+
+    # the page size cuts block 11, the rest of it is read as well.
+    page = stream.read_page(collection, 9)
+    assert [(x.block_height, x.tx_index, x.ordering) for x in page] == [
+        (10, 0, 0),
+        (10, 0, 1),
+        (11, 0, 0),
+        (11, 0, 1),
+        (11, 1, 0),
+    ]
+
+    # blocks past the max height (not completely stored) are not read.
+    assert stream.read_page(collection, 11, max_height=11) == []
+    assert [x.block_height for x in stream.read_page(collection, 11)] == [12]
+
+
+def test_page_size_follows_the_accounting_rate():
+    stream = LoggedEventStream(
+        min_page_size=100, max_page_size=10_000, target_seconds=2
+    )
+    assert stream.page_size() == 100
+    stream.record(5_000, 1.0)
+    assert stream.page_size() == 10_000
+    stream.events_per_second = 400
+    assert stream.page_size() == 800
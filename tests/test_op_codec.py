@@ -0,0 +1,50 @@
+import datetime as dt
+from pymongo import ReplaceOne
+from heartbeat.module_logic import module_update
+from bson.raw_bson import RawBSONDocument
+from heartbeat.op_codec import encode_queues, decode_queues, pre_encode_queues
+from heartbeat.utils import Queue
+
+
+def test_round_trip():
+    slot_time = dt.datetime(2024, 1, 1, 12, 0, 0)
+    queues = {q: [] for q in Queue}
+    queues[Queue.blocks].append(
+        ReplaceOne(
+            {"_id": "abc"},
+            {"_id": "abc", "height": 1, "slot_time": slot_time},
+            upsert=True,
+        )
+    )
+    queues[Queue.modules].append(
+        module_update("m1", {"module_name": "cis2", "methods": ["transfer"]}, ["<1,0>"])
+    )
+    queues[Queue.block_heights].extend([1, 2])
+    queues[Queue.provenance_contracts_to_add].append("<1,0>")
+
+    decoded = decode_queues(encode_queues(queues))
+
+    assert decoded[Queue.blocks] == queues[Queue.blocks]
+    assert decoded[Queue.modules] == queues[Queue.modules]
+    assert decoded[Queue.block_heights] == [1, 2]
+    assert decoded[Queue.provenance_contracts_to_add] == ["<1,0>"]
+    assert decoded[Queue.transactions] == []
+
+
+def test_pre_encode():
+    slot_time = dt.datetime(2024, 1, 1, 12, 0, 0)
+    doc = {"_id": "abc", "height": 1, "slot_time": slot_time}
+    queues = {q: [] for q in Queue}
+    queues[Queue.transactions].append(ReplaceOne({"_id": "abc"}, doc, upsert=True))
+    queues[Queue.block_heights].append(1)
+
+    assert pre_encode_queues(queues) > 0
+    op = queues[Queue.transactions][0]
+    assert isinstance(op._doc, RawBSONDocument)
+    assert dict(op._doc) == doc
+    assert op._upsert
+    # already encoded operations are left alone.
+    assert pre_encode_queues(queues) == 0
+
+    decoded = decode_queues(encode_queues(queues))
+    assert decoded[Queue.transactions][0]._doc == doc
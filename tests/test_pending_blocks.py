@@ -0,0 +1,47 @@
+from heartbeat.pending_blocks import SAMPLE_EVERY, PendingBlocks
+from tests.fakes import FakeBlockInfo
+
+
+def test_pops_in_height_order():
+    pending = PendingBlocks()
+    pending.extend([FakeBlockInfo(x) for x in [10, 11, 12]])
+    pending.add(FakeBlockInfo(5))
+    pending.add(FakeBlockInfo(8))
+
+    assert pending.first().height == 5
+    assert pending.last().height == 12
+    assert [pending.popleft().height for _ in range(len(pending))] == [
+        5,
+        8,
+        10,
+        11,
+        12,
+    ]
+    assert len(pending) == 0
+    assert pending.first() is None
+
+
+def test_dedupes_by_height():
+    pending = PendingBlocks()
+    assert pending.add(FakeBlockInfo(1))
+    assert not pending.add(FakeBlockInfo(1))
+    assert pending.extend([FakeBlockInfo(1), FakeBlockInfo(2)]) == 1
+
+    assert 1 in pending
+    assert 3 not in pending
+    assert [x.height for x in pending] == [1, 2]
+
+
+class SerializedBlockInfo(FakeBlockInfo):
+    serialized = 0
+
+    def model_dump_json(self, exclude_none: bool = False) -> str:
+        SerializedBlockInfo.serialized += 1
+        return "x" * 1_000
+
+
+def test_only_a_sample_of_blocks_is_serialized():
+    pending = PendingBlocks()
+    pending.extend([SerializedBlockInfo(x) for x in range(2 * SAMPLE_EVERY)])
+    assert SerializedBlockInfo.serialized == 3
+    assert pending.estimated_bytes == 2 * SAMPLE_EVERY * 1_000
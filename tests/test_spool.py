@@ -0,0 +1,36 @@
+from heartbeat.spool import Spool
+import os
+
+
+def test_segments_are_replayed_in_order(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100)
+    spool.append(b"a" * 80, 10)
+    spool.append(b"b" * 80, 11)
+    spool.append(b"c", None)
+
+    assert spool.last_checkpoint_height == 11
+    replayed = []
+    while (path := spool.oldest_segment()) is not None:
+        replayed.extend(spool.read_segment(path))
+        spool.remove(path)
+
+    assert replayed == [(10, b"a" * 80), (11, b"b" * 80), (None, b"c")]
+    assert spool.is_empty()
+
+
+def test_restart_skips_incomplete_record(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=1_000_000)
+    spool.append(b"first", 20)
+    spool.append(b"second", 21)
+    spool.close()
+    # a crash halfway through the last append.
+    path = spool.segment_paths()[0]
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    restarted = Spool(str(tmp_path), segment_bytes=1_000_000)
+    assert restarted.last_checkpoint_height == 20
+    assert restarted.read_segment(path) == [(20, b"first")]
+    # new records go to a new segment.
+    restarted.append(b"third", 22)
+    assert len(restarted.segment_paths()) == 2
@@ -70,11 +70,13 @@ def create_new_token_address(token_address: str) -> MongoTypeTokenAddress:
             "token_id": token_id,
             "token_amount": str(int(0)),  # mongo limitation on int size
             # not that we need to include the token_holders here, because we use it in code (but do not store it!)
-            "token_holders": {},  # {CCD_AccountAddress, str(token_amount)}
+            "token_holders": {},  # {CCD_AccountAddress, token_amount}
             "last_height_processed": -1,
             "hidden": False,
         }
     )
+    # while accounting, amounts are ints.
+    token_address.token_amount = 0
     return token_address
 
 
@@ -114,16 +116,15 @@ def test_logs(heartbeat: Heartbeat):  # grpcclient: GRPCClient, mongodb: MongoDB
         token_address_as_class,
         filtered_events[0],
     )
-    assert (
-        token_address_as_class.token_holders.get(address_to_follow)
-        == filtered_events[0].result["token_amount"]
+    assert token_address_as_class.token_holders.get(address_to_follow) == int(
+        filtered_events[0].result["token_amount"]
     )
 
     token_address_as_class = heartbeat.execute_logged_event(
         token_address_as_class,
         filtered_events[1],
     )
-    assert token_address_as_class.token_holders.get(address_to_follow) == str(
+    assert token_address_as_class.token_holders.get(address_to_follow) == (
         int(filtered_events[0].result["token_amount"])
         + int(filtered_events[1].result["token_amount"])
     )
@@ -132,7 +133,7 @@ def test_logs(heartbeat: Heartbeat):  # grpcclient: GRPCClient, mongodb: MongoDB
         token_address_as_class,
         filtered_events[2],
     )
-    assert token_address_as_class.token_holders.get(address_to_follow) == str(
+    assert token_address_as_class.token_holders.get(address_to_follow) == (
         int(filtered_events[0].result["token_amount"])
         + int(filtered_events[1].result["token_amount"])
         + int(filtered_events[2].result["token_amount"])
@@ -142,7 +143,7 @@ def test_logs(heartbeat: Heartbeat):  # grpcclient: GRPCClient, mongodb: MongoDB
         token_address_as_class,
         filtered_events[3],
     )
-    assert token_address_as_class.token_holders.get(address_to_follow) == str(
+    assert token_address_as_class.token_holders.get(address_to_follow) == (
         int(filtered_events[0].result["token_amount"])
         + int(filtered_events[1].result["token_amount"])
         + int(filtered_events[2].result["token_amount"])
@@ -153,7 +154,7 @@ def test_logs(heartbeat: Heartbeat):  # grpcclient: GRPCClient, mongodb: MongoDB
         token_address_as_class,
         filtered_events[4],
     )
-    assert token_address_as_class.token_holders.get(address_to_follow) == str(
+    assert token_address_as_class.token_holders.get(address_to_follow) == (
         int(filtered_events[0].result["token_amount"])
         + int(filtered_events[1].result["token_amount"])
         + int(filtered_events[2].result["token_amount"])
@@ -0,0 +1,234 @@
+from ccdexplorer_fundamentals.cis import MongoTypeLoggedEvent, MongoTypeTokenAddress
+from ccdexplorer_fundamentals.mongodb import Collections
+from pymongo import DeleteOne, ReplaceOne
+from heartbeat.token_accounting import TokenAccounting
+from heartbeat.token_ledger import (
+    ENTRY_BYTES,
+    HOLDER_BYTES,
+    TokenAddressLocks,
+    TokenLedger,
+)
+from tests.fakes import FakeCollection
+import threading
+import time
+
+
+def token_address(_id: str, token_holders: dict) -> MongoTypeTokenAddress:
+    token_address_as_class = MongoTypeTokenAddress(
+        **{
+            "_id": _id,
+            "contract": _id.split("-")[0],
+            "token_id": _id.split("-")[1],
+            "token_amount": "0",
+            "last_height_processed": 10,
+        }
+    )
+    token_address_as_class.token_amount = sum(token_holders.values())
+    token_address_as_class.token_holders = token_holders
+    return token_address_as_class
+
+
+def test_evicts_least_recently_used_over_memory_limit():
+    ledger = TokenLedger(max_bytes=2 * ENTRY_BYTES + 3 * HOLDER_BYTES)
+    ledger.set(token_address("<1,0>-", {"a": 1}))
+    ledger.set(token_address("<2,0>-", {"b": 2, "c": 3}))
+    assert ledger.get("<1,0>-") is not None
+
+    # growing <2,0>- (the least recently used) past the limit evicts <1,0>-,
+    # never the entry that is set.
+    grown = token_address("<2,0>-", {"b": 2, "c": 3, "d": 4})
+    ledger.set(grown)
+    assert ledger.get("<1,0>-") is None
+    assert ledger.get("<2,0>-") is grown
+    assert ledger.stats()["evictions"] == 1
+
+
+def test_mongo_is_only_read_on_a_miss():
+    accounting = TokenAccounting()
+    accounting.token_ledger = TokenLedger(max_bytes=1_000_000)
+    accounting.db = {
+        Collections.tokens_token_addresses_v2: FakeCollection(
+            [
+                {
+                    "_id": "<1,0>-",
+                    "contract": "<1,0>",
+                    "token_id": "",
+                    "token_amount": "5",
+                    "last_height_processed": 10,
+                }
+            ]
+        ),
+        Collections.tokens_links_v2: FakeCollection(
+            [
+                {
+                    "account_address": "a",
+                    "token_holding": {"token_address": "<1,0>-", "token_amount": "5"},
+                }
+            ]
+        ),
+    }
+    cached = token_address("<2,0>-", {"b": 7})
+    accounting.token_ledger.set(cached)
+
+    result = accounting.token_addresses_for_accounting(["<1,0>-", "<2,0>-"])
+    assert result["<1,0>-"].token_holders == {"a": 5}
+    assert result["<1,0>-"].token_amount == 5
+    assert result["<2,0>-"] is cached
+    assert accounting.db[Collections.tokens_links_v2].finds == 1
+
+    # once accounted for, <1,0>- comes from the ledger as well.
+    accounting.token_ledger.set(result["<1,0>-"])
+    accounting.token_addresses_for_accounting(["<1,0>-", "<2,0>-"])
+    assert accounting.db[Collections.tokens_links_v2].finds == 1
+
+
+def test_only_changed_holders_are_written():
+    accounting = TokenAccounting()
+    accounting.address_to_follow = None
+    token_address_as_class = token_address(
+        "<1,0>-", {f"holder{i}": 10 for i in range(1_000)}
+    )
+    changed_holders = set()
+    log = MongoTypeLoggedEvent(
+        **{
+            "_id": "5-0-0",
+            "logged_event": "",
+            "result": {
+                "tag": 255,
+                "token_id": "",
+                "token_amount": "10",
+                "from_address": "holder1",
+                "to_address": "holder2",
+            },
+            "tag": 255,
+            "event_type": "transfer_event",
+            "block_height": 5,
+            "tx_index": 0,
+            "ordering": 0,
+            "tx_hash": "tx",
+            "token_address": "<1,0>-",
+            "contract": "<1,0>",
+        }
+    )
+    accounting.execute_logged_event(token_address_as_class, log, changed_holders)
+    assert changed_holders == {"holder1", "holder2"}
+
+    queue = accounting.copy_token_holders_to_links(
+        token_address_as_class, changed_holders
+    )
+    ops = {op._filter["_id"]: op for op in queue}
+    assert len(ops) == 2
+    assert isinstance(ops["<1,0>--holder1"], DeleteOne)
+    assert ops["<1,0>--holder2"]._doc["token_holding"]["token_amount"] == "20"
+
+
+class FakeTokenCollection(FakeCollection):
+    """
+    Applies ReplaceOne and the `$set` of UpdateOne on `_id`. With `entered`
+    and `release` set, a bulk write waits for `release` halfway.
+    """
+
+    def __init__(self, docs: list[dict]):
+        super().__init__(docs)
+        self.entered = None
+        self.release = None
+
+    def find_one(self, query: dict):
+        return next((x for x in self.docs if x["_id"] == query["_id"]), None)
+
+    def bulk_write(self, ops: list):
+        if self.entered is not None:
+            self.entered.set()
+            self.release.wait(5)
+        for op in ops:
+            if isinstance(op, DeleteOne):
+                continue
+            doc = self.find_one(op._filter)
+            if doc is None:
+                doc = {"_id": op._filter["_id"]}
+                self.docs.append(doc)
+            if isinstance(op, ReplaceOne):
+                doc.update(op._doc)
+            else:
+                doc.update(op._doc["$set"])
+
+
+def mint_log(height: int) -> MongoTypeLoggedEvent:
+    return MongoTypeLoggedEvent(
+        **{
+            "_id": f"{height}-0-0",
+            "logged_event": "",
+            "result": {
+                "tag": 254,
+                "token_id": "",
+                "token_amount": "10",
+                "to_address": "holder1",
+            },
+            "tag": 254,
+            "event_type": "mint_event",
+            "block_height": height,
+            "tx_index": 0,
+            "ordering": 0,
+            "tx_hash": "tx",
+            "token_address": "<1,0>-",
+            "contract": "<1,0>",
+        }
+    )
+
+
+def test_locks_are_only_kept_while_held():
+    locks = TokenAddressLocks()
+    with locks.hold(["<2,0>-", "<1,0>-", "<1,0>-"]):
+        assert sorted(locks.locks) == ["<1,0>-", "<2,0>-"]
+        assert locks.locks["<1,0>-"][0].locked()
+    assert locks.locks == {}
+
+
+def test_redo_marked_during_accounting_is_kept():
+    accounting = TokenAccounting()
+    accounting.address_to_follow = None
+    accounting.token_ledger = TokenLedger(max_bytes=1_000_000)
+    accounting.token_address_locks = TokenAddressLocks()
+    links = FakeTokenCollection([])
+    accounting.db = {
+        Collections.tokens_token_addresses_v2: FakeTokenCollection(
+            [
+                {
+                    "_id": "<1,0>-",
+                    "contract": "<1,0>",
+                    "token_id": "",
+                    "token_amount": "0",
+                    "last_height_processed": 10,
+                }
+            ]
+        ),
+        Collections.tokens_links_v2: links,
+        Collections.helpers: FakeTokenCollection(
+            [{"_id": "redo_token_addresses", "token_addresses": ["<1,0>-"]}]
+        ),
+    }
+    token_address_doc = accounting.db[Collections.tokens_token_addresses_v2].docs[0]
+
+    # main accounting is writing the links of <1,0>- when the redo is marked.
+    links.entered = threading.Event()
+    links.release = threading.Event()
+    main = threading.Thread(
+        target=accounting.account_for_token_addresses,
+        args=(["<1,0>-"], {"<1,0>-": [mint_log(20)]}, 15),
+    )
+    redo = threading.Thread(target=accounting.mark_redo_token_addresses)
+    main.start()
+    assert links.entered.wait(5)
+    redo.start()
+    time.sleep(0.1)
+    assert token_address_doc["last_height_processed"] == 10
+    links.release.set()
+    main.join()
+    redo.join()
+    assert token_address_doc["last_height_processed"] == -1
+    assert accounting.token_ledger.get("<1,0>-") is None
+
+    # until the redo has run, main accounting leaves the marker alone.
+    links.entered = None
+    accounting.account_for_token_addresses(["<1,0>-"], {"<1,0>-": [mint_log(30)]}, 20)
+    assert token_address_doc["last_height_processed"] == -1
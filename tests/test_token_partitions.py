@@ -0,0 +1,17 @@
+from heartbeat.token_accounting import partition_token_addresses
+
+
+def test_partitions_balance_events():
+    events_by_token_address = {
+        "<1,0>-": [1] * 10,
+        "<2,0>-": [1] * 6,
+        "<3,0>-": [1] * 5,
+        "<4,0>-": [1] * 1,
+    }
+    partitions = partition_token_addresses(events_by_token_address, 2)
+    assert partitions == [["<1,0>-", "<4,0>-"], ["<2,0>-", "<3,0>-"]]
+
+    # never more partitions than token addresses, every token address once.
+    partitions = partition_token_addresses(events_by_token_address, 8)
+    assert len(partitions) == 4
+    assert sorted(sum(partitions, [])) == sorted(events_by_token_address)